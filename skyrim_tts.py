@@ -1,19 +1,30 @@
 import os
+import time
+import hashlib
 import argparse
+import torch
 import torchaudio
 from pathlib import Path
 import traceback
 import sys
+import multiprocessing
+from multiprocessing.connection import wait
 
-from tortoise.api import TextToSpeech
 from tortoise.utils.audio import load_voices
+from tortoise.utils.artifacts import ArtifactStore
 
-from skyrim_utils.Utils import create_empty_audio
+from skyrim_utils.Utils import create_empty_audio, link_or_copy
 from skyrim_utils.Logger import LoggingStream
 from skyrim_utils.BatchBuilder import BatchBuilder
 from skyrim_utils.BatchBuilder import STATE_COMPLETED_TRUE
-from skyrim_utils.BatchBuilder import STATE_COMPLETED_ONGOING, STATE_COMPLETED_ERROR
-from skyrim_utils.Settings import TtsSettings
+from skyrim_utils.BatchBuilder import STATE_COMPLETED_ERROR
+from skyrim_utils.Settings import TtsSettings, TortoiseModelPresets, TortoiseApiSettings
+from skyrim_utils.Settings import BatchPlannerSettings
+from skyrim_utils.BatchPlanner import BatchPlanner
+from skyrim_utils.BatchEstimator import BatchEstimator
+from skyrim_utils.TtsEngine import TtsEngine
+from skyrim_utils.AudioCache import AudioCache
+from skyrim_utils.AudioWriter import AudioWriter
 
 VERSION = "1.0.0"
 RET_ERROR = 1
@@ -34,6 +45,26 @@ def main():
     parser.add_argument('--archive-batch', '-a', action='store_true', help='Archive active batch, if any')
     parser.add_argument('--batch-generate', '-b', action='store_true',
                         help='Create the batch and start synthesizing the audio generation')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of worker processes used by --batch-generate. Each worker loads its own models '
+                             'and uses an equal share of the CPU threads. Default is 1')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='Serve the batch metrics of --batch-generate in the Prometheus text format on '
+                             'http://127.0.0.1:PORT/metrics. The metrics are always written to the batch metrics.json')
+    parser.add_argument('--keep-artifacts', action='store_true',
+                        help='Keep the intermediate results (sampled codes, CLVP scores, best latents) of the '
+                             'synthesized lines, so a line set back to false in batch.csv is synthesized again from '
+                             'its diffusion stage, as long as its sampling settings are unchanged. By default they are '
+                             'only kept until the audio of the line is written')
+
+    parser.add_argument('--estimate', '-e', action='store_true',
+                        help='Predict the compute time of the pending lines of the batch (or of the import, if the '
+                             'batch was not created yet), calibrated by a short benchmark on this machine')
+
+    parser.add_argument('--cache-info', action='store_true', help='Show the size of the synthesized audio cache')
+    parser.add_argument('--cache-prune', type=float, metavar='SIZE_MB',
+                        help='Evict the least recently used audios from the synthesized audio cache until its size is '
+                             'below SIZE_MB. Use 0 to clear the cache')
 
     parser.add_argument('--version', '-v', action='version', version=f'tortoise4skyrim {VERSION}', help='Show version')
 
@@ -51,8 +82,20 @@ def main():
         import_dialogs(args.import_dialogs)
         sys.exit(RET_SUCCESS)
 
+    if args.estimate:
+        ret = estimate_batch(workers=args.workers)
+        sys.exit(ret)
+
+    if args.cache_info:
+        audio_cache_info()
+        sys.exit(RET_SUCCESS)
+
+    if args.cache_prune is not None:
+        audio_cache_prune(args.cache_prune)
+        sys.exit(RET_SUCCESS)
+
     if args.batch_generate:
-        ret = batch_generate()
+        ret = batch_generate(workers=args.workers, metrics_port=args.metrics_port, keep_artifacts=args.keep_artifacts)
         sys.exit(ret)
 
 
@@ -71,13 +114,66 @@ def archive_batch():
 
 def import_dialogs(path):
     if BatchBuilder.is_import_active():
-        print("Import procedure already have been executed.")
-        print("To import again the dialogs from CreationKit, use the option --archive-import")
+        if not BatchBuilder.has_import_manifest():
+            print("Import procedure already have been executed.")
+            print("To import again the dialogs from CreationKit, use the option --archive-import")
+            return
+        # only the dialog files changed since the last import are parsed again
+        print(f"Re-importing changed dialogs from Creation Kit from path: {path}")
+        delta_df = BatchBuilder.reimport_dialogs(path)
+        BatchBuilder.create_delta_batch(delta_df)
         return
     print(f"Importing exported dialogs from Creation Kit from path: {path}")
+    import_file = BatchBuilder.import_dialogs(path)
+    print(f"Dialogs imported to {import_file}")
 
 
-def batch_generate():
+def audio_cache_info():
+    audio_cache = AudioCache(BatchBuilder.get_audio_cache_dir())
+    try:
+        info = audio_cache.info()
+    finally:
+        audio_cache.close()
+    print(f"Audio cache: {info['path']}")
+    print(f"Entries: {info['entries']}")
+    print(f"Size: {info['size'] / 1024 ** 2:.1f} MB of {info['max_size'] / 1024 ** 2:.1f} MB")
+
+
+def audio_cache_prune(size_mb):
+    audio_cache = AudioCache(BatchBuilder.get_audio_cache_dir())
+    try:
+        evicted = audio_cache.prune(int(size_mb * 1024 ** 2))
+    finally:
+        audio_cache.close()
+    print(f"{evicted} entries evicted from the audio cache.")
+
+
+def estimate_batch(workers=1):
+    lines = BatchBuilder.get_pending_lines()
+    if len(lines) == 0:
+        print("Error: there are no pending lines to estimate. Import the dialogs from CreationKit first. Use --help "
+              "option for help.")
+        BatchBuilder.close_batch_store()
+        return RET_ERROR
+    try:
+        planner = BatchPlanner(**BatchPlannerSettings.get_default())
+        estimator = BatchEstimator(planner)
+        voiced = [line for line in lines if str(line['text']).strip() != ""]
+        preset_settings = {'num_autoregressive_samples': 0, 'diffusion_iterations': 0}
+        if len(voiced) > 0:
+            # the benchmark uses the voice and api settings of the first line to synthesize
+            engine = TtsEngine(models_dir=BatchBuilder.get_models_dir(), latents_dir=BatchBuilder.get_latents_dir())
+            engine.configure(TtsSettings.get_settings(voiced[0])['api'])
+            estimator.calibrate(engine, voiced[0]['voice'])
+            preset_settings = engine.preset_settings()
+        estimate = estimator.estimate(lines, preset_settings)
+        BatchEstimator.report(estimate, workers=workers)
+    finally:
+        BatchBuilder.close_batch_store()
+    return RET_SUCCESS
+
+
+def batch_generate(workers=1, metrics_port=None, keep_artifacts=False):
     # Check if batch is active or not.
     if not BatchBuilder.is_batch_active():
         if not BatchBuilder.is_import_active():
@@ -94,11 +190,22 @@ def batch_generate():
 
     # batch is already active, start batch loop.
     print("Starting batch audio generation...")
-    while True:
-        entry = BatchBuilder.get_next_line()
+    metrics_exporter = None
+    try:
+        # load the batch.csv into the batch store before any worker starts
+        BatchBuilder.get_batch_store()
+        metrics_exporter = BatchBuilder.start_metrics_exporter(port=metrics_port)
+        print(f"Batch metrics are written to {BatchBuilder.get_batch_metrics_path()}")
+        BatchPlanner(**BatchPlannerSettings.get_default()).report(BatchBuilder.get_claimable_lines())
+        if workers > 1:
+            run_batch_workers(workers, keep_artifacts=keep_artifacts)
+        else:
+            # models are loaded once, and shared by all the entries of the batch.
+            engine = TtsEngine(models_dir=BatchBuilder.get_models_dir(), latents_dir=BatchBuilder.get_latents_dir())
+            run_batch_loop(engine, owner=f"main-{os.getpid()}", keep_artifacts=keep_artifacts)
 
         # batch finished
-        if entry == None:
+        if BatchBuilder.get_next_line() is None:
             resp = input("No valid batch to proceed. Do you want to archive current batch?(Y/N)").strip().upper()
             if resp == "Y":
                BatchBuilder.archive_batch()
@@ -106,83 +213,352 @@ def batch_generate():
                 # solid here
                 batchfile = BatchBuilder.get_batch_file_path()
                 print(f"Use --archive-batch option to archive the active batch, or rename/edit the file {batchfile} manually to proceed.")
-            break
-
-        BatchBuilder.update_batch_line(entry["id"], STATE_COMPLETED_ONGOING)
-        state = tortoise_do_tts(entry)
-        BatchBuilder.update_batch_line(entry["id"], state)
+        else:
+            print("Batch generation stopped with lines still pending. Use --batch-generate to resume it.")
+    finally:
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+        # write the latest states back to batch.csv, even if the run was interrupted
+        BatchBuilder.close_batch_store()
 
     LoggingStream.finalize()
     return RET_SUCCESS
 
 
+def run_batch_loop(engine, owner, keep_artifacts=False):
+    """
+    Claim and synthesize groups of batch lines until there is nothing left. The claimed lines are leased to owner,
+    and the leases are renewed by a heartbeat thread while the lines are synthesized.
+    The audios are saved by a background writer, and a line is only marked as completed once its files are written.
+    The intermediate results of each line are checkpointed, so a line interrupted by a crash is resumed from its
+    last completed stage.
+    """
+    heartbeat = BatchBuilder.start_lease_heartbeat(owner)
+    audio_cache = AudioCache(BatchBuilder.get_audio_cache_dir())
+    planner = BatchPlanner(**BatchPlannerSettings.get_default())
+    writer = AudioWriter()
+    writer.start()
+    # line id -> (audio seconds, synthesis seconds), for the batch metrics
+    timings = {}
+    last_voice = None
+    try:
+        while True:
+            # lines are processed grouped by voice, so the voice latents can be reused between entries, and by text
+            # length, so the lines of a group can be synthesized together with little padding.
+            entries = BatchBuilder.claim_next_group(owner, planner, prefer_voice=last_voice)
+            if len(entries) == 0:
+                break
+
+            states = tortoise_do_tts_group(entries, engine, audio_cache=audio_cache, writer=writer, timings=timings,
+                                           use_artifacts=True, keep_artifacts=keep_artifacts)
+            for entry, state in zip(entries, states):
+                # None: the state is reported by the writer
+                if state is not None:
+                    update_line(entry["id"], state, owner, timings)
+            update_written_lines(writer.completed(), owner, timings)
+            last_voice = entries[-1]["voice"]
+        print(f"Padding waste of the synthesized groups: {planner.padding_waste() * 100:.1f}%")
+    finally:
+        # the queued audios are written before the leases are released
+        update_written_lines(writer.close(), owner, timings)
+        heartbeat.stop()
+        audio_cache.close()
+        # lines interrupted by an exception are given back to the batch
+        BatchBuilder.release_leases(owner)
+
+
+def update_written_lines(results, owner, timings):
+    """
+    Update the batch states with the (line id, error) results of the audio writer.
+    """
+    for line_id, error in results:
+        if error is None:
+            update_line(line_id, STATE_COMPLETED_TRUE, owner, timings)
+        else:
+            LoggingStream.error(f"Error writing the audio of the line {line_id}: {error}")
+            update_line(line_id, STATE_COMPLETED_ERROR, owner, timings)
+
+
+def update_line(line_id, state, owner, timings):
+    """
+    Update the batch state of a line, recording its synthesis timing for the batch metrics.
+    """
+    audio_seconds, synth_seconds = timings.pop(line_id, (0.0, 0.0))
+    if state != STATE_COMPLETED_TRUE:
+        audio_seconds, synth_seconds = 0.0, 0.0
+    BatchBuilder.update_batch_line(line_id, state, owner=owner, audio_seconds=audio_seconds,
+                                   synth_seconds=synth_seconds)
+
+
+def run_batch_workers(workers, keep_artifacts=False):
+    """
+    Run the batch with several worker processes, each one with its own engine and an equal share of the CPU threads.
+    batch.csv is exported by this process while the workers are running.
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Starting {workers} batch workers with {num_threads} threads each...")
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=batch_worker, args=(worker_id, num_threads, keep_artifacts),
+                                 name=f"batch-worker-{worker_id}")
+                 for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        running = list(processes)
+        while len(running) > 0:
+            wait([process.sentinel for process in running], timeout=BatchBuilder.LEASE_HEARTBEAT_SECONDS)
+            for process in [process for process in running if not process.is_alive()]:
+                running.remove(process)
+                if process.exitcode != 0:
+                    print(f"WARNING: {process.name} exited with code {process.exitcode}. "
+                          f"Its ongoing lines will be claimed again by the other workers.")
+            BatchBuilder.export_batch()
+    finally:
+        for process in processes:
+            process.join()
+
+
+def batch_worker(worker_id, num_threads, keep_artifacts=False):
+    """
+    Entry point of the batch worker processes.
+    """
+    torch.set_num_threads(num_threads)
+    BatchBuilder.disable_csv_sync()
+    log_name, log_ext = os.path.splitext(LOG_FILE_NAME)
+    LoggingStream.initialize(log_dir=BatchBuilder.get_log_dir(), log_file=f"{log_name}.worker{worker_id}{log_ext}")
+    try:
+        engine = TtsEngine(models_dir=BatchBuilder.get_models_dir(), latents_dir=BatchBuilder.get_latents_dir())
+        run_batch_loop(engine, owner=f"worker{worker_id}-{os.getpid()}", keep_artifacts=keep_artifacts)
+    finally:
+        BatchBuilder.close_batch_store()
+        LoggingStream.finalize()
+
+
 def remove_filename_from_path(file_path):
     path = Path(file_path)
     directory = path.parent
     return str(directory) + os.sep
 
 
-def tortoise_do_tts(entry, bypass=False):
+def tortoise_do_tts(entry, engine, audio_cache=None, bypass=False):
+    return tortoise_do_tts_group([entry], engine, audio_cache=audio_cache, bypass=bypass)[0]
+
+
+def tortoise_do_tts_group(entries, engine, audio_cache=None, writer=None, timings=None, use_artifacts=False,
+                          keep_artifacts=False, bypass=False):
+    """
+    Synthesize a group of batch lines planned by the BatchPlanner (same voice, similar text lengths). The lines that
+    are not in the audio cache are synthesized together by a single engine call. Returns the state of each line.
+    If writer (an AudioWriter) is given, the synthesized audios are saved by it, and the state of their lines is None:
+    it is reported by the writer once the files are written.
+    If timings (a dict) is given, the seconds of audio synthesized for each line and the wall time spent synthesizing
+    them are stored in it, by line id. The time of a group synthesis is split between its lines by audio length.
+    If use_artifacts is True, the intermediate results of each line are checkpointed in its ArtifactStore, and the
+    lines with checkpoints left by an interrupted run are resumed from them. The checkpoints are removed once the
+    audio is written, unless keep_artifacts is True.
+    """
     if bypass:
-        print(f"Skipping speach synthesis for entry {entry}.")
+        print(f"Skipping speach synthesis for entries {entries}.")
         LoggingStream.finalize()
-        return STATE_COMPLETED_TRUE
+        return [STATE_COMPLETED_TRUE] * len(entries)
+
+    states = [STATE_COMPLETED_ERROR] * len(entries)
+    # lines to be synthesized by tortoise: (index, entry, settings, output_dir, output_file_name, cache_key)
+    pending = []
+    for i, entry in enumerate(entries):
+        try:
+            print("\n##########################################################################")
+            print(f"Starting Voice Synthesis [{entry['id']}]: {entry['quest']}")
+            print("##########################################################################")
+
+            print(f"entry: {entry}")
+
+            settings = TtsSettings.get_settings(entry)
+            print(f"settings:{settings}")
+            preset = settings['model']
+            api = settings['api']
+            candidates = settings['candidates']
+            synth_engine = settings['engine']
+
+            output_dir = remove_filename_from_path(entry["output_path"])
+            output_file_name, _ = os.path.splitext(os.path.basename(entry["output_path"]))
+
+            # I may add more tools for tts later...
+            if synth_engine == TtsSettings.SYNTH_ENGINE_WAVE_EMPTY_AUDIO:
+                # empty audio
+                os.makedirs(output_dir, exist_ok=True)
+                output_files = [candidate_file_name(output_file_name, 0)]
+                create_empty_audio(filename=os.path.join(output_dir, output_files[0]), duration=2)
+                fan_out(entry, output_dir, output_file_name, output_files)
+                states[i] = STATE_COMPLETED_TRUE
+                continue
+
+            # audios already synthesized with the same text, voice and settings are taken from the cache
+            cache_key = None
+            if audio_cache is not None:
+                cache_key = AudioCache.make_key(entry['text'], engine.get_voice_hash(entry['voice']),
+                                                {'model': preset, 'api': TortoiseApiSettings.output_settings(api)},
+                                                api['seed'], candidates)
+                cached_files = [candidate_file_name(output_file_name, j) for j in range(candidates)]
+                if audio_cache.get(cache_key, [os.path.join(output_dir, name) for name in cached_files]):
+                    print("Audio found in the audio cache, skipping the synthesis.")
+                    fan_out(entry, output_dir, output_file_name, cached_files)
+                    states[i] = STATE_COMPLETED_TRUE
+                    continue
+
+            pending.append((i, entry, settings, output_dir, output_file_name, cache_key))
+        except Exception as e:
+            log_tts_error(e)
+
+    if len(pending) == 0:
+        return states
 
     try:
-        print("\n##########################################################################")
-        print(f"Starting Voice Synthesis [{entry['id']}]: {entry['quest']}")
-        print("##########################################################################")
-
-        print(f"entry: {entry}")
-
-        model_dir = BatchBuilder.get_models_dir()
-        settings = TtsSettings.get_settings(entry)
-        print(f"settings:{settings}")
+        # tortoise, the lines of a group share the voice and the emotion, so they share the synthesis settings too.
+        _, first_entry, settings, _, _, _ = pending[0]
         preset = settings['model']
         api = settings['api']
         candidates = settings['candidates']
-        engine = settings['engine']
+        engine.configure(api)
+
+        # the voice samples are only needed by CVVP, otherwise the cached conditioning latents are used.
+        voice_samples = None
+        if api['cvvp_amount'] > 0:
+            voice_samples, _ = load_voices([first_entry['voice']])
+        conditioning_latents = engine.get_conditioning_latents(first_entry['voice'])
+        tts_kwargs = dict(k=candidates, use_deterministic_seed=api['seed'], return_deterministic_state=True,
+                          temperature=preset['temperature'], length_penalty=preset['length_penalty'],
+                          repetition_penalty=preset['repetition_penalty'], top_p=preset['top_p'],
+                          cond_free_k=preset['cond_free_k'], diffusion_temperature=preset['diffusion_temperature'],
+                          fuse_cond_free=api['fuse_cond_free'])
+        # the emotion presets only set the diffusion sampler with the fast_sampler api setting, otherwise the one of the
+        # tortoise preset is used
+        for key in TortoiseModelPresets.SAMPLER_KEYS:
+            if key in preset:
+                tts_kwargs[key] = preset[key]
+
+        stores = {i: artifact_store(entry) if use_artifacts else None for i, entry, _, _, _, _ in pending}
+        # lines with checkpoints are resumed by the single line synthesis, the others are synthesized together.
+        resumed = [i for i, _, _, _, _, _ in pending if stores[i] is not None and has_checkpoints(stores[i])]
+        single = [item for item in pending if item[0] in resumed]
+        together = [item for item in pending if item[0] not in resumed]
+        if len(together) == 1 or voice_samples is not None:
+            # CVVP is only supported by the single line synthesis
+            single, together = single + together, []
+
+        results = {}
+        for i, entry, _, _, _, _ in single:
+            start = time.perf_counter()
+            gen, dbg_state = engine.tts(entry['text'], voice_samples=voice_samples,
+                                        conditioning_latents=conditioning_latents,
+                                        cvvp_amount=api['cvvp_amount'], artifact_store=stores[i],
+                                        adaptive_sampling=api['adaptive_sampling'],
+                                        pipelined_scoring=api['pipelined_scoring'],
+                                        reuse_latents=api['reuse_latents'],
+                                        batch_candidates=api['batch_candidates'], **tts_kwargs)
+            results[i] = gen
+            if timings is not None:
+                timings[entry['id']] = (audio_seconds(gen), time.perf_counter() - start)
+        if len(together) > 0:
+            print(f"Synthesizing {len(together)} lines together...")
+            start = time.perf_counter()
+            gens, dbg_state = engine.tts_batch([entry['text'] for _, entry, _, _, _, _ in together],
+                                               conditioning_latents,
+                                               artifact_stores=[stores[i] for i, _, _, _, _, _ in together],
+                                               **tts_kwargs)
+            for (i, _, _, _, _, _), gen in zip(together, gens):
+                results[i] = gen
+            if timings is not None:
+                elapsed = time.perf_counter() - start
+                lengths = [audio_seconds(gen) for gen in gens]
+                total = sum(lengths)
+                for (_, entry, _, _, _, _), length in zip(together, lengths):
+                    share = length / total if total > 0 else 1 / len(together)
+                    timings[entry['id']] = (length, elapsed * share)
+    except Exception as e:
+        log_tts_error(e)
+        return states
+
+    for i, entry, _, output_dir, output_file_name, cache_key in pending:
+        try:
+            gen = results[i] if isinstance(results[i], list) else [results[i]]
+            output_files = [candidate_file_name(output_file_name, j) for j in range(len(gen))]
+            files = [(os.path.join(output_dir, name), g.squeeze(0).cpu()) for name, g in zip(output_files, gen)]
+
+            def after_write(entry=entry, output_dir=output_dir, output_file_name=output_file_name,
+                            output_files=output_files, cache_key=cache_key, store=stores[i]):
+                if cache_key is not None:
+                    try:
+                        audio_cache.put(cache_key, [os.path.join(output_dir, name) for name in output_files])
+                    except Exception as e:
+                        print(f"WARNING: Cannot store the audio in the audio cache: {e}")
+                fan_out(entry, output_dir, output_file_name, output_files)
+                if store is not None and not keep_artifacts:
+                    store.clear()
+
+            if writer is not None:
+                writer.submit(entry['id'], files, after_write)
+                states[i] = None
+            else:
+                os.makedirs(output_dir, exist_ok=True)
+                for path, wav in files:
+                    torchaudio.save(path, wav, 24000)
+                after_write()
+                states[i] = STATE_COMPLETED_TRUE
+        except Exception as e:
+            log_tts_error(e)
 
-        output_dir = remove_filename_from_path(entry["output_path"])
-        output_file_name, _ = os.path.splitext(os.path.basename(entry["output_path"]))
-        print(f"Creating output path {output_dir}...")
-        os.makedirs(output_dir, exist_ok=True)
+    return states
 
-        # I may add more tools for tts later...
-        if engine == TtsSettings.SYNTH_ENGINE_WAVE_EMPTY_AUDIO:
-            # empty audio
-            create_empty_audio(filename=os.path.join(output_dir, f'{output_file_name}.wav'), duration=2)
-        else:
-            # tortoise
-            tts = TextToSpeech(models_dir=model_dir, use_deepspeed=api['use_deepspeed'], kv_cache=api['kv_cache'],
-                               half=api['half'])
-
-
-            # voice_samples, conditioning_latents = load_voices(['malenordneutral'])
-            voice_samples, conditioning_latents = load_voices([entry['voice']])
-
-            gen, dbg_state = tts.tts_with_preset(entry['text'], k=candidates, voice_samples=voice_samples,
-                                                 conditioning_latents=conditioning_latents,
-                                                 preset=api['preset'], use_deterministic_seed=api['seed'],
-                                                 return_deterministic_state=True, cvvp_amount=api['cvvp_amount'],
-                                                 temperature=preset['temperature'], length_penalty=preset['length_penalty'],
-                                                 repetition_penalty=preset['repetition_penalty'], top_p=preset['top_p'],
-                                                 cond_free_k=preset['cond_free_k'],
-                                                 diffusion_temperature=preset['diffusion_temperature'])
-            if isinstance(gen, list):
-                for j, g in enumerate(gen):
-                    pre_ext = "" if j == 0 else f"({j})"
-                    torchaudio.save(os.path.join(output_dir, f'{output_file_name}{pre_ext}.wav'), g.squeeze(0).cpu(), 24000)
-            else:
-                torchaudio.save(os.path.join(output_dir, f'{output_file_name}.wav'), gen.squeeze(0).cpu(), 24000)
 
-        return STATE_COMPLETED_TRUE
+def log_tts_error(e):
+    traceback_content = traceback.format_exc()
+    LoggingStream.error(f"Error Message: {e}")
+    LoggingStream.error(f"Stack Trace: {traceback_content}")
+
+
+def artifact_store(entry):
+    """
+    ArtifactStore of the checkpoints of a batch line, shared by the lines with the same voice and text.
+    """
+    key = hashlib.sha256(f"{entry['voice']}\n{entry['text']}".encode('utf-8')).hexdigest()[:32]
+    return ArtifactStore(os.path.join(BatchBuilder.get_artifacts_dir(), key))
+
+
+def has_checkpoints(store):
+    return os.path.isdir(store.directory) and len(os.listdir(store.directory)) > 0
+
+
+def audio_seconds(gen):
+    """
+    Seconds of audio of a tortoise result (a clip, or a list of candidate clips), at 24kHz.
+    """
+    gen = gen if isinstance(gen, list) else [gen]
+    return sum(g.shape[-1] for g in gen) / 24000
+
+
+def candidate_file_name(output_file_name, j):
+    pre_ext = "" if j == 0 else f"({j})"
+    return f'{output_file_name}{pre_ext}.wav'
+
+
+def fan_out(entry, output_dir, output_file_name, output_files):
+    """
+    Copy the audios synthesized for a batch line to the output paths of its duplicated lines, keeping the candidate
+    suffixes ("(1)", "(2)", ...) of the file names.
+    """
+    fanout_paths = BatchBuilder.get_fanout_paths(entry)
+    if len(fanout_paths) == 0:
+        return
+    print(f"Copying the results to {len(fanout_paths)} duplicated lines...")
+    for fanout_path in fanout_paths:
+        fanout_dir = remove_filename_from_path(fanout_path)
+        fanout_name, _ = os.path.splitext(os.path.basename(fanout_path))
+        for output_file in output_files:
+            suffix = output_file[len(output_file_name):]
+            link_or_copy(os.path.join(output_dir, output_file), os.path.join(fanout_dir, f"{fanout_name}{suffix}"))
 
-    except Exception as e:
-        traceback_content = traceback.format_exc()
-        LoggingStream.error(f"Error Message: {e}")
-        LoggingStream.error(f"Stack Trace: {traceback_content}")
-        return STATE_COMPLETED_ERROR
 
 def setup_home():
     # set .. dir as home
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+
+class AudioCache:
+    """
+    Persistent cache of synthesized audios, shared by all the batches. Entries are addressed by a hash of everything
+    that defines the synthesis result (processed text, voice samples, model and api settings, seed, number of
+    candidates), so a line already generated by a previous batch, or by another mod, is copied from the cache instead
+    of synthesized again.
+    The audios are kept in <cache_dir>/<key[:2]>/<key>/, and an index database keeps their size and last use time,
+    so the least recently used entries are evicted when the cache grows over max_bytes.
+    An instance can be shared by the threads of a process.
+    """
+    INDEX_FILE = "index.db"
+    DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, AudioCache.INDEX_FILE), timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.RLock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, files TEXT NOT NULL, "
+                           "size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used)")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def make_key(text, voice_hash, settings, seed, candidates):
+        """
+        Cache key of a synthesis. settings is any json serializable object with the model/api settings used.
+        """
+        content = json.dumps({'text': text, 'voice_hash': voice_hash, 'settings': settings, 'seed': seed,
+                              'candidates': candidates}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key, output_files):
+        """
+        Copy the cached audios of key to output_files, in the order they were stored. Returns False on a miss.
+        """
+        with self._lock:
+            return self._get(key, output_files)
+
+    def put(self, key, files):
+        """
+        Store a copy of the audio files under key, evicting the least recently used entries if needed.
+        """
+        with self._lock:
+            self._put(key, files)
+
+    def info(self):
+        """
+        Returns a dict with the number of entries, the total size in bytes and the size limit.
+        """
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {'entries': count, 'size': size, 'max_size': self.max_bytes, 'path': self.cache_dir}
+
+    def prune(self, max_bytes):
+        """
+        Evict the least recently used entries until the cache size is below max_bytes. Returns the number of evicted
+        entries.
+        """
+        with self._lock:
+            return self._prune(max_bytes)
+
+    #####################################################
+
+    def _get(self, key, output_files):
+        row = self._conn.execute("SELECT files FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        files = json.loads(row[0])
+        entry_dir = self._entry_dir(key)
+        if len(files) != len(output_files) or \
+                not all(os.path.exists(os.path.join(entry_dir, name)) for name in files):
+            # incomplete entry, e.g. the files were deleted by hand
+            self._remove(key)
+            return False
+        for name, output_file in zip(files, output_files):
+            os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+            shutil.copyfile(os.path.join(entry_dir, name), output_file)
+        self._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return True
+
+    def _put(self, key, files):
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        names = []
+        size = 0
+        for i, src in enumerate(files):
+            name = f"{i}{os.path.splitext(src)[1]}"
+            shutil.copyfile(src, os.path.join(tmp_dir, name))
+            size += os.path.getsize(src)
+            names.append(name)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        now = time.time()
+        self._conn.execute("INSERT OR REPLACE INTO entries (key, files, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                           (key, json.dumps(names), size, now, now))
+        self._prune(self.max_bytes)
+
+    def _prune(self, max_bytes):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= max_bytes:
+                break
+            self._remove(key)
+            total -= size
+            evicted += 1
+        return evicted
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remove(self, key):
+        self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
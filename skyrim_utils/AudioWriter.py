@@ -0,0 +1,71 @@
+import os
+import queue
+import threading
+import torchaudio
+
+
+class AudioWriter(threading.Thread):
+    """
+    Background thread saving the synthesized audios, so the inference never waits for the disk.
+    Jobs are a list of (path, waveform tensor) and an optional callable run after the files are written. The queue is
+    bounded, so submit() blocks when the disk cannot keep up with the synthesis. The result of each job is collected
+    by completed(), as (job_id, error) pairs with error None on success, so the caller can update the batch states
+    from its own thread.
+    """
+    _STOP = object()
+
+    def __init__(self, sample_rate=24000, max_pending=16):
+        super().__init__(name="audio-writer", daemon=True)
+        self.sample_rate = sample_rate
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._results = queue.Queue()
+        # directories already created, so os.makedirs is called once per directory
+        self._created_dirs = set()
+
+    def submit(self, job_id, files, after_write=None):
+        """
+        Queue the waveforms (cpu tensors) to be saved as wav files. after_write is called on the writer thread once
+        all the files are written.
+        """
+        if not self.is_alive():
+            raise RuntimeError("The audio writer is not running.")
+        self._jobs.put((job_id, files, after_write))
+
+    def completed(self):
+        """
+        Returns the (job_id, error) pairs of the jobs finished since the last call.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """
+        Write all the queued jobs and stop the thread. Returns the (job_id, error) pairs not collected yet.
+        """
+        if self.is_alive():
+            self._jobs.put(AudioWriter._STOP)
+            self.join()
+        return self.completed()
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is AudioWriter._STOP:
+                return
+            job_id, files, after_write = job
+            try:
+                for directory in set(os.path.dirname(path) for path, _ in files) - self._created_dirs:
+                    if directory != "":
+                        os.makedirs(directory, exist_ok=True)
+                    self._created_dirs.add(directory)
+                for path, wav in files:
+                    torchaudio.save(path, wav, self.sample_rate)
+                if after_write is not None:
+                    after_write()
+                self._results.put((job_id, None))
+            except Exception as e:
+                self._results.put((job_id, e))
@@ -4,8 +4,13 @@ import glob
 import traceback
 import pandas as pd
 from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from skyrim_utils.CustomExceptions import *
+from skyrim_utils.BatchStore import BatchStore, LeaseHeartbeat
+from skyrim_utils.BatchPlanner import BatchPlanner
+from skyrim_utils.BatchMetrics import MetricsExporter
+from skyrim_utils.ImportManifest import ImportManifest
 
 
 # == states of the column completed ==
@@ -27,12 +32,28 @@ class BatchBuilder:
     CACHE_FOLDER = "cache"
     RESULTS_FOLDER = "results"
     MODELS_FOLDER = "models"
+    LATENTS_FOLDER = "latents"
+    AUDIO_CACHE_FOLDER = "audio"
+    ARTIFACTS_FOLDER = "artifacts"
     IMPORT_FILE = os.path.join("import", "import.csv")
+    IMPORT_MANIFEST_FILE = os.path.join("import", "manifest.json")
     BATCH_FILE = os.path.join("batch", "batch.csv")
+    BATCH_DB_FILE = os.path.join("batch", "batch.db")
+    BATCH_METRICS_FILE = os.path.join("batch", "metrics.json")
+    # number of state updates between two exports of the batch store to batch.csv
+    BATCH_EXPORT_INTERVAL = 20
+    # a claimed line is given to another worker if its owner does not renew the lease for LEASE_SECONDS
+    LEASE_SECONDS = 120
+    LEASE_HEARTBEAT_SECONDS = 30
+    # interval between two rewrites of the batch metrics file
+    METRICS_EXPORT_SECONDS = 15
     VALID_EMOTIONS = ['neutral', 'anger', 'happy', 'disgust', 'puzzled', 'sad', 'fear', 'hurt', 'surprise', 'sing',
                       'confident', 'curious', 'frustrated', 'amused']
     INPUT_COLUMNS = ['quest', 'voice_type', 'emotion', 'intensity', 'text', 'file', 'filepath', 'source']
-    BATCH_HEADER = ['id', 'quest', 'completed', 'voice', 'emotion','text', 'output_path']
+    # fanout: other output paths of the same utterance, separated by FANOUT_SEP. They receive a copy (or hard link)
+    # of the audios synthesized for output_path.
+    BATCH_HEADER = ['id', 'quest', 'completed', 'voice', 'emotion','text', 'output_path', 'fanout']
+    FANOUT_SEP = "|"
     LOW_EMOTION_PREFIXES = {
         "neutral": "",
         "anger": "I'M ANGRY",
@@ -71,19 +92,58 @@ class BatchBuilder:
     EMPTY_VALUE_STR = ""
     EMPTY_VALUE_INT = "0"
     CSV_SEP = ";"
+    # common special characters found in the exported dialogs, other non-ASCII characters are removed.
+    SPECIAL_CHARS_TABLE = str.maketrans({
+        "…": "...",
+        "’": "'",
+        "‘": "'",
+        "“": "\"",
+        "”": "\"",
+        "–": "-",
+        "—": "-",
+        "•": "-",
+        # Add any other replacements as needed
+    })
+    _batch_store = None
+    _pending_updates = 0
+    _csv_sync = True
 
     @staticmethod
     def get_batch_file_path():
         return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.BATCH_FILE)
 
+    @staticmethod
+    def get_batch_db_path():
+        return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.BATCH_DB_FILE)
+
+    @staticmethod
+    def get_batch_metrics_path():
+        return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.BATCH_METRICS_FILE)
+
     @staticmethod
     def get_import_file_path():
         return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.IMPORT_FILE)
 
+    @staticmethod
+    def get_import_manifest_path():
+        return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.IMPORT_MANIFEST_FILE)
+
     @staticmethod
     def get_models_dir():
         return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.MODELS_FOLDER)
 
+    @staticmethod
+    def get_latents_dir():
+        return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.LATENTS_FOLDER)
+
+    @staticmethod
+    def get_audio_cache_dir():
+        return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.AUDIO_CACHE_FOLDER)
+
+    @staticmethod
+    def get_artifacts_dir():
+        return os.path.join(BatchBuilder.CACHE_FOLDER, BatchBuilder.ARTIFACTS_FOLDER)
+
     @staticmethod
     def get_log_dir():
         return os.path.join(BatchBuilder.RESULTS_FOLDER, "logs")
@@ -92,15 +152,104 @@ class BatchBuilder:
     def import_dialogs(skyrim_root):
         BatchBuilder._initialize()
         import_file = BatchBuilder.get_import_file_path()
-        df = BatchBuilder._import_all_dialogues(skyrim_root)
+        list_dialogs = BatchBuilder._list_dialog_files(skyrim_root)
+        loaded_dfs = BatchBuilder._parse_dialogue_files(list_dialogs)
+        df = BatchBuilder._concat_dialogues(loaded_dfs)
+        os.makedirs(os.path.dirname(import_file), exist_ok=True)
         df.to_csv(import_file, sep=BatchBuilder.CSV_SEP, index=False)
+
+        # files that could not be parsed are left out of the manifest, so they are parsed again by the next re-import
+        manifest = ImportManifest(BatchBuilder.get_import_manifest_path())
+        for dialog_file, loaded_df in zip(list_dialogs, loaded_dfs):
+            if loaded_df is not None:
+                manifest.update(dialog_file, ImportManifest.row_hashes(loaded_df))
+        manifest.save()
         return import_file
 
+    @staticmethod
+    def reimport_dialogs(skyrim_root):
+        """
+        Update the active import with the dialogueExport*.txt files changed since the last import. Only the changed
+        files are parsed again, and the rows of the removed files are dropped from import.csv.
+        Returns a Dataframe with the new or modified rows.
+        """
+        import_file = BatchBuilder.get_import_file_path()
+        manifest = ImportManifest.load(BatchBuilder.get_import_manifest_path())
+        list_dialogs = BatchBuilder._list_dialog_files(skyrim_root)
+        changed_dialogs = [dialog_file for dialog_file in list_dialogs if manifest.is_changed(dialog_file)]
+        removed_sources = manifest.removed_sources(list_dialogs)
+        print(f"{len(changed_dialogs)} changed and {len(removed_sources)} removed dialog files since the last import.")
+        if len(changed_dialogs) == 0 and len(removed_sources) == 0:
+            return pd.DataFrame(columns=BatchBuilder.INPUT_COLUMNS)
+
+        old_df = pd.read_csv(import_file, sep=BatchBuilder.CSV_SEP, dtype=str, keep_default_na=False, index_col=False)
+        old_dfs = {source: group for source, group in old_df.groupby('source', sort=False)}
+        parsed_dfs = {}
+        delta_dfs = []
+        for dialog_file, loaded_df in zip(changed_dialogs, BatchBuilder._parse_dialogue_files(changed_dialogs)):
+            if loaded_df is None:
+                # keep the previous rows of the file, it is parsed again by the next re-import
+                continue
+            source = os.path.basename(dialog_file)
+            row_hashes = ImportManifest.row_hashes(loaded_df)
+            delta_dfs.append(loaded_df[~row_hashes.isin(manifest.get_row_hashes(source))])
+            manifest.update(dialog_file, row_hashes)
+            parsed_dfs[source] = loaded_df
+        for source in removed_sources:
+            manifest.remove(source)
+
+        # rebuild import.csv in the order of the dialog files
+        import_dfs = []
+        for dialog_file in list_dialogs:
+            source = os.path.basename(dialog_file)
+            if source in parsed_dfs:
+                import_dfs.append(parsed_dfs[source])
+            elif source in old_dfs:
+                import_dfs.append(old_dfs[source])
+        BatchBuilder._concat_dialogues(import_dfs).to_csv(import_file, sep=BatchBuilder.CSV_SEP, index=False)
+        manifest.save()
+
+        delta_df = BatchBuilder._concat_dialogues(delta_dfs)
+        print(f"{len(delta_df)} new or modified lines imported.")
+        return delta_df
+
+    @staticmethod
+    def has_import_manifest():
+        return os.path.exists(BatchBuilder.get_import_manifest_path())
+
     @staticmethod
     def create_tts_batch(import_file):
         df = pd.read_csv(import_file, sep=BatchBuilder.CSV_SEP, dtype=str, header=0, index_col=False)
         try:
             batch_file = BatchBuilder._create_batch_from_dataframe(df, check_voice_samples=False)
+            BatchBuilder._set_import_batched()
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            traceback.print_exc()
+
+    @staticmethod
+    def create_delta_batch(delta_df):
+        """
+        Add the new or modified lines returned by reimport_dialogs() to the batch. They are appended to the active
+        batch, or become a new batch with just these lines if the previous one was archived. Already generated audios
+        are not touched. If no batch was created from the import yet, nothing is done, since the whole import will be
+        in the first batch.
+        """
+        if len(delta_df) == 0:
+            return
+        manifest = ImportManifest.load(BatchBuilder.get_import_manifest_path())
+        if not manifest.batched:
+            print("The updated import will be used when the batch is created.")
+            return
+        delta_df = delta_df.reset_index(drop=True)
+        try:
+            if BatchBuilder.is_batch_active():
+                batch_lines = BatchBuilder._build_batch_lines(delta_df, check_voice_samples=False)
+                appended = BatchBuilder.get_batch_store().append_lines(batch_lines, fanout_sep=BatchBuilder.FANOUT_SEP)
+                BatchBuilder.close_batch_store()
+                print(f"{appended} lines appended to the batch {BatchBuilder.get_batch_file_path()}")
+            else:
+                BatchBuilder._create_batch_from_dataframe(delta_df, check_voice_samples=False)
         except Exception as e:
             print(f"An error occurred: {e}")
             traceback.print_exc()
@@ -121,6 +270,11 @@ class BatchBuilder:
             if confirmation != 'Y':
                 print("Operation canceled.")
                 return
+            # make sure the csv holds the latest states before archiving it
+            if os.path.exists(BatchBuilder.get_batch_db_path()):
+                BatchBuilder.get_batch_store()
+            BatchBuilder.close_batch_store()
+            BatchBuilder._remove_batch_db()
             now = datetime.now()
             timestamp = now.strftime("%Y-%m-%d-%H-%M-%S")
             new_filename = os.path.join(BatchBuilder.CACHE_FOLDER, f"{BatchBuilder.BATCH_FILE}-{timestamp}.csv")
@@ -149,10 +303,54 @@ class BatchBuilder:
             print("No valid imports to archive.")
 
     @staticmethod
-    def get_next_line(list_completed_states_to_select=None):
+    def get_batch_store():
+        """
+        Returns the BatchStore holding the states of the active batch. The store is (re)loaded from batch.csv when it
+        does not exist yet, or when the csv file was edited after the last export.
+        """
+        if BatchBuilder._batch_store is None:
+            BatchBuilder._batch_store = BatchStore(BatchBuilder.get_batch_db_path(), BatchBuilder.BATCH_HEADER,
+                                                    token_counter=BatchPlanner.count_tokens)
+        store = BatchBuilder._batch_store
+        batch_file_path = BatchBuilder.get_batch_file_path()
+        if BatchBuilder._csv_sync and store.is_csv_modified(batch_file_path):
+            print(f"Loading batch states from {batch_file_path}")
+            store.import_csv(batch_file_path)
+        return store
+
+    @staticmethod
+    def disable_csv_sync():
+        """
+        Stop importing/exporting batch.csv in this process. Used by the batch workers, so only the process that owns
+        the workers reads and writes the csv file.
+        """
+        BatchBuilder._csv_sync = False
+
+    @staticmethod
+    def export_batch():
+        """
+        Write the states kept by the batch store back to batch.csv.
+        """
+        if BatchBuilder._batch_store is not None and BatchBuilder._csv_sync:
+            BatchBuilder._batch_store.export_csv(BatchBuilder.get_batch_file_path())
+        BatchBuilder._pending_updates = 0
+
+    @staticmethod
+    def close_batch_store():
+        """
+        Export the batch store to batch.csv and close it.
+        """
+        if BatchBuilder._batch_store is not None:
+            BatchBuilder.export_batch()
+            BatchBuilder._batch_store.close()
+            BatchBuilder._batch_store = None
+
+    @staticmethod
+    def get_next_line(list_completed_states_to_select=None, prefer_voice=None):
         """
-        Search the batch.csv from the top to bottom for a line with the column "completed" with the values passed
+        Search the batch from the top to bottom for a line with the column "completed" with the values passed
         as arguments. Default is STATE_COMPLETED_FALSE. It is case insensitive.
+        Lines with the voice prefer_voice are selected first, so the batch is processed grouped by voice.
         Returns a dict with key equals to the column names.
         Returns None if no line with the provided state exists.
         """
@@ -161,56 +359,135 @@ class BatchBuilder:
 
         list_completed_states_to_select = [state.lower() for state in list_completed_states_to_select]
 
-        batch_file_path = BatchBuilder.get_batch_file_path()
-
         try:
-            df = pd.read_csv(batch_file_path, sep=';', dtype=str)
-            # Rename the '# id' column to 'id'
-            df.rename(columns={'# id': 'id'}, inplace=True)
+            store = BatchBuilder.get_batch_store()
         except Exception as e:
-            print(f"Error reading {batch_file_path}: {e}")
+            print(f"Error reading {BatchBuilder.get_batch_file_path()}: {e}")
             return None
 
-        for i, row in df.iterrows():
-            if row['completed'].strip().lower() in list_completed_states_to_select:
-                return row.to_dict()
-
-        return None
+        return store.next_line(list_completed_states_to_select, prefer_voice=prefer_voice)
 
     @staticmethod
-    def update_batch_line(line_id, new_completed_state: str):
+    def update_batch_line(line_id, new_completed_state: str, owner="", audio_seconds=0.0, synth_seconds=0.0):
         """
         Update line id to new_completed_state (lower case)
+        Completed and error states are also recorded for the batch metrics, with the seconds of audio synthesized for
+        the line and the wall time spent synthesizing it.
         """
-        batch_file_path = BatchBuilder.get_batch_file_path()
-
         try:
-            df = pd.read_csv(batch_file_path, sep=';', dtype=str)
-            # Rename the '# id' column to 'id'
-            df.rename(columns={'# id': 'id'}, inplace=True)
+            store = BatchBuilder.get_batch_store()
         except Exception as e:
-            print(f"Error reading {batch_file_path}: {e}")
-            return False
-
-        if 'id' not in df.columns or 'completed' not in df.columns:
-            print("Required columns 'id' and 'completed' are not in the CSV file.")
+            print(f"Error reading {BatchBuilder.get_batch_file_path()}: {e}")
             return False
 
         line_id = str(line_id).strip()
         new_completed_state = new_completed_state.lower().strip()
 
-        if line_id not in df['id'].values:
+        if not store.update_state(line_id, new_completed_state):
             print(f"Line id {line_id} not found in the batch.")
             return False
+        if new_completed_state in [STATE_COMPLETED_TRUE, STATE_COMPLETED_ERROR]:
+            store.record_line(line_id, new_completed_state, owner, audio_seconds, synth_seconds)
 
-        df.loc[df['id'] == line_id, 'completed'] = new_completed_state
+        BatchBuilder._pending_updates += 1
+        if BatchBuilder._csv_sync and BatchBuilder._pending_updates >= BatchBuilder.BATCH_EXPORT_INTERVAL:
+            try:
+                BatchBuilder.export_batch()
+            except Exception as e:
+                print(f"Error saving {BatchBuilder.get_batch_file_path()}: {e}")
+        return True
 
+    @staticmethod
+    def claim_next_line(owner, prefer_voice=None):
+        """
+        Select the next line to synthesize and mark it as ongoing, leased to owner. Not started lines are selected, as
+        well as ongoing lines whose lease expired (left behind by a crashed worker). Lines with the voice prefer_voice
+        are selected first. Returns a dict with key equals to the column names, or None if there is nothing left.
+        """
         try:
-            df.to_csv(batch_file_path, sep=';', index=False)
-            return True
+            store = BatchBuilder.get_batch_store()
         except Exception as e:
-            print(f"Error saving {batch_file_path}: {e}")
-            return False
+            print(f"Error reading {BatchBuilder.get_batch_file_path()}: {e}")
+            return None
+        return store.claim_next(owner, BatchBuilder.LEASE_SECONDS, prefer_voice=prefer_voice)
+
+    @staticmethod
+    def claim_next_group(owner, planner, prefer_voice=None):
+        """
+        Select the next group of lines planned by planner (a BatchPlanner) and mark them as ongoing, leased to owner.
+        The group starts with the line claim_next_line() would select, followed by the next lines with its voice, emotion
+        and length bucket. Returns a list of dicts with key equals to the column names, empty if there is nothing left.
+        """
+        try:
+            store = BatchBuilder.get_batch_store()
+        except Exception as e:
+            print(f"Error reading {BatchBuilder.get_batch_file_path()}: {e}")
+            return []
+        group = store.claim_group(owner, BatchBuilder.LEASE_SECONDS, planner.bucket_range, planner.max_group_size,
+                                  prefer_voice=prefer_voice)
+        planner.account(group)
+        return group
+
+    @staticmethod
+    def get_pending_lines():
+        """
+        Lines that are still to be synthesized, as dicts with the batch columns: the claimable lines of the active
+        batch or, if no batch was created yet, the lines the active import would create, without creating the batch.
+        """
+        if BatchBuilder.is_batch_active():
+            return BatchBuilder.get_claimable_lines()
+        if not BatchBuilder.is_import_active():
+            return []
+        df = pd.read_csv(BatchBuilder.get_import_file_path(), sep=BatchBuilder.CSV_SEP, dtype=str, header=0,
+                         index_col=False)
+        return [dict(zip(BatchBuilder.BATCH_HEADER, line))
+                for line in BatchBuilder._build_batch_lines(df, check_voice_samples=False)]
+
+    @staticmethod
+    def get_claimable_lines():
+        """
+        Lines that are still to be synthesized: not started lines and ongoing lines with an expired lease.
+        """
+        return BatchBuilder.get_batch_store().claimable_lines()
+
+    @staticmethod
+    def start_lease_heartbeat(owner):
+        """
+        Start a thread renewing the leases of owner. Call stop() on the returned object to terminate it.
+        """
+        heartbeat = LeaseHeartbeat(BatchBuilder.get_batch_db_path(), BatchBuilder.BATCH_HEADER, owner,
+                                   BatchBuilder.LEASE_SECONDS, BatchBuilder.LEASE_HEARTBEAT_SECONDS)
+        heartbeat.start()
+        return heartbeat
+
+    @staticmethod
+    def start_metrics_exporter(port=None):
+        """
+        Start a thread rewriting the batch metrics file, and serving the metrics on port if given. Call stop() on the
+        returned object to terminate it.
+        """
+        exporter = MetricsExporter(BatchBuilder.get_batch_db_path(), BatchBuilder.BATCH_HEADER,
+                                   BatchBuilder.get_batch_metrics_path(), BatchBuilder.METRICS_EXPORT_SECONDS, port=port)
+        exporter.start()
+        return exporter
+
+    @staticmethod
+    def release_leases(owner):
+        """
+        Give back the ongoing lines of owner to the batch, so they can be claimed again immediately.
+        """
+        if BatchBuilder._batch_store is not None:
+            BatchBuilder._batch_store.release_leases(owner)
+
+    @staticmethod
+    def get_fanout_paths(entry):
+        """
+        Output paths that must receive a copy of the audios synthesized for a batch line.
+        """
+        fanout = entry.get('fanout', "")
+        if fanout is None or fanout.strip() == "":
+            return []
+        return fanout.split(BatchBuilder.FANOUT_SEP)
 
     #####################################################
 
@@ -220,54 +497,96 @@ class BatchBuilder:
         Import all the dialogs from skyrim root directories, and transform it in a pandas Dataframe, to be used to
         create the batches.
         """
-        list_dialogs = []
+        return BatchBuilder._parse_dialogues(BatchBuilder._list_dialog_files(skyrim_root))
+
+    @staticmethod
+    def _list_dialog_files(skyrim_root):
         dialog_pattern = os.path.join(skyrim_root,
                                       f"{BatchBuilder.SKYRIM_EXPORT_DIALOG_PREFIX}*{BatchBuilder.SKYRIM_EXPORT_SUFFIX}")
-        list_dialogs = glob.glob(dialog_pattern)
         # list_scenes = []
         # scene_pattern = os.path.join(skyrim_root,
         #                             f"{BatchBuilder.SKYRIM_EXPORT_SCENE_PREFIX}*{BatchBuilder.SKYRIM_EXPORT_SUFFIX}")
         # list_scenes = glob.glob(scene_pattern)
-        return BatchBuilder._parse_dialogues(list_dialogs)
+        return sorted(glob.glob(dialog_pattern))
 
     @staticmethod
     def _parse_dialogues(list_dialogs):
-        loaded_data = []
-        for dialog_file in list_dialogs:
-            try:
-                # df = pd.read_csv(dialog_file, sep='\t', dtype=str, header=0, index_col=False)
-                print(f"Loading file {dialog_file}")
-                df = BatchBuilder._load_dataframe_helper(dialog_file)
-            except Exception as e:
-                print(f"Error reading {dialog_file}: {e}")
-                traceback.print_exc()
-                continue
-
-            for i, row in df.iterrows():
-                # Extract and trim the required values
-                quest = row['QUEST'].strip() if pd.notna(row['QUEST']) else BatchBuilder.EMPTY_VALUE_STR
-                voice_type = row['VOICE TYPE'].strip() if pd.notna(row['VOICE TYPE']) else BatchBuilder.EMPTY_VALUE_STR
-                emotion_full = row['EMOTION'].strip() if pd.notna(row['EMOTION']) else f"{BatchBuilder.EMPTY_VALUE_STR} {BatchBuilder.EMPTY_VALUE_INT}"
-                emotion, intensity = emotion_full.split(' ')
-                text = row['RESPONSE TEXT'].strip().replace(BatchBuilder.CSV_SEP, ",").replace('"', "'")  if pd.notna(row['RESPONSE TEXT']) else BatchBuilder.EMPTY_VALUE_STR
-                file = row['FILENAME'].strip() if pd.notna(row['FILENAME']) else BatchBuilder.EMPTY_VALUE_STR
-                filepath = row['FULL PATH'].strip() if pd.notna(row['FULL PATH']) else BatchBuilder.EMPTY_VALUE_STR
-                source = os.path.basename(dialog_file)
-
-                # Check for empty values and log the error
-                for col, value in zip(BatchBuilder.INPUT_COLUMNS[:-1], [quest, voice_type, emotion, intensity, text, file, filepath]):
-                    if value == BatchBuilder.EMPTY_VALUE_STR:
-                        print(f"WARNING: Cannot recover value '{col}' at line {i + 1} in file {source}. This information might be missing from source file.")
+        """
+        Parse the dialogueExport*.txt files, in parallel when there is more than one, and concatenate them in the
+        order of list_dialogs.
+        """
+        return BatchBuilder._concat_dialogues(BatchBuilder._parse_dialogue_files(list_dialogs))
 
-                loaded_data.append([quest, voice_type, emotion, intensity, text, file, filepath, source])
+    @staticmethod
+    def _parse_dialogue_files(list_dialogs):
+        """
+        Parse the dialogueExport*.txt files, in parallel when there is more than one. Returns a list of Dataframes
+        aligned with list_dialogs, with None for the files that could not be parsed.
+        """
+        if len(list_dialogs) > 1:
+            max_workers = min(len(list_dialogs), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(BatchBuilder._parse_dialogue_file, list_dialogs))
+        return [BatchBuilder._parse_dialogue_file(dialog_file) for dialog_file in list_dialogs]
 
-        # Convert the loaded data into a DataFrame
-        loaded_df = pd.DataFrame(loaded_data, columns=BatchBuilder.INPUT_COLUMNS)
+    @staticmethod
+    def _concat_dialogues(loaded_dfs):
+        loaded_dfs = [df for df in loaded_dfs if df is not None]
+        if len(loaded_dfs) == 0:
+            return pd.DataFrame(columns=BatchBuilder.INPUT_COLUMNS)
+        loaded_df = pd.concat(loaded_dfs, ignore_index=True)
 
         # Save the DataFrame to a CSV file, just for debug
         # loaded_df.to_csv('load_test.csv', sep=BatchBuilder.CSV_SEP, index=False)
         return loaded_df
 
+    @staticmethod
+    def _parse_dialogue_file(dialog_file):
+        """
+        Parse a single dialogueExport*.txt file into a Dataframe with the INPUT_COLUMNS. Returns None if the file
+        cannot be parsed.
+        """
+        try:
+            # df = pd.read_csv(dialog_file, sep='\t', dtype=str, header=0, index_col=False)
+            print(f"Loading file {dialog_file}")
+            df = BatchBuilder._load_dataframe_helper(dialog_file)
+            source = os.path.basename(dialog_file)
+
+            def column(name, default=BatchBuilder.EMPTY_VALUE_STR):
+                return df[name].str.strip().fillna(default)
+
+            # Extract and trim the required values
+            emotion_full = column('EMOTION', f"{BatchBuilder.EMPTY_VALUE_STR} {BatchBuilder.EMPTY_VALUE_INT}")
+            emotion_parts = emotion_full.str.split(' ')
+            invalid_emotions = emotion_parts.str.len() != 2
+            if invalid_emotions.any():
+                i = invalid_emotions.idxmax()
+                raise ValueError(f"Invalid EMOTION value '{emotion_full[i]}' at line {i + 1}")
+            text = df['RESPONSE TEXT'].str.strip().str.replace(BatchBuilder.CSV_SEP, ",", regex=False)\
+                .str.replace('"', "'", regex=False).fillna(BatchBuilder.EMPTY_VALUE_STR)
+
+            loaded_df = pd.DataFrame({
+                'quest': column('QUEST'),
+                'voice_type': column('VOICE TYPE'),
+                'emotion': emotion_parts.str[0],
+                'intensity': emotion_parts.str[1],
+                'text': text,
+                'file': column('FILENAME'),
+                'filepath': column('FULL PATH'),
+                'source': source,
+            }, columns=BatchBuilder.INPUT_COLUMNS)
+        except Exception as e:
+            print(f"Error reading {dialog_file}: {e}")
+            traceback.print_exc()
+            return None
+
+        # Check for empty values and log the error
+        for col in BatchBuilder.INPUT_COLUMNS[:-1]:
+            for i in loaded_df.index[loaded_df[col] == BatchBuilder.EMPTY_VALUE_STR]:
+                print(f"WARNING: Cannot recover value '{col}' at line {i + 1} in file {source}. This information might be missing from source file.")
+
+        return loaded_df
+
     @staticmethod
     def _initialize():
         # Create the output directory if it doesn't exist
@@ -279,7 +598,33 @@ class BatchBuilder:
         """
         The purpose of this method is create a batch.csv file responsible to manage the batches of audios to generate.
         """
+        batch_data = BatchBuilder._build_batch_lines(df, check_voice_samples)
+
+        # Create batch.csv with headers, the states of a previous batch store are discarded
+        BatchBuilder.close_batch_store()
+        BatchBuilder._remove_batch_db()
+        batch_file_path = BatchBuilder.get_batch_file_path()
+        os.makedirs(os.path.dirname(batch_file_path), exist_ok=True)
+        with open(batch_file_path, 'w') as batch_file:
+            batch_file.write("# " + BatchBuilder.CSV_SEP.join(BatchBuilder.BATCH_HEADER) + "\n")
+            for line in batch_data:
+                batch_file.write(BatchBuilder.CSV_SEP.join(line) + "\n")
+        # build the store right away, so the texts are tokenized now rather than when the batch is run
+        BatchBuilder.get_batch_store()
+        BatchBuilder.close_batch_store()
+        print(f"Batch file created at {batch_file_path}")
+        return batch_file_path
+
+    @staticmethod
+    def _build_batch_lines(df, check_voice_samples=True):
+        """
+        Validate the rows of an import Dataframe and convert them to batch lines, with the columns of BATCH_HEADER.
+        Rows with the same voice, emotion and text (the synthesis settings depend only on these) are merged into a
+        single line, synthesized once, whose fanout column lists the output paths of the other rows.
+        """
         batch_data = []
+        # (voice, emotion, normalized text) -> index of the batch line in batch_data
+        unique_lines = {}
         for i, row in df.iterrows():
             # validate emotion values
             emotion = row['emotion'].strip().lower()
@@ -322,18 +667,45 @@ class BatchBuilder:
                 raise InvalidTextException(f"Line {i + 1}: quest must be a valid string: {quest_id}")
 
             mod_text = BatchBuilder._modify_text_with_emotion(text, emotion, intensity)
+            output_path = os.path.join(BatchBuilder.RESULTS_FOLDER, filepath)
+            key = (voice_type + emotion, emotion, BatchBuilder._normalize_text(mod_text))
+            if key in unique_lines:
+                batch_line = batch_data[unique_lines[key]]
+                if output_path != batch_line[6] and output_path not in batch_line[7]:
+                    batch_line[7].append(output_path)
+                continue
+            unique_lines[key] = len(batch_data)
             batch_line = [str(i), quest_id, STATE_COMPLETED_FALSE, voice_type + emotion, emotion, mod_text,
-                          os.path.join(BatchBuilder.RESULTS_FOLDER, filepath)]
+                          output_path, []]
             batch_data.append(batch_line)
 
-        # Create batch.csv with headers
-        batch_file_path = BatchBuilder.get_batch_file_path()
-        with open(batch_file_path, 'w') as batch_file:
-            batch_file.write("# " + BatchBuilder.CSV_SEP.join(BatchBuilder.BATCH_HEADER) + "\n")
-            for line in batch_data:
-                batch_file.write(BatchBuilder.CSV_SEP.join(line) + "\n")
-        print(f"Batch file created at {batch_file_path}")
-        return batch_file_path
+        fanout_count = 0
+        for batch_line in batch_data:
+            fanout_count += len(batch_line[7])
+            batch_line[7] = BatchBuilder.FANOUT_SEP.join(batch_line[7])
+        if fanout_count > 0:
+            print(f"{fanout_count} duplicated lines will be copied from {len(batch_data)} synthesized lines.")
+        return batch_data
+
+    @staticmethod
+    def _normalize_text(text):
+        # Tortoise lowercases the text and collapses the whitespace before tokenizing it
+        return " ".join(text.split()).lower()
+
+    @staticmethod
+    def _set_import_batched():
+        manifest_path = BatchBuilder.get_import_manifest_path()
+        if os.path.exists(manifest_path):
+            manifest = ImportManifest.load(manifest_path)
+            manifest.batched = True
+            manifest.save()
+
+    @staticmethod
+    def _remove_batch_db():
+        db_path = BatchBuilder.get_batch_db_path()
+        for path in [db_path, db_path + "-wal", db_path + "-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
 
     @staticmethod
     def _modify_text_with_emotion(text, emotion, intensity):
@@ -368,37 +740,11 @@ class BatchBuilder:
 
     @staticmethod
     def _load_dataframe_helper(dialog_file):
-        def replace_special_chars(text):
-            # Define replacements for common special characters
-            replacements = {
-                "…": "...",
-                "’": "'",
-                "‘": "'",
-                "“": "\"",
-                "”": "\"",
-                "–": "-",
-                "—": "-",
-                "•": "-",
-                "•": "-",
-                # Add any other replacements as needed
-            }
-
-            # Replace characters based on the replacements dictionary
-            for char, replacement in replacements.items():
-                text = text.replace(char, replacement)
-
-            # Remove any non-ASCII characters
-            text = re.sub(r'[^\x00-\x7F]+', '', text)
-
-            return text
-
-        # Read the content of the file and preprocess it in memory
+        # Read the content of the file and preprocess it in memory: replace the common special characters and remove
+        # any other non-ASCII character.
         with open(dialog_file, 'r', encoding='utf-8', errors='replace') as file:
-            lines = file.readlines()
-            processed_lines = [replace_special_chars(line) for line in lines]
-
-        # Join the processed lines and load into a DataFrame
-        processed_content = ''.join(processed_lines)
+            content = file.read()
+        processed_content = content.translate(BatchBuilder.SPECIAL_CHARS_TABLE).encode('ascii', 'ignore').decode('ascii')
 
         df = pd.read_csv(StringIO(processed_content), sep='\t', dtype=str, header=0, index_col=False)
 
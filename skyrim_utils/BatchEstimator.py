@@ -0,0 +1,132 @@
+from skyrim_utils.Settings import TtsSettings
+
+
+class BatchEstimator:
+    """
+    Predicts the compute time of the pending batch lines. A short micro-benchmark synthesizes a few calibration texts
+    on this machine, and the per stage timings reported by Tortoise (InferenceStats) are turned into a cost model:
+    autoregressive seconds per decoding step of a batch, CLVP seconds per sample, diffusion seconds per step and mel
+    code of a candidate, and so on. The cost of each line is then predicted from its text length (in tokens), its
+    number of candidates and the number of samples and diffusion iterations of the active preset.
+    The lines are costed one by one, so the prediction is an upper bound for the groups synthesized together.
+    """
+    CALIBRATION_TEXTS = [
+        "Hello there, traveler.",
+        "I used to be an adventurer like you, then I took an arrow in the knee. Now I guard the gates of Whiterun.",
+    ]
+    CALIBRATION_DIFFUSION_ITERATIONS = 10
+    MEL_CODES_PER_SECOND = 20
+    MAX_MEL_TOKENS = 500
+
+    def __init__(self, planner):
+        self.planner = planner
+        self.model = None
+
+    def calibrate(self, engine, voice):
+        """
+        Run the micro-benchmark with voice, using the preset selected by the last engine.configure() call, and fit
+        the cost model. Returns the model as a dict.
+        """
+        samples = []
+        # the first run warms up the models (memory allocation, kernel selection) and is not measured
+        texts = BatchEstimator.CALIBRATION_TEXTS[:1] + BatchEstimator.CALIBRATION_TEXTS
+        for i, text in enumerate(texts):
+            print(f"Calibrating with '{text}'...")
+            _, stats = engine.tts(text, conditioning_latents=engine.get_conditioning_latents(voice), k=1,
+                                  verbose=False, use_deterministic_seed=0,
+                                  num_autoregressive_samples=engine.autoregressive_batch_size(),
+                                  diffusion_iterations=BatchEstimator.CALIBRATION_DIFFUSION_ITERATIONS,
+                                  return_stats=True)
+            if i > 0:
+                samples.append(self._fit(text, stats))
+        self.model = {key: sum(sample[key] for sample in samples) / len(samples) for key in samples[0]}
+        return self.model
+
+    def estimate(self, lines, preset_settings):
+        """
+        Predict the cost of lines (dicts with the batch columns). preset_settings are the tortoise settings of the
+        active preset (num_autoregressive_samples, diffusion_iterations), the diffusion_iterations of the emotion presets
+        take precedence when they set one. Returns a dict with the number of lines, the
+        predicted seconds of each stage, the total seconds and the predicted seconds of audio.
+        """
+        model = self.model
+        num_samples = preset_settings['num_autoregressive_samples']
+        iterations = preset_settings['diffusion_iterations']
+        # settings only depend on the emotion for the lines with text
+        settings_cache = {}
+        result = {'lines': 0, 'empty_lines': 0, 'candidates': 0, 'audio_seconds': 0.0,
+                  'stages': {stage: 0.0 for stage in ['autoregressive', 'clvp', 'latents', 'diffusion', 'vocoder',
+                                                      'redaction']}}
+        for line in lines:
+            result['lines'] += 1
+            if str(line.get('text', '')).strip() == '':
+                result['empty_lines'] += 1
+                continue
+            if model is None:
+                raise RuntimeError("BatchEstimator.calibrate() must be called before estimating a batch.")
+            emotion = line.get('emotion', 'neutral')
+            if emotion not in settings_cache:
+                settings_cache[emotion] = TtsSettings.get_settings(line)
+            candidates = settings_cache[emotion]['candidates']
+            line_iterations = settings_cache[emotion]['model'].get('diffusion_iterations', iterations)
+            num_batches = max(1, num_samples // model['batch_size'])
+            codes = min(BatchEstimator.MAX_MEL_TOKENS,
+                        model['codes_per_text_token'] * (self.planner.token_count(line['text']) + 1))
+            stages = result['stages']
+            stages['autoregressive'] += num_batches * model['autoregressive_step'] * codes
+            stages['clvp'] += num_samples * model['clvp_sample']
+            stages['latents'] += candidates * model['latents_candidate']
+            stages['diffusion'] += candidates * line_iterations * codes * model['diffusion_step_code']
+            stages['vocoder'] += candidates * codes * model['vocoder_code']
+            stages['redaction'] += candidates * model['redaction_candidate']
+            result['candidates'] += candidates
+            result['audio_seconds'] += codes / BatchEstimator.MEL_CODES_PER_SECOND
+        result['total_seconds'] = sum(result['stages'].values())
+        return result
+
+    @staticmethod
+    def report(estimate, workers=1):
+        """
+        Print an estimate returned by estimate().
+        """
+        print(f"Batch estimate: {estimate['lines']} pending lines, {estimate['empty_lines']} of them with no text, "
+              f"{estimate['candidates']} candidates to synthesize.")
+        for stage, seconds in estimate['stages'].items():
+            print(f"  {stage}: {BatchEstimator._format_duration(seconds)}")
+        total = estimate['total_seconds']
+        print(f"  total: {BatchEstimator._format_duration(total)} of compute for about "
+              f"{BatchEstimator._format_duration(estimate['audio_seconds'])} of speech.")
+        if workers > 1:
+            print(f"  with {workers} workers: about {BatchEstimator._format_duration(total / workers)}, "
+                  f"if the machine has resources for all of them.")
+
+    #####################################################
+
+    def _fit(self, text, stats):
+        stages = stats.stages
+        autoregressive = stages['autoregressive']
+        # mel codes generated per sample, which is also the number of decoding steps of the batch
+        codes = max(1.0, autoregressive.tokens / max(1, autoregressive.items))
+        iterations = BatchEstimator.CALIBRATION_DIFFUSION_ITERATIONS
+        return {
+            'batch_size': autoregressive.items,
+            'codes_per_text_token': codes / (self.planner.token_count(text) + 1),
+            'autoregressive_step': autoregressive.wall_time / codes,
+            'clvp_sample': BatchEstimator._per_item(stages.get('clvp')),
+            'latents_candidate': BatchEstimator._per_item(stages.get('latents')),
+            'diffusion_step_code': BatchEstimator._per_item(stages.get('diffusion')) / (iterations * codes),
+            'vocoder_code': BatchEstimator._per_item(stages.get('vocoder')) / codes,
+            'redaction_candidate': BatchEstimator._per_item(stages.get('redaction')),
+        }
+
+    @staticmethod
+    def _per_item(stage):
+        if stage is None or stage.items == 0:
+            return 0.0
+        return stage.wall_time / stage.items
+
+    @staticmethod
+    def _format_duration(seconds):
+        hours, rest = divmod(int(seconds), 3600)
+        minutes, seconds = divmod(rest, 60)
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from skyrim_utils.BatchStore import BatchStore
+
+
+class BatchMetrics:
+    """
+    Running metrics of a batch, computed from the line states and the line results kept by the batch store, so the
+    lines synthesized by all the workers are accounted.
+    Rates (lines per hour, audio seconds per wall second, error rate, ETA) cover the lines finished since start_time,
+    the real time factors (synthesis seconds per audio second) cover all the synthesized lines of the batch.
+    """
+    PROMETHEUS_PREFIX = "tortoise4skyrim"
+
+    def __init__(self, start_time=None):
+        self.start_time = time.time() if start_time is None else start_time
+
+    def snapshot(self, state_counts, line_metrics, now=None):
+        """
+        Returns the metrics as a json serializable dict. state_counts and line_metrics are the results of
+        BatchStore.state_counts() and BatchStore.line_metrics().
+        """
+        now = time.time() if now is None else now
+        elapsed = max(now - self.start_time, 1e-9)
+        run = [line for line in line_metrics if line['finished'] >= self.start_time]
+        run_errors = sum(1 for line in run if line['state'] == BatchStore.STATE_ERROR)
+        run_audio = sum(line['audio_seconds'] for line in run)
+        lines_per_second = len(run) / elapsed
+        remaining = state_counts.get(BatchStore.STATE_FALSE, 0) + state_counts.get(BatchStore.STATE_ONGOING, 0)
+        eta = remaining / lines_per_second if lines_per_second > 0 else None
+        return {
+            'time': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            'started': datetime.fromtimestamp(self.start_time).isoformat(timespec='seconds'),
+            'elapsed_seconds': elapsed,
+            'lines': {state: count for state, count in sorted(state_counts.items())},
+            'lines_total': sum(state_counts.values()),
+            'lines_remaining': remaining,
+            'run_lines': len(run),
+            'run_errors': run_errors,
+            'run_audio_seconds': run_audio,
+            'lines_per_hour': lines_per_second * 3600,
+            'audio_seconds_per_second': run_audio / elapsed,
+            'error_rate': run_errors / len(run) if len(run) > 0 else 0.0,
+            'eta_seconds': eta,
+            'projected_completion': None if eta is None else
+            datetime.fromtimestamp(now + eta).isoformat(timespec='seconds'),
+            'voices': BatchMetrics._group_rtf(line_metrics, 'voice'),
+            'emotions': BatchMetrics._group_rtf(line_metrics, 'emotion'),
+        }
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        """
+        Render a snapshot in the Prometheus text exposition format.
+        """
+        prefix = BatchMetrics.PROMETHEUS_PREFIX
+        out = []
+
+        def metric(name, help_text, samples):
+            out.append(f"# HELP {prefix}_{name} {help_text}")
+            out.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_str = ",".join(f'{key}="{BatchMetrics._escape_label(val)}"' for key, val in labels.items())
+                out.append(f"{prefix}_{name}{{{label_str}}} {value}" if label_str else f"{prefix}_{name} {value}")
+
+        metric("lines", "Batch lines by completed state.",
+               [({'state': state}, count) for state, count in snapshot['lines'].items()])
+        metric("lines_remaining", "Batch lines still to be synthesized.", [({}, snapshot['lines_remaining'])])
+        metric("lines_per_hour", "Lines finished per hour in this run.", [({}, snapshot['lines_per_hour'])])
+        metric("audio_seconds_per_second", "Seconds of audio synthesized per wall second in this run.",
+               [({}, snapshot['audio_seconds_per_second'])])
+        metric("error_rate", "Fraction of the lines finished in this run that failed.", [({}, snapshot['error_rate'])])
+        metric("eta_seconds", "Projected seconds until the batch is completed.", [({}, snapshot['eta_seconds'])])
+        for group, label in (('voices', 'voice'), ('emotions', 'emotion')):
+            stats = snapshot[group]
+            metric(f"{label}_lines", f"Synthesized lines per {label}.",
+                   [({label: key}, value['lines']) for key, value in stats.items()])
+            metric(f"{label}_audio_seconds", f"Seconds of audio synthesized per {label}.",
+                   [({label: key}, value['audio_seconds']) for key, value in stats.items()])
+            metric(f"{label}_rtf", f"Synthesis seconds per second of audio, per {label}.",
+                   [({label: key}, value['rtf']) for key, value in stats.items()])
+        return "\n".join(out) + "\n"
+
+    #####################################################
+
+    @staticmethod
+    def _group_rtf(line_metrics, key):
+        groups = {}
+        for line in line_metrics:
+            if line['audio_seconds'] <= 0:
+                # errors and cache hits
+                continue
+            group = groups.setdefault(line[key], {'lines': 0, 'audio_seconds': 0.0, 'synth_seconds': 0.0})
+            group['lines'] += 1
+            group['audio_seconds'] += line['audio_seconds']
+            group['synth_seconds'] += line['synth_seconds']
+        for group in groups.values():
+            group['rtf'] = group['synth_seconds'] / group['audio_seconds']
+        return dict(sorted(groups.items()))
+
+    @staticmethod
+    def _escape_label(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Background thread rewriting the batch metrics to a json file every interval seconds, and optionally serving them
+    in the Prometheus text format on http://127.0.0.1:<port>/metrics.
+    It uses its own connection, since sqlite connections cannot be shared between threads.
+    """
+    def __init__(self, db_path, columns, json_path, interval, port=None):
+        super().__init__(name="metrics-exporter", daemon=True)
+        self.db_path = db_path
+        self.columns = columns
+        self.json_path = json_path
+        self.interval = interval
+        self.port = port
+        self.metrics = BatchMetrics()
+        self._stop_event = threading.Event()
+        self._snapshot = None
+        self._server = None
+
+    def run(self):
+        store = BatchStore(self.db_path, self.columns)
+        try:
+            if self.port is not None:
+                self._start_server()
+            while True:
+                self._export(store)
+                if self._stop_event.wait(self.interval):
+                    break
+            # final values, including the lines finished since the last export
+            self._export(store)
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            store.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    #####################################################
+
+    def _export(self, store):
+        try:
+            snapshot = self.metrics.snapshot(store.state_counts(), store.line_metrics())
+            self._snapshot = snapshot
+            tmp_path = f"{self.json_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as metrics_file:
+                json.dump(snapshot, metrics_file, indent=2)
+            os.replace(tmp_path, self.json_path)
+        except Exception as e:
+            print(f"WARNING: Cannot export the batch metrics: {e}")
+
+    def _start_server(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics" or exporter._snapshot is None:
+                    self.send_error(404)
+                    return
+                body = BatchMetrics.to_prometheus(exporter._snapshot).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # keep the scrapes out of the console
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        except OSError as e:
+            print(f"WARNING: Cannot serve the batch metrics on port {self.port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"Batch metrics available at http://127.0.0.1:{self.port}/metrics")
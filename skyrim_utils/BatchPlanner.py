@@ -0,0 +1,112 @@
+import bisect
+from tortoise.utils.tokenizer import VoiceBpeTokenizer
+
+
+class BatchPlanner:
+    """
+    Groups the batch lines that are synthesized together. The text of every line is tokenized with the Tortoise
+    tokenizer, and the lines are grouped by voice, emotion and token length bucket, so a group shares the voice
+    latents and the synthesis settings (which depend on the emotion), and the padding added to the shorter texts of the group stays small.
+    The batch store keeps the token count of every line (see count_tokens()), so the next group is selected in SQL
+    from the token range of a bucket (see bucket_range()) rather than by tokenizing the pending lines.
+    The planner keeps count of the padded tokens of the claimed groups, to report the padding waste.
+    """
+    _tokenizer = None
+
+    def __init__(self, bucket_boundaries, max_group_size):
+        self.bucket_boundaries = sorted(bucket_boundaries)
+        self.max_group_size = max(1, max_group_size)
+        # text -> number of tokens
+        self._token_counts = {}
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def token_count(self, text):
+        count = self._token_counts.get(text)
+        if count is None:
+            count = BatchPlanner.count_tokens(text)
+            self._token_counts[text] = count
+        return count
+
+    @staticmethod
+    def count_tokens(text):
+        """
+        Number of Tortoise tokens of a text, without caching. Used by the batch store to keep the token count of the
+        lines when they are added to the batch.
+        """
+        if BatchPlanner._tokenizer is None:
+            BatchPlanner._tokenizer = VoiceBpeTokenizer()
+        return len(BatchPlanner._tokenizer.encode(text))
+
+    def bucket(self, text):
+        """
+        Index of the length bucket of a text. Texts longer than the last boundary get a bucket of their own.
+        """
+        return bisect.bisect_left(self.bucket_boundaries, self.token_count(text))
+
+    def bucket_range(self, token_count):
+        """
+        Token counts (lower, upper), both included, of the bucket of a line with token_count tokens. upper is None for
+        the last bucket.
+        """
+        bucket = bisect.bisect_left(self.bucket_boundaries, token_count)
+        lower = self.bucket_boundaries[bucket - 1] + 1 if bucket > 0 else 0
+        upper = self.bucket_boundaries[bucket] if bucket < len(self.bucket_boundaries) else None
+        return lower, upper
+
+    def plan(self, lines, use_buckets=True):
+        """
+        Split lines (dicts with the batch columns, in batch order) in groups of at most max_group_size lines with the
+        same voice, emotion and bucket. Returns the list of groups, each one a list of lines.
+        """
+        buckets = {}
+        for line in lines:
+            bucket = self.bucket(line['text']) if use_buckets else 0
+            buckets.setdefault((line['voice'], line['emotion'], bucket), []).append(line)
+        groups = []
+        for bucket_lines in buckets.values():
+            for start in range(0, len(bucket_lines), self.max_group_size):
+                groups.append(bucket_lines[start:start + self.max_group_size])
+        return groups
+
+    def padding_waste(self, groups=None):
+        """
+        Fraction of the text tokens of the groups that are padding. Uses the groups passed to account() if groups is
+        None.
+        """
+        if groups is None:
+            real, padded = self.real_tokens, self.padded_tokens
+        else:
+            real, padded = 0, 0
+            for group in groups:
+                counts = [self.token_count(line['text']) for line in group]
+                real += sum(counts)
+                padded += max(counts) * len(counts)
+        return 0.0 if padded == 0 else 1.0 - real / padded
+
+    def report(self, lines):
+        """
+        Print the number of lines per bucket and the padding waste of planning lines with and without the buckets.
+        """
+        groups = self.plan(lines)
+        counts = {}
+        for group in groups:
+            bucket = self.bucket(group[0]['text'])
+            counts[bucket] = counts.get(bucket, 0) + len(group)
+        print(f"Batch plan: {len(lines)} lines in {len(groups)} groups of up to {self.max_group_size} lines.")
+        for bucket in sorted(counts):
+            lower = self.bucket_boundaries[bucket - 1] + 1 if bucket > 0 else 0
+            upper = self.bucket_boundaries[bucket] if bucket < len(self.bucket_boundaries) else "..."
+            print(f"  {lower}-{upper} tokens: {counts[bucket]} lines")
+        print(f"  padding waste: {self.padding_waste(groups) * 100:.1f}% "
+              f"({self.padding_waste(self.plan(lines, use_buckets=False)) * 100:.1f}% without length buckets)")
+
+    def account(self, group):
+        """
+        Count the real and padded tokens of a claimed group, for padding_waste().
+        """
+        if len(group) == 0:
+            return
+        counts = [self.token_count(line['text']) for line in group]
+        self.real_tokens += sum(counts)
+        self.padded_tokens += max(counts) * len(counts)
@@ -0,0 +1,463 @@
+import os
+import time
+import sqlite3
+import threading
+import pandas as pd
+
+
+class BatchStore:
+    """
+    Indexed state store for the batch lines, kept in a SQLite database next to batch.csv.
+    The CSV file is still the human-editable view of the batch: it is imported when the database does not exist or
+    when the file was changed after the last export, and it is rewritten from the database by export_csv(). The CSV is
+    only exported from time to time, so an import merges the edits of the file into the store rather than replacing
+    it: the states changed since the last export are kept unless the state was edited in the file.
+    Every state change is a single committed transaction, so an interrupted run never loses or corrupts the batch.
+    Several processes can share the same store: lines are claimed with a lease that the owner must renew, and the
+    ongoing lines of an owner that stopped renewing its leases are claimed again by the others.
+    The store keeps the token count of the text of every line, computed by token_counter (a function of the text) when
+    the line is added, so groups of lines of similar length are claimed with indexed queries.
+    """
+    TABLE = "batch"
+    CSV_SEP = ";"
+    META_CSV_MTIME = "csv_mtime"
+    STATE_FALSE = "false"
+    STATE_ONGOING = "ongoing"
+    STATE_ERROR = "error"
+
+    def __init__(self, db_path, columns, token_counter=None):
+        self.db_path = db_path
+        self.columns = list(columns)
+        self.token_counter = token_counter
+        db_dir = os.path.dirname(db_path)
+        if db_dir != "":
+            os.makedirs(db_dir, exist_ok=True)
+        # autocommit mode, transactions are opened explicitly where more than one statement is involved.
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._create_schema()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def count(self):
+        return self._conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def is_csv_modified(self, csv_path):
+        """
+        True if the CSV file was changed (or never imported) since the last import/export.
+        """
+        if not os.path.exists(csv_path):
+            return False
+        return self._get_meta(BatchStore.META_CSV_MTIME) != repr(os.path.getmtime(csv_path))
+
+    def import_csv(self, csv_path):
+        """
+        Merge the lines of the CSV file into the store. An empty store gets the lines in the file order.
+        Otherwise, for the lines already in the store, the columns are updated from the file, except the completed
+        state: it only replaces the state of the store (and its lease) when it differs from the state last exported to
+        the file, i.e. when the user edited it. Lines deleted from the file are deleted, and lines added to the file are
+        appended in the file order. The lines appended to the store after the last export are kept.
+        """
+        df = pd.read_csv(csv_path, sep=BatchStore.CSV_SEP, dtype=str, keep_default_na=False, index_col=False)
+        df.columns = [col.strip() for col in df.columns]
+        df.rename(columns={'# id': 'id'}, inplace=True)
+        for col in self.columns:
+            if col not in df.columns:
+                df[col] = ""
+        df['completed'] = df['completed'].str.strip().str.lower()
+        rows = [dict(zip(self.columns, row)) for row in df[self.columns].itertuples(index=False, name=None)]
+        # the texts are tokenized before taking the write lock, reusing the counts of the texts already in the store
+        token_counts = self._token_counts([line['text'] for line in rows])
+
+        placeholders = ", ".join(["?"] * (len(self.columns) + 2))
+        insert = (f"INSERT INTO {self.TABLE} ({self._column_list()}, csv_completed, token_count) "
+                  f"VALUES ({placeholders})")
+        with self._transaction():
+            # id -> (completed, csv_completed) of the lines in the store
+            existing = {row[0]: (row[1], row[2]) for row in
+                        self._conn.execute(f"SELECT id, completed, csv_completed FROM {self.TABLE}")}
+            inserts, updates, edited_states = [], [], []
+            for line, token_count in zip(rows, token_counts):
+                current = existing.get(line['id'])
+                if current is None:
+                    inserts.append([line[col] for col in self.columns] + [line['completed'], token_count])
+                    continue
+                completed, csv_completed = current
+                if line['completed'] != csv_completed:
+                    edited_states.append((line['completed'], line['id']))
+                else:
+                    line['completed'] = completed
+                updates.append([line[col] for col in self.columns if col != 'id'] +
+                               [csv_completed, token_count, line['id']])
+            csv_ids = set(line['id'] for line in rows)
+            # lines with an exported state were in the file, lines without one were appended after the export
+            deletes = [(line_id,) for line_id, (_, csv_completed) in existing.items()
+                       if line_id not in csv_ids and csv_completed != '']
+            assignments = ", ".join(f"{col} = ?" for col in self.columns if col != 'id')
+            self._conn.executemany(f"UPDATE {self.TABLE} SET {assignments}, csv_completed = ?, token_count = ? "
+                                   f"WHERE id = ?", updates)
+            self._conn.executemany(f"UPDATE {self.TABLE} SET completed = ?, csv_completed = completed, lease_owner = '', "
+                                   f"lease_expires = 0 WHERE id = ?", edited_states)
+            self._conn.executemany(f"DELETE FROM {self.TABLE} WHERE id = ?", deletes)
+            self._conn.executemany(insert, inserts)
+            self._set_meta(BatchStore.META_CSV_MTIME, repr(os.path.getmtime(csv_path)))
+
+    def export_csv(self, csv_path):
+        """
+        Rewrite the CSV file from the store. The file is replaced atomically, so a crash while exporting leaves the
+        previous version in place.
+        """
+        tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+        # the exported states are remembered in the same transaction, so import_csv() can tell the edited ones
+        with self._transaction():
+            self._conn.execute(f"UPDATE {self.TABLE} SET csv_completed = completed")
+            with open(tmp_path, 'w') as batch_file:
+                batch_file.write("# " + BatchStore.CSV_SEP.join(self.columns) + "\n")
+                for row in self._conn.execute(f"SELECT {self._column_list()} FROM {self.TABLE} ORDER BY seq"):
+                    batch_file.write(BatchStore.CSV_SEP.join(str(value) for value in row) + "\n")
+            os.replace(tmp_path, csv_path)
+            self._set_meta(BatchStore.META_CSV_MTIME, repr(os.path.getmtime(csv_path)))
+
+    def append_lines(self, lines, fanout_sep="|"):
+        """
+        Append lines (lists with the store columns) at the end of the batch, with new ids following the largest one.
+        The output paths of the new lines (output_path and the fanout paths, separated by fanout_sep) are split out of
+        the lines already in the store, so an outdated line never writes its audio there: they are removed from the
+        fanout of the other lines, and not started lines with one of them as output_path are dropped, or take the
+        first of their remaining fanout paths as output_path. Returns the number of appended lines.
+        """
+        id_index = self.columns.index('id')
+        token_counts = self._token_counts([line[self.columns.index('text')] for line in lines])
+        placeholders = ", ".join(["?"] * (len(self.columns) + 1))
+        with self._transaction():
+            next_id = self._conn.execute(f"SELECT COALESCE(MAX(CAST(id AS INTEGER)), -1) + 1 "
+                                         f"FROM {self.TABLE}").fetchone()[0]
+            rows = []
+            for line in lines:
+                row = list(line)
+                row[id_index] = str(next_id)
+                next_id += 1
+                rows.append(row)
+            if 'output_path' in self.columns:
+                self._split_output_paths(rows, fanout_sep)
+            self._conn.executemany(f"INSERT INTO {self.TABLE} ({self._column_list()}, token_count) "
+                                   f"VALUES ({placeholders})",
+                                   [row + [token_count] for row, token_count in zip(rows, token_counts)])
+        return len(rows)
+
+    def next_line(self, states, prefer_voice=None):
+        """
+        Returns the first line, in file order, whose completed state is one of states, or None.
+        If prefer_voice is given, the lines of that voice are returned first, so consecutive entries share the same
+        voice as long as there is work left for it.
+        """
+        placeholders = ", ".join(["?"] * len(states))
+        row = None
+        if prefer_voice is not None:
+            row = self._conn.execute(f"SELECT {self._column_list()} FROM {self.TABLE} "
+                                     f"WHERE completed IN ({placeholders}) AND voice = ? ORDER BY seq LIMIT 1",
+                                     list(states) + [prefer_voice]).fetchone()
+        if row is None:
+            row = self._conn.execute(f"SELECT {self._column_list()} FROM {self.TABLE} "
+                                     f"WHERE completed IN ({placeholders}) ORDER BY seq LIMIT 1", list(states)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update_state(self, line_id, new_completed_state):
+        """
+        Set the completed state of a line. Returns False if the line does not exist.
+        """
+        cursor = self._conn.execute(f"UPDATE {self.TABLE} SET completed = ?, lease_owner = '', lease_expires = 0 "
+                                    f"WHERE id = ?", (new_completed_state, str(line_id)))
+        return cursor.rowcount > 0
+
+    def record_line(self, line_id, state, owner="", audio_seconds=0.0, synth_seconds=0.0):
+        """
+        Keep the result of a finished line for the batch metrics: its final state, the seconds of audio synthesized and
+        the wall time spent synthesizing them.
+        """
+        self._conn.execute("INSERT INTO line_metrics (line_id, owner, state, audio_seconds, synth_seconds, finished) "
+                           "VALUES (?, ?, ?, ?, ?, ?)",
+                           (str(line_id), owner, state, audio_seconds, synth_seconds, time.time()))
+
+    def state_counts(self):
+        """
+        Number of lines of each completed state, as a dict.
+        """
+        return {row[0]: row[1] for row in
+                self._conn.execute(f"SELECT completed, COUNT(*) FROM {self.TABLE} GROUP BY completed")}
+
+    def line_metrics(self):
+        """
+        Results kept by record_line(), with the voice and emotion of their lines, as a list of dicts.
+        """
+        rows = self._conn.execute(f"SELECT m.line_id, m.owner, m.state, m.audio_seconds, m.synth_seconds, m.finished, "
+                                  f"COALESCE(b.voice, '') AS voice, COALESCE(b.emotion, '') AS emotion "
+                                  f"FROM line_metrics m LEFT JOIN {self.TABLE} b ON b.id = m.line_id "
+                                  f"ORDER BY m.finished").fetchall()
+        return [dict(row) for row in rows]
+
+    def claim_next(self, owner, lease_seconds, prefer_voice=None):
+        """
+        Atomically select the next line to synthesize and mark it as ongoing, leased to owner for lease_seconds.
+        Candidates are the not started lines, and the ongoing lines whose lease has expired (their owner crashed or
+        was killed). Lines of prefer_voice are selected first. Returns the line as a dict, or None.
+        """
+        with self._transaction():
+            now = time.time()
+            row = None
+            if prefer_voice is not None:
+                row = self._first_claimable(now, prefer_voice)
+            if row is None:
+                row = self._first_claimable(now)
+            if row is None:
+                return None
+            self._conn.execute(f"UPDATE {self.TABLE} SET completed = ?, lease_owner = ?, lease_expires = ? WHERE id = ?",
+                               (BatchStore.STATE_ONGOING, owner, now + lease_seconds, row['id']))
+        del row['token_count']
+        row['completed'] = BatchStore.STATE_ONGOING
+        return row
+
+    def claim_group(self, owner, lease_seconds, token_range, max_lines, prefer_voice=None):
+        """
+        Atomically select a group of at most max_lines lines and mark them as ongoing, leased to owner. The group
+        starts with the line claim_next() would select, followed by the next claimable lines with the same voice and
+        emotion (the synthesis settings depend on both) and a token count within token_range(token count of the first line), a (lower, upper) tuple with both bounds
+        included and upper None for no limit. Returns the claimed lines, empty if there is nothing left.
+        """
+        with self._transaction():
+            now = time.time()
+            first = None
+            if prefer_voice is not None:
+                first = self._first_claimable(now, prefer_voice)
+            if first is None:
+                first = self._first_claimable(now)
+            if first is None:
+                return []
+            lower, upper = token_range(first.pop('token_count'))
+            others = self._claimable_in_range(now, first['voice'], first['emotion'], lower, upper, max_lines)
+            group = [first] + [line for line in others if line['id'] != first['id']][:max_lines - 1]
+            self._conn.executemany(f"UPDATE {self.TABLE} SET completed = ?, lease_owner = ?, lease_expires = ? "
+                                   f"WHERE id = ?",
+                                   [(BatchStore.STATE_ONGOING, owner, now + lease_seconds, line['id']) for line in group])
+        for line in group:
+            line['completed'] = BatchStore.STATE_ONGOING
+        return group
+
+    def claimable_lines(self):
+        """
+        The not started lines and the ongoing lines with an expired lease, in file order.
+        """
+        return self._claimable_lines(time.time())
+
+    def renew_leases(self, owner, lease_seconds):
+        """
+        Extend the leases of all the ongoing lines of owner. Returns the number of renewed leases.
+        """
+        cursor = self._conn.execute(f"UPDATE {self.TABLE} SET lease_expires = ? WHERE lease_owner = ? AND completed = ?",
+                                    (time.time() + lease_seconds, owner, BatchStore.STATE_ONGOING))
+        return cursor.rowcount
+
+    def release_leases(self, owner):
+        """
+        Give back the ongoing lines of owner, so they can be claimed right away by another worker.
+        """
+        cursor = self._conn.execute(f"UPDATE {self.TABLE} SET completed = ?, lease_owner = '', lease_expires = 0 "
+                                    f"WHERE lease_owner = ? AND completed = ?",
+                                    (BatchStore.STATE_FALSE, owner, BatchStore.STATE_ONGOING))
+        return cursor.rowcount
+
+    #####################################################
+
+    def _create_schema(self):
+        columns = ", ".join(f"{col} TEXT NOT NULL DEFAULT ''" for col in self.columns if col != 'id')
+        with self._transaction():
+            # seq keeps the order of the lines in batch.csv, csv_completed is the state last written to (or read from)
+            # batch.csv, empty for the lines appended after the last export
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+                               f"(seq INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, {columns}, "
+                               f"lease_owner TEXT NOT NULL DEFAULT '', lease_expires REAL NOT NULL DEFAULT 0, "
+                               f"csv_completed TEXT NOT NULL DEFAULT '', token_count INTEGER NOT NULL DEFAULT 0)")
+            # databases created by older versions may lack some of the columns
+            existing = [row[1] for row in self._conn.execute(f"PRAGMA table_info({self.TABLE})")]
+            for col in self.columns:
+                if col not in existing:
+                    self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN {col} TEXT NOT NULL DEFAULT ''")
+            if 'lease_owner' not in existing:
+                self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN lease_owner TEXT NOT NULL DEFAULT ''")
+                self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN lease_expires REAL NOT NULL DEFAULT 0")
+            if 'csv_completed' not in existing:
+                self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN csv_completed TEXT NOT NULL DEFAULT ''")
+            if 'token_count' not in existing:
+                self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_completed ON {self.TABLE} (completed, seq)")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_voice ON {self.TABLE} (voice, completed, seq)")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_group "
+                               f"ON {self.TABLE} (voice, emotion, completed, token_count)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS line_metrics (line_id TEXT NOT NULL, owner TEXT NOT NULL, "
+                               "state TEXT NOT NULL, audio_seconds REAL NOT NULL, synth_seconds REAL NOT NULL, "
+                               "finished REAL NOT NULL)")
+        if 'token_count' not in existing:
+            self._count_missing_tokens()
+
+    def _count_missing_tokens(self):
+        # Fills the token counts of the lines of a store created before they were kept.
+        if self.token_counter is None:
+            return
+        rows = self._conn.execute(f"SELECT id, text FROM {self.TABLE}").fetchall()
+        updates = [(self.token_counter(text), line_id) for line_id, text in rows]
+        with self._transaction():
+            self._conn.executemany(f"UPDATE {self.TABLE} SET token_count = ? WHERE id = ?", updates)
+
+    def _token_counts(self, texts):
+        # Token counts of texts, reusing the counts of the texts already in the store. 0 without a token_counter.
+        if self.token_counter is None:
+            return [0] * len(texts)
+        known = {text: token_count for text, token_count in
+                 self._conn.execute(f"SELECT text, token_count FROM {self.TABLE}")}
+        counts = []
+        for text in texts:
+            if text not in known:
+                known[text] = self.token_counter(text)
+            counts.append(known[text])
+        return counts
+
+    def _split_output_paths(self, rows, fanout_sep):
+        # Removes the output paths of rows from the lines of the store, see append_lines().
+        output_index = self.columns.index('output_path')
+        has_fanout = 'fanout' in self.columns
+        paths = set()
+        for row in rows:
+            paths.add(row[output_index])
+            if has_fanout:
+                paths.update(_split_fanout(row[self.columns.index('fanout')], fanout_sep))
+        fanout_column = "fanout" if has_fanout else "''"
+        updates, deletes = [], []
+        for line_id, completed, output_path, fanout in self._conn.execute(
+                f"SELECT id, completed, output_path, {fanout_column} FROM {self.TABLE}").fetchall():
+            fanout = _split_fanout(fanout, fanout_sep)
+            kept = [path for path in fanout if path not in paths]
+            if output_path in paths and completed == BatchStore.STATE_FALSE:
+                if len(kept) == 0:
+                    deletes.append((line_id,))
+                else:
+                    updates.append((kept[0], fanout_sep.join(kept[1:]), line_id))
+            elif len(kept) != len(fanout):
+                updates.append((output_path, fanout_sep.join(kept), line_id))
+        self._conn.executemany(f"DELETE FROM {self.TABLE} WHERE id = ?", deletes)
+        if has_fanout:
+            self._conn.executemany(f"UPDATE {self.TABLE} SET output_path = ?, fanout = ? WHERE id = ?", updates)
+
+    def _first_claimable(self, now, voice=None):
+        voice_filter = "AND voice = ? " if voice is not None else ""
+        voice_args = [voice] if voice is not None else []
+        candidates = [
+            self._conn.execute(f"SELECT seq, token_count, {self._column_list()} FROM {self.TABLE} "
+                               f"WHERE completed = ? {voice_filter}ORDER BY seq LIMIT 1",
+                               [BatchStore.STATE_FALSE] + voice_args).fetchone(),
+            self._conn.execute(f"SELECT seq, token_count, {self._column_list()} FROM {self.TABLE} "
+                               f"WHERE completed = ? {voice_filter}"
+                               f"AND lease_expires < ? ORDER BY seq LIMIT 1",
+                               [BatchStore.STATE_ONGOING] + voice_args + [now]).fetchone(),
+        ]
+        candidates = [row for row in candidates if row is not None]
+        if len(candidates) == 0:
+            return None
+        row = dict(min(candidates, key=lambda r: r['seq']))
+        del row['seq']
+        return row
+
+    def _claimable_in_range(self, now, voice, emotion, lower, upper, limit):
+        # First claimable lines of voice and emotion with a token count within [lower, upper], in file order.
+        upper_filter = "AND token_count <= ? " if upper is not None else ""
+        range_args = [lower] + ([upper] if upper is not None else [])
+        rows = []
+        for state_filter, state_args in (("completed = ?", [BatchStore.STATE_FALSE]),
+                                         ("completed = ? AND lease_expires < ?", [BatchStore.STATE_ONGOING, now])):
+            rows += self._conn.execute(f"SELECT seq, {self._column_list()} FROM {self.TABLE} "
+                                       f"WHERE voice = ? AND emotion = ? AND {state_filter} AND token_count >= ? "
+                                       f"{upper_filter}ORDER BY seq LIMIT ?",
+                                       [voice, emotion] + state_args + range_args + [limit]).fetchall()
+        lines = []
+        for row in sorted(rows, key=lambda r: r['seq'])[:limit]:
+            line = dict(row)
+            del line['seq']
+            lines.append(line)
+        return lines
+
+    def _claimable_lines(self, now):
+        rows = self._conn.execute(f"SELECT {self._column_list()} FROM {self.TABLE} "
+                                  f"WHERE completed = ? OR (completed = ? AND lease_expires < ?) ORDER BY seq",
+                                  (BatchStore.STATE_FALSE, BatchStore.STATE_ONGOING, now)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _column_list(self):
+        return ", ".join(self.columns)
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _transaction(self):
+        return _Transaction(self._conn)
+
+
+def _split_fanout(fanout, fanout_sep):
+    return [path for path in fanout.split(fanout_sep) if path.strip() != ""] if fanout else []
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Background thread renewing the leases of an owner every interval seconds, while the owner is busy synthesizing.
+    It uses its own connection, since sqlite connections cannot be shared between threads.
+    """
+    def __init__(self, db_path, columns, owner, lease_seconds, interval):
+        super().__init__(name=f"lease-heartbeat-{owner}", daemon=True)
+        self.db_path = db_path
+        self.columns = columns
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        store = BatchStore(self.db_path, self.columns)
+        try:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    store.renew_leases(self.owner, self.lease_seconds)
+                except sqlite3.Error as e:
+                    print(f"WARNING: Cannot renew the leases of {self.owner}: {e}")
+        finally:
+            store.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE / COMMIT block, rolled back if an exception is raised inside it.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._conn.execute("COMMIT")
+        else:
+            self._conn.execute("ROLLBACK")
+        return False
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+
+class ImportManifest:
+    """
+    Record of the dialogueExport*.txt files used by the active import: path, size, modification time, content hash and
+    a hash of each imported row. It is used to re-import only the files changed since the last import, and to find
+    which of their rows are new or modified.
+    """
+    VERSION = 1
+    # columns used to compute the row hashes, the source file name is already the manifest key
+    ROW_HASH_COLUMNS = ['quest', 'voice_type', 'emotion', 'intensity', 'text', 'file', 'filepath']
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        # source file name -> {path, size, mtime, sha256, row_hashes}
+        self.files = {}
+        # True once a batch was created from the import, so later changes are delivered as delta batches
+        self.batched = False
+
+    @staticmethod
+    def load(manifest_path):
+        manifest = ImportManifest(manifest_path)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+                content = json.load(manifest_file)
+            manifest.files = content.get('files', {})
+            manifest.batched = content.get('batched', False)
+        return manifest
+
+    def save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'version': ImportManifest.VERSION, 'batched': self.batched, 'files': self.files},
+                      manifest_file, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def is_changed(self, dialog_file):
+        """
+        True if the file is not in the manifest or its content changed. The content hash is only computed when the
+        size or the modification time differ from the recorded ones.
+        """
+        record = self.files.get(os.path.basename(dialog_file))
+        if record is None:
+            return True
+        stat = os.stat(dialog_file)
+        if stat.st_size == record['size'] and stat.st_mtime == record['mtime']:
+            return False
+        return ImportManifest.file_hash(dialog_file) != record['sha256']
+
+    def removed_sources(self, list_dialogs):
+        """
+        Source file names present in the manifest but not in list_dialogs.
+        """
+        current = set(os.path.basename(dialog_file) for dialog_file in list_dialogs)
+        return [source for source in self.files if source not in current]
+
+    def get_row_hashes(self, source):
+        record = self.files.get(source)
+        return set(record['row_hashes']) if record is not None else set()
+
+    def update(self, dialog_file, row_hashes):
+        stat = os.stat(dialog_file)
+        self.files[os.path.basename(dialog_file)] = {
+            'path': os.path.abspath(dialog_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': ImportManifest.file_hash(dialog_file),
+            'row_hashes': list(row_hashes),
+        }
+
+    def remove(self, source):
+        self.files.pop(source, None)
+
+    @staticmethod
+    def file_hash(dialog_file):
+        sha = hashlib.sha256()
+        with open(dialog_file, 'rb') as content:
+            for chunk in iter(lambda: content.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def row_hashes(df):
+        """
+        Stable hash of each row of an import Dataframe, as a Series of hex strings aligned with df.
+        """
+        hashes = pd.util.hash_pandas_object(df[ImportManifest.ROW_HASH_COLUMNS].fillna(""), index=False)
+        return hashes.map(lambda value: format(value, '016x'))
@@ -1,28 +1,70 @@
 import logging
 import sys
 import os
+import time
+import queue
+import threading
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 
 class LoggingStream:
+    """
+    Redirects stdout and stderr to the logging module. The records are put in a queue and written to the console and
+    to a rotating log file by a listener thread, so a print never waits for the disk.
+    Progress bars (text rewritten with carriage returns, like tqdm bars) are logged at most once every
+    PROGRESS_INTERVAL_SECONDS, and when they are completed.
+    """
+    LOG_MAX_BYTES = 50 * 1024 * 1024
+    LOG_BACKUP_COUNT = 5
+    PROGRESS_INTERVAL_SECONDS = 5
     _is_initialize = False
     _stdout_bkp = None
     _stderr_bkp = None
     _logger = None
     _log_file_path = None
+    _queue_handler = None
+    _listener = None
 
     def __init__(self, logger, log_level):
         self.logger = logger
         self.log_level = log_level
         self.linebuf = ''
+        self._last_progress = 0.0
+        self._lock = threading.Lock()
 
     def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
+        with self._lock:
+            lines = (self.linebuf + buf).split('\n')
+            self.linebuf = lines.pop()
+            for line in lines:
+                # a completed progress bar: keep its final state only
+                line = LoggingStream._last_segment(line)
+                if line.strip() != "":
+                    self.logger.log(self.log_level, line.rstrip())
+            if '\r' in self.linebuf:
+                segments = self.linebuf.split('\r')
+                self.linebuf = segments[-1]
+                now = time.monotonic()
+                if now - self._last_progress >= LoggingStream.PROGRESS_INTERVAL_SECONDS:
+                    progress = LoggingStream._last_segment('\r'.join(segments))
+                    if progress.strip() != "":
+                        self.logger.log(self.log_level, progress.rstrip())
+                    self._last_progress = now
 
     def flush(self):
         pass  # No action needed, just here to satisfy file-like object interface
 
+    def flush_pending(self):
+        """
+        Log the text written after the last line break, if any.
+        """
+        with self._lock:
+            line = LoggingStream._last_segment(self.linebuf)
+            self.linebuf = ''
+        if line.strip() != "":
+            self.logger.log(self.log_level, line.rstrip())
+
     @staticmethod
     def initialize(log_dir="", log_file="app.log"):
         """
@@ -34,18 +76,24 @@ class LoggingStream:
 
         print(f"Using log_file {log_file}")
         if not LoggingStream._is_initialize:
-            # Set up logging
-            logging.basicConfig(
-                level=logging.DEBUG,
-                format='%(asctime)s [%(levelname)s] %(message)s',
-                handlers=[
-                    logging.FileHandler(LoggingStream._log_file_path),
-                    logging.StreamHandler(sys.stdout)
-                ]
-            )
             LoggingStream._stdout_bkp = sys.stdout
             LoggingStream._stderr_bkp = sys.stderr
 
+            # Set up logging: the handlers are only called by the listener thread.
+            formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+            file_handler = RotatingFileHandler(LoggingStream._log_file_path, maxBytes=LoggingStream.LOG_MAX_BYTES,
+                                               backupCount=LoggingStream.LOG_BACKUP_COUNT)
+            console_handler = logging.StreamHandler(LoggingStream._stdout_bkp)
+            for handler in [file_handler, console_handler]:
+                handler.setFormatter(formatter)
+            log_queue = queue.Queue(-1)
+            LoggingStream._listener = QueueListener(log_queue, file_handler, console_handler)
+            LoggingStream._listener.start()
+            LoggingStream._queue_handler = QueueHandler(log_queue)
+            root = logging.getLogger()
+            root.setLevel(logging.DEBUG)
+            root.addHandler(LoggingStream._queue_handler)
+
             LoggingStream._logger = logging.getLogger(__name__)
 
             # Redirect stdout to logging
@@ -59,11 +107,21 @@ class LoggingStream:
     @staticmethod
     def finalize():
         """
-        Reset the LoggingStream class.
+        Reset the LoggingStream class. The queued messages are written before the log files are renamed.
         """
+        for stream in [sys.stdout, sys.stderr]:
+            if isinstance(stream, LoggingStream):
+                stream.flush_pending()
         sys.stdout = LoggingStream._stdout_bkp
         sys.stderr = LoggingStream._stderr_bkp
         LoggingStream._is_initialize = False
+        if LoggingStream._listener is not None:
+            LoggingStream._listener.stop()
+            logging.getLogger().removeHandler(LoggingStream._queue_handler)
+            for handler in LoggingStream._listener.handlers:
+                handler.close()
+            LoggingStream._listener = None
+            LoggingStream._queue_handler = None
         if LoggingStream._log_file_path:
             # Create a timestamp for the new log file name
             timestamp = datetime.now().strftime('%Y.%m.%d.%H.%M.%S')
@@ -72,8 +130,11 @@ class LoggingStream:
             new_log_file_name = f"{log_file_name}.{timestamp}{log_file_ext}"
             new_log_file_path = os.path.join(log_dir, new_log_file_name)
 
-            # Rename the log file
+            # Rename the log file, and the files rotated out of it
             os.rename(LoggingStream._log_file_path, new_log_file_path)
+            for i in range(1, LoggingStream.LOG_BACKUP_COUNT + 1):
+                if os.path.exists(f"{LoggingStream._log_file_path}.{i}"):
+                    os.rename(f"{LoggingStream._log_file_path}.{i}", f"{new_log_file_path}.{i}")
 
     @staticmethod
     def debug(message):
@@ -100,6 +161,14 @@ class LoggingStream:
         if LoggingStream._logger:
             LoggingStream._logger.critical(message)
 
+    #####################################################
+
+    @staticmethod
+    def _last_segment(line):
+        # text shown by a line rewritten with carriage returns
+        segments = [segment for segment in line.split('\r') if segment.strip() != ""]
+        return segments[-1] if len(segments) > 0 else ""
+
 
 def test_logger():
     # Example usage
@@ -21,6 +21,9 @@ class TtsSettings:
 
         # API settings
         api_settings = TortoiseApiSettings.get_default()
+        if not api_settings['fast_sampler']:
+            model_settings = {key: value for key, value in model_settings.items()
+                              if key not in TortoiseModelPresets.SAMPLER_KEYS}
 
         # engine selection
         text = str(entry.get('text', ''))
@@ -63,6 +66,12 @@ class TortoiseModelPresets:
 
     diffusion_temperature: Increase this value to add more randomness and variability to the diffusion process, which can enhance expressiveness.
 
+    sampler, diffusion_iterations, ddim_eta (SAMPLER_KEYS): only used when 'fast_sampler' is set in TortoiseApiSettings, otherwise the ancestral sampler and the diffusion steps of the tortoise preset are used. Switching it changes the generated audio: lines synthesized before sound different from the new ones.
+
+    sampler: The diffusion sampler. 'dpm++2m' decodes a line in few diffusion_iterations and is deterministic given the noise, 'ddim' adds back some of the randomness of the diffusion with ddim_eta (0 to 1), which suits the more dramatic emotions.
+
+    diffusion_iterations: Number of diffusion steps, 20 to 50 are enough for these samplers.
+
     ---- ChatGPT Tutorial ----
     # Temperature:
 
@@ -100,6 +109,7 @@ class TortoiseModelPresets:
     * Effect: Controls the randomness of the diffusion process, affecting the smoothness or variability of the generated output.
     * Typical Range: Varies based on implementation.
     """
+    SAMPLER_KEYS = ['sampler', 'diffusion_iterations', 'ddim_eta']
 
     default = {
         'temperature': .8,
@@ -107,7 +117,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 2.0,
         'top_p': .8,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     high_expressiveness = {
         'temperature': 1.0,
@@ -115,7 +128,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .8,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'ddim',
+        'diffusion_iterations': 50,
+        'ddim_eta': 0.5
     }
     top_p_expressive = {
         'temperature': .8,
@@ -123,7 +139,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 2.0,
         'top_p': 0.95,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # sad: Higher repetition penalty for more repetition, lower temperature.
     sad = {
@@ -132,7 +151,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 2.5,
         'top_p': .85,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'ddim',
+        'diffusion_iterations': 50,
+        'ddim_eta': 0.0
     }
     # anger: Uses the top_p_expressive() preset with slight modifications.
     angry = {
@@ -141,7 +163,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.8,
         'top_p': 0.95,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'ddim',
+        'diffusion_iterations': 50,
+        'ddim_eta': 0.5
     }
     # happy: Slightly higher temperature and lower repetition penalty for expressiveness.
     happy = {
@@ -150,7 +175,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # disgust: Similar to neutral but with slight modifications.
     disgust = {
@@ -159,7 +187,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 2.0,
         'top_p': .85,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # puzzled: Higher temperature for more variability.
     puzzled = {
@@ -168,7 +199,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # fear: High temperature and condition-free to enhance dramatic effect.
     fear = {
@@ -177,7 +211,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .8,
         'cond_free_k': 2.5,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'ddim',
+        'diffusion_iterations': 50,
+        'ddim_eta': 0.5
     }
     # hurt: Similar to sad but slightly different parameters.
     hurt = {
@@ -186,7 +223,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 2.5,
         'top_p': .85,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'ddim',
+        'diffusion_iterations': 50,
+        'ddim_eta': 0.0
     }
     # surprise: High temperature for variability and expressiveness.
     surprise = {
@@ -195,7 +235,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # sing: Higher temperature and lower length penalty for more fluidity.
     sing = {
@@ -204,7 +247,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .95,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'ddim',
+        'diffusion_iterations': 50,
+        'ddim_eta': 0.5
     }
     # confident: Balanced parameters for a confident tone.
     confident = {
@@ -213,7 +259,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # curious: Higher temperature and length penalty for variability.
     curious = {
@@ -222,7 +271,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # frustrated: Balanced but with higher repetition penalty.
     frustrated = {
@@ -231,7 +283,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 2.0,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
     # amused: Similar to happy but slightly different parameters.
     amused = {
@@ -240,7 +295,10 @@ class TortoiseModelPresets:
         'repetition_penalty': 1.5,
         'top_p': .9,
         'cond_free_k': 2.0,
-        'diffusion_temperature': 1.0
+        'diffusion_temperature': 1.0,
+        'sampler': 'dpm++2m',
+        'diffusion_iterations': 30,
+        'ddim_eta': 0.0
     }
 
     @staticmethod
@@ -266,6 +324,17 @@ class TortoiseModelPresets:
 
 
 class TortoiseApiSettings:
+    # settings changing the synthesized audio, the others only change the speed or the memory use
+    OUTPUT_KEYS = ['seed', 'cvvp_amount', 'preset', 'half', 'quantize', 'fuse_cond_free', 'reuse_latents',
+                   'adaptive_sampling', 'adaptive_margin', 'adaptive_patience', 'adaptive_min_samples', 'fast_sampler']
+
+    @staticmethod
+    def output_settings(api_settings):
+        """
+        The api settings of OUTPUT_KEYS, e.g. for the audio cache keys, so the cached audio is found on machines with
+        other performance settings.
+        """
+        return {key: api_settings[key] for key in TortoiseApiSettings.OUTPUT_KEYS if key in api_settings}
 
     @staticmethod
     def get_default():
@@ -282,9 +351,53 @@ class TortoiseApiSettings:
             "seed": None,
             "cvvp_amount": 0,
             'preset': 'high_quality',
+            # the models stay on the GPU between lines while they fit, see tortoise.utils.residency.ModelResidency
+            'residency_policy': 'lru',
+            # only used without a GPU: bf16 autocast when the CPU has fast bf16 kernels ('auto'), 'bf16' or 'fp32',
+            # and the thread count (None: one per physical core)
+            'cpu_profile': 'auto',
+            'cpu_threads': None,
+            # dynamic int8 autoregressive model and CLVP without a GPU, faster but slightly lower quality, see
+            # tortoise/quantization_benchmark.py. Read when the models are loaded.
+            'quantize': False,
+            # stop sampling the lines synthesized one by one once their CLVP ranking converges, instead of always taking
+            # all the samples of the preset
+            'adaptive_sampling': False,
+            # score the samples of the lines synthesized one by one on a background thread while the next batch is sampled
+            'pipelined_scoring': False,
+            # keep the autoregressive latents of the best samples while sampling instead of recomputing them
+            'reuse_latents': False,
+            # diffuse and vocode the candidates of a line in one batch instead of one after the other, faster on GPUs
+            # but uses candidates times the diffusion memory
+            'batch_candidates': False,
+            # run the conditioned and conditioning-free diffusion passes as one forward of twice the batch, faster but
+            # uses twice the diffusion activation memory
+            'fuse_cond_free': False,
+            # decode with the few step diffusion samplers of the emotion presets (sampler, diffusion_iterations and
+            # ddim_eta of TortoiseModelPresets) instead of the ancestral sampler of the preset, much faster but the
+            # audio differs from the one of the lines synthesized without it
+            'fast_sampler': False,
         }
 
         return default
 
 
 
+
+
+class BatchPlannerSettings:
+    """
+    Settings of the BatchPlanner, which selects the batch lines synthesized together by a single engine call.
+    bucket_boundaries: upper bounds (in text tokens) of the length buckets. Lines are only grouped with lines of the
+    same voice, emotion and bucket, so short barks are not padded to the length of long quest dialogues.
+    max_group_size: maximum number of lines in a group. 1 synthesizes the lines one by one.
+    """
+
+    @staticmethod
+    def get_default():
+        default = {
+            'bucket_boundaries': [8, 16, 32, 64, 128, 256, 400],
+            'max_group_size': 4,
+        }
+
+        return default
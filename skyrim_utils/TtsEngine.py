@@ -0,0 +1,79 @@
+from tortoise.api import TextToSpeech
+from skyrim_utils.VoiceLatentCache import VoiceLatentCache
+
+
+class TtsEngine:
+    """
+    Resident Tortoise session used by the batch loop. The models are loaded once, when the first entry that needs them
+    is synthesized, and are reused by all the following entries. The per entry api settings (preset, kv_cache, half)
+    are applied over the loaded models, so they never are read from disk again.
+    """
+
+    def __init__(self, models_dir, latents_dir):
+        self.models_dir = models_dir
+        self.preset = None
+        self.latent_cache = VoiceLatentCache(latents_dir)
+        self._tts = None
+
+    def configure(self, api_settings):
+        """
+        Apply the api settings returned by TortoiseApiSettings to the session, loading the models on the first call.
+        Returns the underlying TextToSpeech instance.
+        """
+        if self._tts is None:
+            print(f"Loading Tortoise models from {self.models_dir}...")
+            self._tts = TextToSpeech(models_dir=self.models_dir, use_deepspeed=api_settings['use_deepspeed'],
+                                     kv_cache=api_settings['kv_cache'], half=api_settings['half'],
+                                     residency_policy=api_settings['residency_policy'],
+                                     cpu_profile=api_settings['cpu_profile'], cpu_threads=api_settings['cpu_threads'],
+                                     quantize=api_settings['quantize'])
+        else:
+            self._tts.reconfigure(use_deepspeed=api_settings['use_deepspeed'], kv_cache=api_settings['kv_cache'],
+                                  half=api_settings['half'], residency_policy=api_settings['residency_policy'],
+                                  cpu_profile=api_settings['cpu_profile'])
+        self.preset = api_settings['preset']
+        return self._tts
+
+    def get_conditioning_latents(self, voice):
+        """
+        Conditioning latents of a voice, computed once per voice and cached in memory and on disk.
+        """
+        if self._tts is None:
+            raise RuntimeError("TtsEngine.configure() must be called before computing conditioning latents.")
+        return self.latent_cache.get_latents(voice, self._tts)
+
+    def get_voice_hash(self, voice):
+        """
+        Content hash of the voice samples, it does not need the models to be loaded.
+        """
+        return self.latent_cache.get_voice_hash(voice)
+
+    def preset_settings(self):
+        """
+        Tortoise settings (num_autoregressive_samples, diffusion_iterations, ...) of the preset selected by the last call
+        to configure().
+        """
+        if self._tts is None:
+            raise RuntimeError("TtsEngine.configure() must be called before reading the preset settings.")
+        return self._tts._preset_settings(self.preset, {})
+
+    def autoregressive_batch_size(self):
+        if self._tts is None:
+            raise RuntimeError("TtsEngine.configure() must be called before reading the batch size.")
+        return self._tts.autoregressive_batch_size
+
+    def tts(self, text, **kwargs):
+        """
+        Synthesize text with the preset selected by the last call to configure().
+        """
+        if self._tts is None:
+            raise RuntimeError("TtsEngine.configure() must be called before synthesizing audio.")
+        return self._tts.tts_with_preset(text, preset=self.preset, **kwargs)
+
+    def tts_batch(self, texts, voices, **kwargs):
+        """
+        Synthesize several texts in shared batches with the preset selected by the last call to configure().
+        """
+        if self._tts is None:
+            raise RuntimeError("TtsEngine.configure() must be called before synthesizing audio.")
+        return self._tts.tts_batch_with_preset(texts, voices, preset=self.preset, **kwargs)
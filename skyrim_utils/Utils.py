@@ -1,4 +1,6 @@
+import os
 import wave
+import shutil
 import numpy as np
 
 TORTOISE_4SKYRIM_HOME = ""
@@ -44,3 +46,23 @@ def create_empty_audio(filename, duration, sample_rate=44100):
 
         # Write the audio data to the wave file
         wav_file.writeframes(audio_data.tobytes())
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link src to dst, or copy it when hard links are not supported (e.g. the paths are on different drives).
+    An existing dst is replaced.
+
+    Args:
+        src (str): The existing file.
+        dst (str): The path of the new file.
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
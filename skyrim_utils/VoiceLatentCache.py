@@ -0,0 +1,117 @@
+import os
+import glob
+import json
+import hashlib
+import torch
+from tortoise.utils.audio import BUILTIN_VOICES_DIR, load_voices
+from skyrim_utils.CustomExceptions import InvalidVoiceTypeException
+
+
+class VoiceLatentCache:
+    """
+    Cache of the conditioning latents (autoregressive_latent, diffusion_latent) of each voice, so the voice samples are
+    decoded and encoded only once, instead of once per batch entry.
+    Latents are kept in memory and saved as <voice>.pth files inside the cache directory. Both are invalidated by a
+    content hash of the voice sample folder and by the fingerprint of the models computing them, so editing the
+    samples of a voice, or switching the model weights or their quantization, produces new latents.
+    """
+    VOICE_FILE_PATTERNS = ['*.wav', '*.mp3', '*.pth']
+
+    def __init__(self, cache_dir, voices_dir=BUILTIN_VOICES_DIR):
+        self.cache_dir = cache_dir
+        self.voices_dir = voices_dir
+        # voice -> (latents key, latents)
+        self._latents = {}
+        # voice -> (stat signature, voice_hash), avoids re-reading the samples when the folder did not change
+        self._hashes = {}
+
+    def get_latents(self, voice, tts):
+        """
+        Returns the conditioning latents of the voice, computing them with tts (a tortoise TextToSpeech) on a miss.
+        """
+        key = VoiceLatentCache.latents_key(self.get_voice_hash(voice), tts.conditioning_fingerprint())
+        cached = self._latents.get(voice)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        latents = self._load(voice, key)
+        if latents is None:
+            print(f"Computing conditioning latents for voice {voice}...")
+            voice_samples, latents = load_voices([voice], extra_voice_dirs=self._extra_voice_dirs())
+            if voice_samples is not None:
+                latents = tts.get_conditioning_latents(voice_samples)
+            latents = tuple(latent.cpu() for latent in latents)
+            self._save(voice, key, latents)
+
+        self._latents[voice] = (key, latents)
+        return latents
+
+    @staticmethod
+    def latents_key(voice_hash, model_fingerprint):
+        """
+        Key of the latents of a voice: its sample hash and the fingerprint of the models computing the latents.
+        """
+        sha = hashlib.sha256(voice_hash.encode('utf-8'))
+        sha.update(json.dumps(model_fingerprint, sort_keys=True).encode('utf-8'))
+        return sha.hexdigest()
+
+    def get_voice_hash(self, voice):
+        """
+        Content hash of the sample files of a voice.
+        """
+        paths = self._voice_files(voice)
+        if len(paths) == 0:
+            raise InvalidVoiceTypeException(f"There is no voice sample for the voice '{voice}' at {self.voices_dir}.")
+
+        signature = tuple((path, os.path.getsize(path), os.path.getmtime(path)) for path in paths)
+        cached = self._hashes.get(voice)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        sha = hashlib.sha256()
+        for path in paths:
+            sha.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as sample:
+                for chunk in iter(lambda: sample.read(1024 * 1024), b''):
+                    sha.update(chunk)
+        voice_hash = sha.hexdigest()
+        self._hashes[voice] = (signature, voice_hash)
+        return voice_hash
+
+    #####################################################
+
+    def _voice_files(self, voice):
+        voice_dir = os.path.join(self.voices_dir, voice)
+        paths = []
+        for pattern in VoiceLatentCache.VOICE_FILE_PATTERNS:
+            paths.extend(glob.glob(os.path.join(voice_dir, pattern)))
+        return sorted(paths)
+
+    def _extra_voice_dirs(self):
+        if os.path.realpath(self.voices_dir) == os.path.realpath(BUILTIN_VOICES_DIR):
+            return []
+        return [self.voices_dir]
+
+    def _cache_file(self, voice):
+        return os.path.join(self.cache_dir, f"{voice}.pth")
+
+    def _load(self, voice, key):
+        cache_file = self._cache_file(voice)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            content = torch.load(cache_file, map_location=torch.device('cpu'))
+        except Exception as e:
+            print(f"WARNING: Cannot read cached latents {cache_file}: {e}")
+            return None
+        if content.get('latents_key') != key:
+            return None
+        return tuple(content['latents'])
+
+    def _save(self, voice, key, latents):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = self._cache_file(voice)
+        # several workers may compute the latents of the same voice at once
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        torch.save({'latents_key': key, 'latents': latents}, tmp_file)
+        os.replace(tmp_file, cache_file)
@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from tortoise.utils.artifacts import ArtifactStore
+
+
+def fingerprints(text="Hello.", seed=42, cvvp_amount=0.0, k=1, **overrides):
+    settings = dict(num_autoregressive_samples=16, batch_size=8, temperature=.8, length_penalty=1.0,
+                    repetition_penalty=2.0, top_p=.8, max_mel_tokens=500, hf_generate_kwargs={})
+    settings.update(overrides)
+    return ArtifactStore.stage_fingerprints(text, torch.ones(1, 2, 4), seed, cvvp_amount=cvvp_amount, k=k,
+                                            **settings)
+
+
+def test_fingerprints_chain_the_stages():
+    base = fingerprints()
+    assert base == fingerprints()
+    # a change of the ranking settings keeps the codes
+    other_k = fingerprints(k=2)
+    assert other_k[ArtifactStore.STAGE_CODES] == base[ArtifactStore.STAGE_CODES]
+    assert other_k[ArtifactStore.STAGE_SCORES] == base[ArtifactStore.STAGE_SCORES]
+    assert other_k[ArtifactStore.STAGE_BEST] != base[ArtifactStore.STAGE_BEST]
+    # a change of the sampling settings invalidates every stage
+    other_seed = fingerprints(seed=43)
+    assert all(other_seed[stage] != base[stage] for stage in ArtifactStore.STAGES)
+
+
+def test_load_with_matching_fingerprint(tmp_path):
+    store = ArtifactStore(str(tmp_path / "line"))
+    codes = torch.tensor([[1, 2, 8193]])
+    store.save(ArtifactStore.STAGE_CODES, fingerprints(), codes=codes)
+    tensors = store.load(ArtifactStore.STAGE_CODES, fingerprints()[ArtifactStore.STAGE_CODES])
+    assert tensors['codes'].dtype == torch.long
+    assert torch.equal(tensors['codes'], codes)
+
+
+def test_fingerprint_mismatch_is_not_loaded(tmp_path):
+    store = ArtifactStore(str(tmp_path / "line"))
+    store.save(ArtifactStore.STAGE_CODES, fingerprints(), codes=torch.tensor([[1, 2]]))
+    assert store.load(ArtifactStore.STAGE_CODES, fingerprints(text="Goodbye.")[ArtifactStore.STAGE_CODES]) is None
+    assert store.resume(fingerprints(temperature=.9)) == (None, None)
+
+
+def test_resume_returns_the_last_matching_stage(tmp_path):
+    store = ArtifactStore(str(tmp_path / "line"))
+    store.save(ArtifactStore.STAGE_CODES, fingerprints(), codes=torch.tensor([[1, 2]]))
+    store.save(ArtifactStore.STAGE_SCORES, fingerprints(), codes=torch.tensor([[1, 2]]), scores=torch.tensor([.5]))
+    store.save(ArtifactStore.STAGE_BEST, fingerprints(), codes=torch.tensor([[1, 2]]))
+    stage, tensors = store.resume(fingerprints())
+    assert stage == ArtifactStore.STAGE_BEST
+    # another k only invalidates the best samples
+    stage, tensors = store.resume(fingerprints(k=2))
+    assert stage == ArtifactStore.STAGE_SCORES
+    assert torch.equal(tensors['scores'], torch.tensor([.5]))
+
+
+def test_unreadable_checkpoint_is_ignored(tmp_path):
+    store = ArtifactStore(str(tmp_path / "line"))
+    store.save(ArtifactStore.STAGE_CODES, fingerprints(), codes=torch.tensor([[1, 2]]))
+    with open(store._stage_path(ArtifactStore.STAGE_CODES), 'wb') as checkpoint:
+        checkpoint.write(b"truncated")
+    assert store.load(ArtifactStore.STAGE_CODES, fingerprints()[ArtifactStore.STAGE_CODES]) is None
+
+
+def test_clear(tmp_path):
+    store = ArtifactStore(str(tmp_path / "line"))
+    store.save(ArtifactStore.STAGE_CODES, fingerprints(), codes=torch.tensor([[1, 2]]))
+    store.clear()
+    assert store.resume(fingerprints()) == (None, None)
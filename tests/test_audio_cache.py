@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from skyrim_utils.AudioCache import AudioCache
+
+
+def write_audio(path, size):
+    with open(path, 'wb') as audio_file:
+        audio_file.write(os.urandom(size))
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as audio_file:
+        return audio_file.read()
+
+
+def set_last_used(cache, key, last_used):
+    cache._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (last_used, key))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    audio_cache = AudioCache(str(tmp_path / "cache"), max_bytes=250)
+    yield audio_cache
+    audio_cache.close()
+
+
+def test_make_key_depends_on_every_input():
+    key = AudioCache.make_key("Hello.", "abc", {'preset': "fast"}, 42, 1)
+    assert key == AudioCache.make_key("Hello.", "abc", {'preset': "fast"}, 42, 1)
+    assert key != AudioCache.make_key("Hello!", "abc", {'preset': "fast"}, 42, 1)
+    assert key != AudioCache.make_key("Hello.", "abd", {'preset': "fast"}, 42, 1)
+    assert key != AudioCache.make_key("Hello.", "abc", {'preset': "standard"}, 42, 1)
+    assert key != AudioCache.make_key("Hello.", "abc", {'preset': "fast"}, 43, 1)
+    assert key != AudioCache.make_key("Hello.", "abc", {'preset': "fast"}, 42, 2)
+
+
+def test_put_and_get(tmp_path, cache):
+    files = [write_audio(tmp_path / "a.wav", 10), write_audio(tmp_path / "b.wav", 20)]
+    cache.put("key", files)
+    outputs = [str(tmp_path / "out" / "a.wav"), str(tmp_path / "out" / "b.wav")]
+    assert cache.get("key", outputs)
+    assert [read(path) for path in outputs] == [read(path) for path in files]
+    assert not cache.get("other", outputs)
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, cache):
+    for i, key in enumerate(["first", "second", "third"]):
+        cache.put(key, [write_audio(tmp_path / f"{key}.wav", 80)])
+        set_last_used(cache, key, i)
+    # reading the first entry makes the second one the least recently used
+    assert cache.get("first", [str(tmp_path / "out.wav")])
+    cache.put("fourth", [write_audio(tmp_path / "fourth.wav", 80)])
+
+    info = cache.info()
+    assert info['entries'] == 3
+    assert info['size'] <= cache.max_bytes
+    assert not cache.get("second", [str(tmp_path / "out.wav")])
+    assert not os.path.exists(cache._entry_dir("second"))
+    for key in ["first", "third", "fourth"]:
+        assert cache.get(key, [str(tmp_path / "out.wav")])
+
+
+def test_prune(tmp_path, cache):
+    for i, key in enumerate(["first", "second"]):
+        cache.put(key, [write_audio(tmp_path / f"{key}.wav", 100)])
+        set_last_used(cache, key, i)
+    assert cache.prune(150) == 1
+    assert cache.info()['entries'] == 1
+    assert cache.get("second", [str(tmp_path / "out.wav")])
+
+
+def test_entry_with_missing_files_is_a_miss(tmp_path, cache):
+    cache.put("key", [write_audio(tmp_path / "a.wav", 10)])
+    os.remove(os.path.join(cache._entry_dir("key"), "0.wav"))
+    assert not cache.get("key", [str(tmp_path / "out.wav")])
+    assert cache.info()['entries'] == 0
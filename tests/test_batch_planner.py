@@ -0,0 +1,59 @@
+import pytest
+
+BatchPlanner = pytest.importorskip("skyrim_utils.BatchPlanner").BatchPlanner
+
+
+def make_planner(token_counts, bucket_boundaries=(8, 16, 32), max_group_size=2):
+    planner = BatchPlanner(list(bucket_boundaries), max_group_size)
+    # texts are named after their token counts, so the tests do not depend on the tokenizer
+    planner._token_counts.update(token_counts)
+    return planner
+
+
+def make_line(line_id, voice, text, emotion="neutral"):
+    return {'id': str(line_id), 'voice': voice, 'emotion': emotion, 'text': text}
+
+
+def test_bucket_boundaries_are_inclusive():
+    planner = make_planner({'t0': 0, 't8': 8, 't9': 9, 't32': 32, 't33': 33})
+    assert [planner.bucket(text) for text in ['t0', 't8', 't9', 't32', 't33']] == [0, 0, 1, 2, 3]
+
+
+def test_bucket_range():
+    planner = make_planner({})
+    assert planner.bucket_range(3) == (0, 8)
+    assert planner.bucket_range(8) == (0, 8)
+    assert planner.bucket_range(9) == (9, 16)
+    assert planner.bucket_range(40) == (33, None)
+
+
+def test_plan_groups_by_voice_and_bucket():
+    planner = make_planner({'short': 4, 'short2': 6, 'long': 20})
+    lines = [make_line(0, "malenord", 'short'), make_line(1, "malenord", 'long'),
+             make_line(2, "femalenord", 'short'), make_line(3, "malenord", 'short2'),
+             make_line(4, "malenord", 'short')]
+    groups = [[line['id'] for line in group] for group in planner.plan(lines)]
+    assert sorted(groups) == sorted([["0", "3"], ["4"], ["1"], ["2"]])
+
+
+def test_plan_never_mixes_emotions():
+    planner = make_planner({'short': 4})
+    lines = [make_line(0, "malenord", 'short'), make_line(1, "malenord", 'short', emotion="anger"),
+             make_line(2, "malenord", 'short')]
+    groups = [[line['id'] for line in group] for group in planner.plan(lines)]
+    assert sorted(groups) == sorted([["0", "2"], ["1"]])
+
+
+def test_plan_without_buckets_only_groups_by_voice_and_emotion():
+    planner = make_planner({'short': 4, 'long': 20})
+    lines = [make_line(0, "malenord", 'short'), make_line(1, "malenord", 'long')]
+    assert [[line['id'] for line in group] for group in planner.plan(lines, use_buckets=False)] == [["0", "1"]]
+
+
+def test_padding_waste():
+    planner = make_planner({'t2': 2, 't6': 6})
+    group = [make_line(0, "malenord", 't2'), make_line(1, "malenord", 't6')]
+    assert planner.padding_waste([group]) == pytest.approx(1 - 8 / 12)
+    planner.account(group)
+    planner.account([])
+    assert planner.padding_waste() == pytest.approx(1 - 8 / 12)
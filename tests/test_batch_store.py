@@ -0,0 +1,269 @@
+import time
+
+import pytest
+
+from skyrim_utils.BatchStore import BatchStore
+
+
+COLUMNS = ['id', 'quest', 'completed', 'voice', 'emotion', 'text', 'output_path', 'fanout']
+
+
+def write_csv(csv_path, lines):
+    with open(csv_path, 'w') as batch_file:
+        batch_file.write("# " + BatchStore.CSV_SEP.join(COLUMNS) + "\n")
+        for line in lines:
+            batch_file.write(BatchStore.CSV_SEP.join(line) + "\n")
+
+
+def make_line(line_id, completed="false", voice="malenord", text="Hello there.", output_path=None, fanout="",
+              emotion="neutral"):
+    output_path = output_path if output_path is not None else f"out/{line_id}.wav"
+    return [str(line_id), "quest", completed, voice, emotion, text, output_path, fanout]
+
+
+def states(store):
+    return {row['id']: row['completed'] for row in
+            store._conn.execute(f"SELECT id, completed FROM {BatchStore.TABLE} ORDER BY seq")}
+
+
+@pytest.fixture
+def store(tmp_path):
+    batch_store = BatchStore(str(tmp_path / "batch.db"), COLUMNS, token_counter=lambda text: len(text.split()))
+    yield batch_store
+    batch_store.close()
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    return str(tmp_path / "batch.csv")
+
+
+def test_import_keeps_file_order(store, csv_path):
+    write_csv(csv_path, [make_line(2), make_line(0), make_line(1, completed="true")])
+    store.import_csv(csv_path)
+    assert list(states(store).items()) == [("2", "false"), ("0", "false"), ("1", "true")]
+    assert not store.is_csv_modified(csv_path)
+
+
+def test_export_import_round_trip(store, csv_path):
+    write_csv(csv_path, [make_line(0), make_line(1)])
+    store.import_csv(csv_path)
+    store.update_state("0", "true")
+    store.export_csv(csv_path)
+    assert not store.is_csv_modified(csv_path)
+    with open(csv_path) as batch_file:
+        rows = [row.rstrip("\n").split(BatchStore.CSV_SEP) for row in batch_file.readlines()[1:]]
+    assert [row[2] for row in rows] == ["true", "false"]
+
+
+def test_import_of_stale_csv_keeps_newer_states(store, csv_path):
+    write_csv(csv_path, [make_line(0), make_line(1), make_line(2)])
+    store.import_csv(csv_path)
+    store.export_csv(csv_path)
+    # the store moves on after the export, then the user edits the text of a line in the file
+    store.update_state("0", "true")
+    store.update_state("1", "error")
+    write_csv(csv_path, [make_line(0), make_line(1), make_line(2, text="Edited.")])
+    assert store.is_csv_modified(csv_path)
+    store.import_csv(csv_path)
+    assert states(store) == {"0": "true", "1": "error", "2": "false"}
+    assert store._conn.execute(f"SELECT text FROM {BatchStore.TABLE} WHERE id = '2'").fetchone()[0] == "Edited."
+
+
+def test_import_applies_edited_states(store, csv_path):
+    write_csv(csv_path, [make_line(0), make_line(1)])
+    store.import_csv(csv_path)
+    store.update_state("0", "true")
+    store.export_csv(csv_path)
+    # the user resets line 0 to regenerate it
+    write_csv(csv_path, [make_line(0, completed="false"), make_line(1)])
+    store.import_csv(csv_path)
+    assert states(store) == {"0": "false", "1": "false"}
+
+
+def test_import_deletes_removed_lines_and_keeps_appended_ones(store, csv_path):
+    write_csv(csv_path, [make_line(0), make_line(1)])
+    store.import_csv(csv_path)
+    store.export_csv(csv_path)
+    store.append_lines([make_line("", output_path="out/new.wav")])
+    # line 1 deleted from the file, which does not know the appended line 2 yet
+    write_csv(csv_path, [make_line(0)])
+    store.import_csv(csv_path)
+    assert states(store) == {"0": "false", "2": "false"}
+
+
+@pytest.fixture
+def loaded_store(store, csv_path):
+    write_csv(csv_path, [make_line(0, voice="malenord"), make_line(1, voice="femalenord"), make_line(2, voice="malenord")])
+    store.import_csv(csv_path)
+    return store
+
+
+def test_claim_next_leases_lines_in_file_order(loaded_store):
+    first = loaded_store.claim_next("worker-1", 60)
+    second = loaded_store.claim_next("worker-2", 60)
+    assert (first['id'], second['id']) == ("0", "1")
+    assert first['completed'] == BatchStore.STATE_ONGOING
+    assert states(loaded_store)["0"] == BatchStore.STATE_ONGOING
+
+
+def test_claim_next_prefers_the_voice(loaded_store):
+    loaded_store.claim_next("worker-1", 60)
+    assert loaded_store.claim_next("worker-1", 60, prefer_voice="malenord")['id'] == "2"
+    assert loaded_store.claim_next("worker-1", 60, prefer_voice="malenord")['id'] == "1"
+    assert loaded_store.claim_next("worker-1", 60) is None
+
+
+def test_expired_lease_is_claimed_again(loaded_store):
+    assert loaded_store.claim_next("crashed", -1)['id'] == "0"
+    assert loaded_store.claim_next("worker-2", 60)['id'] == "0"
+    assert loaded_store.claim_next("worker-3", 60)['id'] == "1"
+
+
+def test_active_lease_is_not_claimed_again(loaded_store):
+    loaded_store.claim_next("worker-1", 60)
+    assert "0" not in [line['id'] for line in loaded_store.claimable_lines()]
+    assert loaded_store.claim_next("worker-2", 60)['id'] == "1"
+
+
+def test_renewed_lease_does_not_expire(loaded_store):
+    loaded_store.claim_next("worker-1", 0.2)
+    assert loaded_store.renew_leases("worker-1", 60) == 1
+    time.sleep(0.3)
+    assert loaded_store.claim_next("worker-2", 60)['id'] == "1"
+
+
+def test_released_leases_are_claimable_right_away(loaded_store):
+    loaded_store.claim_next("worker-1", 60)
+    loaded_store.claim_next("worker-1", 60)
+    assert loaded_store.release_leases("worker-1") == 2
+    assert states(loaded_store) == {"0": "false", "1": "false", "2": "false"}
+    assert loaded_store.claim_next("worker-2", 60)['id'] == "0"
+
+
+def test_finished_line_is_not_claimed(loaded_store):
+    line = loaded_store.claim_next("worker-1", -1)
+    loaded_store.update_state(line['id'], "true")
+    assert loaded_store.claim_next("worker-2", 60)['id'] == "1"
+
+
+def test_workers_sharing_the_database_claim_distinct_lines(loaded_store):
+    other = BatchStore(loaded_store.db_path, COLUMNS)
+    try:
+        claimed = [loaded_store.claim_next("worker-1", 60)['id'], other.claim_next("worker-2", 60)['id'],
+                   loaded_store.claim_next("worker-1", 60)['id']]
+        assert claimed == ["0", "1", "2"]
+        assert other.claim_next("worker-2", 60) is None
+    finally:
+        other.close()
+
+
+def output_paths(store):
+    return {row['id']: (row['output_path'], row['fanout']) for row in
+            store._conn.execute(f"SELECT id, output_path, fanout FROM {BatchStore.TABLE} ORDER BY seq")}
+
+
+def test_append_lines_gets_new_ids(store, csv_path):
+    write_csv(csv_path, [make_line(0), make_line(1)])
+    store.import_csv(csv_path)
+    assert store.append_lines([make_line("", output_path="out/a.wav"), make_line("", output_path="out/b.wav")]) == 2
+    assert list(states(store)) == ["0", "1", "2", "3"]
+
+
+def test_appended_path_is_removed_from_older_fanout(store, csv_path):
+    write_csv(csv_path, [make_line(0, output_path="out/a.wav", fanout="out/b.wav|out/c.wav")])
+    store.import_csv(csv_path)
+    store.append_lines([make_line("", text="New text.", output_path="out/b.wav")])
+    assert output_paths(store) == {"0": ("out/a.wav", "out/c.wav"), "1": ("out/b.wav", "")}
+
+
+def test_pending_line_hands_over_its_output_path(store, csv_path):
+    write_csv(csv_path, [make_line(0, output_path="out/a.wav", fanout="out/b.wav|out/c.wav")])
+    store.import_csv(csv_path)
+    store.append_lines([make_line("", text="New text.", output_path="out/a.wav")])
+    assert output_paths(store) == {"0": ("out/b.wav", "out/c.wav"), "1": ("out/a.wav", "")}
+
+
+def test_pending_line_without_paths_left_is_dropped(store, csv_path):
+    write_csv(csv_path, [make_line(0, output_path="out/a.wav", fanout="out/b.wav"), make_line(1)])
+    store.import_csv(csv_path)
+    store.append_lines([make_line("", text="New text.", output_path="out/a.wav", fanout="out/b.wav")])
+    assert list(states(store)) == ["1", "2"]
+
+
+def test_finished_line_keeps_its_output_path(store, csv_path):
+    write_csv(csv_path, [make_line(0, completed="true", output_path="out/a.wav", fanout="out/b.wav")])
+    store.import_csv(csv_path)
+    store.append_lines([make_line("", text="New text.", output_path="out/a.wav", fanout="out/b.wav")])
+    assert output_paths(store) == {"0": ("out/a.wav", ""), "1": ("out/a.wav", "out/b.wav")}
+
+
+def bucket_range(token_count):
+    # buckets of 1-3 and 4+ words, the token counter of the store fixture counts words
+    return (0, 3) if token_count <= 3 else (4, None)
+
+
+@pytest.fixture
+def bucketed_store(store, csv_path):
+    write_csv(csv_path, [make_line(0, text="One two three four five."), make_line(1, text="Hi."),
+                         make_line(2, voice="femalenord", text="Hello."), make_line(3, text="Good day."),
+                         make_line(4, text="Well met, my friend."), make_line(5, text="Yes.")])
+    store.import_csv(csv_path)
+    return store
+
+
+def test_token_counts_are_stored(bucketed_store):
+    counts = dict(bucketed_store._conn.execute(f"SELECT id, token_count FROM {BatchStore.TABLE}").fetchall())
+    assert counts == {"0": 5, "1": 1, "2": 1, "3": 2, "4": 4, "5": 1}
+    bucketed_store.append_lines([make_line("", text="A new line.", output_path="out/new.wav")])
+    assert bucketed_store._conn.execute(f"SELECT token_count FROM {BatchStore.TABLE} WHERE id = '6'").fetchone()[0] == 3
+
+
+def test_claim_group_takes_lines_of_the_voice_and_bucket(bucketed_store):
+    group = bucketed_store.claim_group("worker-1", 60, bucket_range, 2)
+    assert [line['id'] for line in group] == ["0", "4"]
+    assert all(line['completed'] == BatchStore.STATE_ONGOING for line in group)
+    assert "token_count" not in group[0]
+    group = bucketed_store.claim_group("worker-1", 60, bucket_range, 2)
+    assert [line['id'] for line in group] == ["1", "3"]
+    group = bucketed_store.claim_group("worker-1", 60, bucket_range, 2, prefer_voice="femalenord")
+    assert [line['id'] for line in group] == ["2"]
+    assert [line['id'] for line in bucketed_store.claim_group("worker-1", 60, bucket_range, 2)] == ["5"]
+    assert bucketed_store.claim_group("worker-1", 60, bucket_range, 2) == []
+
+
+def test_claim_group_includes_expired_leases(bucketed_store):
+    assert bucketed_store.claim_next("crashed", -1)['id'] == "0"
+    assert bucketed_store.claim_next("worker-1", 60, prefer_voice="femalenord")['id'] == "2"
+    group = bucketed_store.claim_group("worker-2", 60, bucket_range, 4)
+    assert [line['id'] for line in group] == ["0", "4"]
+
+
+def test_claim_group_never_mixes_emotions(store, csv_path):
+    write_csv(csv_path, [make_line(0, text="Hi."), make_line(1, text="Halt!", emotion="anger"),
+                         make_line(2, text="Yes."), make_line(3, text="Die!", emotion="anger")])
+    store.import_csv(csv_path)
+    groups = []
+    while True:
+        group = store.claim_group("worker-1", 60, bucket_range, 4, prefer_voice="malenord")
+        if len(group) == 0:
+            break
+        assert len(set(line['emotion'] for line in group)) == 1
+        groups.append([line['id'] for line in group])
+    assert groups == [["0", "2"], ["1", "3"]]
+
+
+def test_token_counts_are_filled_for_older_stores(tmp_path, csv_path):
+    db_path = str(tmp_path / "old.db")
+    old_store = BatchStore(db_path, COLUMNS)
+    write_csv(csv_path, [make_line(0, text="One two three.")])
+    old_store.import_csv(csv_path)
+    old_store._conn.execute(f"DROP INDEX idx_{BatchStore.TABLE}_group")
+    old_store._conn.execute(f"ALTER TABLE {BatchStore.TABLE} DROP COLUMN token_count")
+    old_store.close()
+
+    upgraded = BatchStore(db_path, COLUMNS, token_counter=lambda text: len(text.split()))
+    try:
+        assert upgraded._conn.execute(f"SELECT token_count FROM {BatchStore.TABLE}").fetchone()[0] == 3
+    finally:
+        upgraded.close()
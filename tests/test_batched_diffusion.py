@@ -0,0 +1,32 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+api = pytest.importorskip("tortoise.api")
+
+LATENT_CHANNELS = 32
+LENGTHS = [23, 9, 16]
+
+
+@pytest.fixture
+def diffusion_model():
+    torch.manual_seed(0)
+    return api.DiffusionTts(model_channels=32, num_layers=2, in_latent_channels=LATENT_CHANNELS, num_heads=2,
+                            layer_drop=0, unconditioned_percentage=0).eval()
+
+
+def test_batched_diffusion_matches_one_candidate_at_a_time(diffusion_model):
+    torch.manual_seed(1)
+    latents = torch.randn(len(LENGTHS), max(LENGTHS), LATENT_CHANNELS)
+    conditioning_latents = torch.randn(1, 2 * diffusion_model.model_channels)
+    diffuser = api.load_discrete_vocoder_diffuser(desired_diffusion_steps=10)
+
+    # With no noise and the deterministic DDIM sampler, the outputs only depend on the model, not on the noise draws.
+    mels, output_lengths = api.do_batched_spectrogram_diffusion(diffusion_model, diffuser, latents, LENGTHS,
+                                                                conditioning_latents, temperature=0, verbose=False,
+                                                                sampler='ddim')
+    for b, (length, output_length) in enumerate(zip(LENGTHS, output_lengths)):
+        mel = api.do_spectrogram_diffusion(diffusion_model, diffuser, latents[b:b+1, :length], conditioning_latents,
+                                           temperature=0, verbose=False, sampler='ddim')
+        assert mel.shape[-1] == output_length
+        torch.testing.assert_close(mels[b:b+1, :, :output_length], mel, atol=1e-4, rtol=1e-4)
+        assert bool((mels[b, :, output_length:] == api.TACOTRON_MEL_MIN).all())
@@ -0,0 +1,57 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from tortoise.utils.convergence import ClvpConvergence
+
+
+def scores(*values):
+    return torch.tensor(values)
+
+
+def test_stops_after_patience_batches_without_improvement():
+    convergence = ClvpConvergence(k=2, max_samples=100, margin=.01, patience=2, min_samples=4)
+    assert not convergence.update(scores(1., 2.))
+    assert convergence.top_score() == pytest.approx(1.5)
+    assert not convergence.update(scores(0., 0.))
+    assert convergence.stalled_batches == 1
+    assert convergence.update(scores(0., 0.))
+
+
+def test_improvement_resets_the_patience():
+    convergence = ClvpConvergence(k=2, max_samples=100, margin=.01, patience=2, min_samples=4)
+    convergence.update(scores(1., 2.))
+    convergence.update(scores(0., 0.))
+    assert not convergence.update(scores(5., 5.))
+    assert convergence.stalled_batches == 0
+    assert convergence.top_score() == pytest.approx(5.)
+    assert not convergence.update(scores(0., 0.))
+    assert convergence.update(scores(0., 0.))
+
+
+def test_improvement_within_margin_counts_as_stalled():
+    convergence = ClvpConvergence(k=1, max_samples=100, margin=.1, patience=1, min_samples=1)
+    convergence.update(scores(10.))
+    assert convergence.update(scores(10.5))
+
+
+def test_first_batches_only_fill_the_top_k():
+    convergence = ClvpConvergence(k=4, max_samples=100, margin=.01, patience=1, min_samples=1)
+    assert not convergence.update(scores(1., 1.))
+    assert not convergence.update(scores(1., 1.))
+    assert convergence.stalled_batches == 0
+    assert convergence.update(scores(0., 0.))
+
+
+def test_min_samples():
+    convergence = ClvpConvergence(k=1, max_samples=100, margin=.01, patience=1, min_samples=6)
+    assert not convergence.update(scores(1., 1.))
+    assert not convergence.update(scores(0., 0.))
+    assert convergence.stalled_batches == 1
+    assert convergence.update(scores(0., 0.))
+
+
+def test_always_stops_at_max_samples():
+    convergence = ClvpConvergence(k=1, max_samples=4, margin=.01, patience=10, min_samples=32)
+    assert convergence.min_samples == 4
+    assert not convergence.update(scores(1., 2.))
+    assert convergence.update(scores(3., 4.))
@@ -0,0 +1,110 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+diffusion = pytest.importorskip("tortoise.utils.diffusion")
+
+TRAINED_STEPS = 1000
+DATA_MEAN, DATA_STD = .3, .5
+
+
+class GaussianDenoiser(torch.nn.Module):
+    """
+    Exact epsilon prediction for data drawn from N(DATA_MEAN, DATA_STD^2), so every sampler has a known target: the
+    samples follow that distribution, and the probability flow ODE maps the noise x_T to DATA_MEAN + DATA_STD * x_T.
+    The second half of the output puts the learned variance at its minimum, the posterior variance.
+    """
+    def __init__(self, alphas_cumprod):
+        super().__init__()
+        self.register_buffer('alphas_cumprod', torch.tensor(alphas_cumprod, dtype=torch.float32))
+
+    def forward(self, x, t):
+        alpha_bar = self.alphas_cumprod[t].view(-1, 1, 1)
+        eps = (1 - alpha_bar).sqrt() * (x - alpha_bar.sqrt() * DATA_MEAN) / (alpha_bar * DATA_STD ** 2 + 1 - alpha_bar)
+        return torch.cat([eps, -torch.ones_like(eps)], dim=1)
+
+
+def make_diffuser(steps):
+    return diffusion.SpacedDiffusion(use_timesteps=diffusion.space_timesteps(TRAINED_STEPS, [steps]),
+                                     model_mean_type='epsilon', model_var_type='learned_range', loss_type='mse',
+                                     betas=diffusion.get_named_beta_schedule('linear', TRAINED_STEPS))
+
+
+@pytest.fixture
+def model():
+    base = diffusion.GaussianDiffusion(betas=diffusion.get_named_beta_schedule('linear', TRAINED_STEPS),
+                                       model_mean_type='epsilon', model_var_type='learned_range', loss_type='mse')
+    return GaussianDenoiser(base.alphas_cumprod)
+
+
+@pytest.fixture
+def noise():
+    torch.manual_seed(0)
+    return torch.randn(1, 1, 20000)
+
+
+def sample(sampler, steps, model, noise, eta=0.0):
+    torch.manual_seed(1)
+    return make_diffuser(steps).sample_loop(sampler, model, noise.shape, eta=eta, noise=noise, clip_denoised=False,
+                                            device='cpu')
+
+
+def ode_solution(noise):
+    alpha_bar = make_diffuser(TRAINED_STEPS).alphas_cumprod[-1]
+    return DATA_MEAN + DATA_STD * (noise - math.sqrt(alpha_bar) * DATA_MEAN) / math.sqrt(alpha_bar * DATA_STD ** 2 +
+                                                                                      1 - alpha_bar)
+
+
+def test_p_sample_matches_the_data_distribution(model, noise):
+    samples = sample('p', 200, model, noise)
+    assert float(samples.mean()) == pytest.approx(DATA_MEAN, abs=.02)
+    assert float(samples.std()) == pytest.approx(DATA_STD, abs=.03)
+
+
+@pytest.mark.parametrize("sampler, steps", [('ddim', 50), ('dpm++2m', 20)])
+def test_deterministic_samplers_follow_the_ode(sampler, steps, model, noise):
+    samples = sample(sampler, steps, model, noise)
+    assert float((samples - ode_solution(noise)).abs().mean()) < .03
+
+
+@pytest.mark.parametrize("sampler, steps, eta", [('ddim', 50, 0.0), ('ddim', 100, 1.0), ('dpm++2m', 20, 0.0)])
+def test_fast_samplers_match_p_sample(sampler, steps, eta, model, noise):
+    reference = sample('p', 200, model, noise)
+    samples = sample(sampler, steps, model, noise, eta=eta)
+    assert float(samples.mean()) == pytest.approx(float(reference.mean()), abs=.02)
+    assert float(samples.std()) == pytest.approx(float(reference.std()), abs=.03)
+
+
+def test_dpm_solver_is_deterministic(model, noise):
+    diffuser = make_diffuser(20)
+    first = diffuser.dpm_solver_sample_loop(model, noise.shape, noise=noise, clip_denoised=False, device='cpu')
+    second = diffuser.dpm_solver_sample_loop(model, noise.shape, noise=noise, clip_denoised=False, device='cpu')
+    assert torch.equal(first, second)
+
+
+def test_unknown_sampler_is_rejected(model, noise):
+    with pytest.raises(AssertionError):
+        sample('euler', 20, model, noise)
+
+
+@pytest.mark.parametrize("padded", [False, True])
+def test_fused_conditioning_free_matches_two_passes(padded):
+    diffusion_decoder = pytest.importorskip("tortoise.models.diffusion_decoder")
+    torch.manual_seed(0)
+    tts_model = diffusion_decoder.DiffusionTts(model_channels=32, num_layers=2, in_latent_channels=32, num_heads=2,
+                                               layer_drop=0, unconditioned_percentage=0).eval()
+    x = torch.randn(2, 100, 40)
+    t = torch.tensor([3, 7])
+    model_kwargs = {'precomputed_aligned_embeddings': torch.randn(2, 32, 40)}
+    if padded:
+        model_kwargs['padding_mask'] = torch.arange(40).unsqueeze(0) < torch.tensor([[40], [25]])
+    diffuser = diffusion.GaussianDiffusion(betas=diffusion.get_named_beta_schedule('linear', TRAINED_STEPS),
+                                           model_mean_type='epsilon', model_var_type='learned_range', loss_type='mse',
+                                           conditioning_free=True, fused_conditioning_free=True)
+    with torch.no_grad():
+        fused, fused_no_conditioning = diffuser._fused_conditioning_free_outputs(tts_model, x, t, model_kwargs)
+        conditioned = tts_model(x, t, **model_kwargs)
+        no_conditioning = tts_model(x, t, conditioning_free=True, **model_kwargs)
+    torch.testing.assert_close(fused, conditioned, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(fused_no_conditioning, no_conditioning, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,82 @@
+import os
+
+import pandas as pd
+
+from skyrim_utils.ImportManifest import ImportManifest
+
+
+def write_dialog(path, content):
+    with open(path, 'w', encoding='utf-8') as dialog_file:
+        dialog_file.write(content)
+    return str(path)
+
+
+def make_rows(texts):
+    return pd.DataFrame([{'quest': "MQ101", 'voice_type': "MaleNord", 'emotion': "Neutral", 'intensity': "50",
+                          'text': text, 'file': f"line{i}.fuz", 'filepath': "sound/voice"}
+                         for i, text in enumerate(texts)])
+
+
+def test_unknown_file_is_changed(tmp_path):
+    manifest = ImportManifest(str(tmp_path / "manifest.json"))
+    dialog = write_dialog(tmp_path / "dialogueExportMQ.txt", "a")
+    assert manifest.is_changed(dialog)
+
+
+def test_recorded_file_is_unchanged(tmp_path):
+    manifest = ImportManifest(str(tmp_path / "manifest.json"))
+    dialog = write_dialog(tmp_path / "dialogueExportMQ.txt", "a")
+    manifest.update(dialog, [])
+    assert not manifest.is_changed(dialog)
+
+
+def test_touched_file_with_same_content_is_unchanged(tmp_path):
+    manifest = ImportManifest(str(tmp_path / "manifest.json"))
+    dialog = write_dialog(tmp_path / "dialogueExportMQ.txt", "a")
+    manifest.update(dialog, [])
+    mtime = os.path.getmtime(dialog) + 10
+    os.utime(dialog, (mtime, mtime))
+    assert not manifest.is_changed(dialog)
+
+
+def test_edited_file_is_changed(tmp_path):
+    manifest = ImportManifest(str(tmp_path / "manifest.json"))
+    dialog = write_dialog(tmp_path / "dialogueExportMQ.txt", "a")
+    manifest.update(dialog, [])
+    stat = os.stat(dialog)
+    # same size and modification time are trusted, the content hash is checked otherwise
+    write_dialog(dialog, "b")
+    os.utime(dialog, (stat.st_atime, stat.st_mtime + 10))
+    assert manifest.is_changed(dialog)
+
+
+def test_removed_sources(tmp_path):
+    manifest = ImportManifest(str(tmp_path / "manifest.json"))
+    first = write_dialog(tmp_path / "dialogueExportMQ.txt", "a")
+    second = write_dialog(tmp_path / "dialogueExportDA.txt", "b")
+    manifest.update(first, [])
+    manifest.update(second, [])
+    assert manifest.removed_sources([first]) == ["dialogueExportDA.txt"]
+
+
+def test_save_and_load(tmp_path):
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = ImportManifest(manifest_path)
+    dialog = write_dialog(tmp_path / "dialogueExportMQ.txt", "a")
+    manifest.update(dialog, ["0011", "0022"])
+    manifest.batched = True
+    manifest.save()
+
+    loaded = ImportManifest.load(manifest_path)
+    assert loaded.batched
+    assert not loaded.is_changed(dialog)
+    assert loaded.get_row_hashes("dialogueExportMQ.txt") == {"0011", "0022"}
+    assert loaded.get_row_hashes("dialogueExportDA.txt") == set()
+
+
+def test_row_hashes_find_modified_rows():
+    before = ImportManifest.row_hashes(make_rows(["Hello.", "Farewell."]))
+    after = ImportManifest.row_hashes(make_rows(["Hello.", "Farewell, friend."]))
+    assert before[0] == after[0]
+    assert before[1] != after[1]
+    assert list(before) == list(ImportManifest.row_hashes(make_rows(["Hello.", "Farewell."])))
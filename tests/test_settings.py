@@ -0,0 +1,17 @@
+from skyrim_utils.Settings import TortoiseApiSettings
+
+
+def test_output_settings_ignore_the_performance_settings():
+    api = TortoiseApiSettings.get_default()
+    tuned = dict(api, use_deepspeed=not api['use_deepspeed'], kv_cache=False, residency_policy='none',
+                 cpu_threads=4, cpu_profile='fp32', pipelined_scoring=True, batch_candidates=True)
+    assert TortoiseApiSettings.output_settings(tuned) == TortoiseApiSettings.output_settings(api)
+
+
+def test_output_settings_keep_the_settings_changing_the_audio():
+    api = TortoiseApiSettings.get_default()
+    for key, value in [('seed', 42), ('cvvp_amount', .5), ('preset', 'fast'), ('half', not api['half']),
+                       ('quantize', True), ('fuse_cond_free', True), ('reuse_latents', True),
+                       ('adaptive_sampling', True), ('fast_sampler', True)]:
+        assert TortoiseApiSettings.output_settings(dict(api, **{key: value})) != \
+            TortoiseApiSettings.output_settings(api), key
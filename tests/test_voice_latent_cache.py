@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+VoiceLatentCache = pytest.importorskip("skyrim_utils.VoiceLatentCache").VoiceLatentCache
+
+
+class FingerprintTts:
+    """
+    Stands for a TextToSpeech loaded with some model weights, for voices given as latents (.pth).
+    """
+    def __init__(self, quantized=False):
+        self.quantized = quantized
+
+    def conditioning_fingerprint(self):
+        return {'autoregressive': "ar-weights", 'diffusion': "diffusion-weights", 'quantized': self.quantized}
+
+
+@pytest.fixture
+def voices_dir(tmp_path):
+    voice_dir = tmp_path / "voices" / "malenord"
+    voice_dir.mkdir(parents=True)
+    torch.save((torch.ones(1, 1024), torch.zeros(1, 2048)), str(voice_dir / "latents.pth"))
+    return str(tmp_path / "voices")
+
+
+def test_latents_key_depends_on_model_fingerprint():
+    fingerprint = FingerprintTts().conditioning_fingerprint()
+    quantized = FingerprintTts(quantized=True).conditioning_fingerprint()
+    assert VoiceLatentCache.latents_key("abc", fingerprint) == VoiceLatentCache.latents_key("abc", dict(fingerprint))
+    assert VoiceLatentCache.latents_key("abc", fingerprint) != VoiceLatentCache.latents_key("abc", quantized)
+    assert VoiceLatentCache.latents_key("abc", fingerprint) != VoiceLatentCache.latents_key("abd", fingerprint)
+
+
+def test_latents_are_saved_with_their_key(tmp_path, voices_dir):
+    cache_dir = str(tmp_path / "latents")
+    cache = VoiceLatentCache(cache_dir, voices_dir=voices_dir)
+    latents = cache.get_latents("malenord", FingerprintTts())
+    assert torch.equal(latents[0], torch.ones(1, 1024))
+
+    expected_key = VoiceLatentCache.latents_key(cache.get_voice_hash("malenord"),
+                                                FingerprintTts().conditioning_fingerprint())
+    content = torch.load(os.path.join(cache_dir, "malenord.pth"))
+    assert content['latents_key'] == expected_key
+    assert os.listdir(cache_dir) == ["malenord.pth"]
+
+    # another process finds the saved latents
+    reloaded = VoiceLatentCache(cache_dir, voices_dir=voices_dir)._load("malenord", expected_key)
+    assert torch.equal(reloaded[1], latents[1])
+
+
+def test_other_model_fingerprint_invalidates_the_latents(tmp_path, voices_dir):
+    cache_dir = str(tmp_path / "latents")
+    cache = VoiceLatentCache(cache_dir, voices_dir=voices_dir)
+    cache.get_latents("malenord", FingerprintTts())
+    voice_hash = cache.get_voice_hash("malenord")
+    quantized_key = VoiceLatentCache.latents_key(voice_hash, FingerprintTts(quantized=True).conditioning_fingerprint())
+    assert cache._load("malenord", quantized_key) is None
+
+    cache.get_latents("malenord", FingerprintTts(quantized=True))
+    assert cache._load("malenord", quantized_key) is not None
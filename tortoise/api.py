@@ -18,11 +18,17 @@ from tortoise.models.clvp import CLVP
 from tortoise.models.cvvp import CVVP
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
-from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, TacotronSTFT
+from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, TacotronSTFT, TACOTRON_MEL_MIN
 from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.residency import ModelResidency
+from tortoise.utils.cpu_profile import CpuProfile
+from tortoise.utils.quantization import load_quantized, checkpoint_fingerprint
+from tortoise.utils.artifacts import ArtifactStore
+from tortoise.utils.convergence import ClvpConvergence
+from tortoise.utils.scoring import ScoringPipeline
+from tortoise.utils.stats import InferenceStats
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
-from contextlib import contextmanager
 from huggingface_hub import hf_hub_download
 pbar = None
 
@@ -62,13 +68,14 @@ def pad_or_truncate(t, length):
         return t[..., :length]
 
 
-def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1):
+def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1,
+                                   fuse_cond_free=False):
     """
     Helper function to load a GaussianDiffusion instance configured for use as a vocoder.
     """
     return SpacedDiffusion(use_timesteps=space_timesteps(trained_diffusion_steps, [desired_diffusion_steps]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
-                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+                           conditioning_free=cond_free, conditioning_free_k=cond_free_k, fused_conditioning_free=fuse_cond_free)
 
 
 def format_conditioning(clip, cond_length=132300, device="cuda" if not torch.backends.mps.is_available() else 'mps'):
@@ -115,9 +122,11 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     return codes
 
 
-def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
+def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True,
+                             sampler='p', eta=0.0):
     """
     Uses the specified diffusion model to convert discrete codes into a spectrogram.
+    :param sampler: One of GaussianDiffusion.SAMPLERS, eta is the stochasticity of the 'ddim' sampler.
     """
     with torch.no_grad():
         output_seq_len = latents.shape[1] * 4 * 24000 // 22050  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
@@ -125,12 +134,61 @@ def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_la
         precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
 
         noise = torch.randn(output_shape, device=latents.device) * temperature
-        mel = diffuser.p_sample_loop(diffusion_model, output_shape, noise=noise,
-                                      model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
-                                     progress=verbose)
+        mel = diffuser.sample_loop(sampler, diffusion_model, output_shape, eta=eta, noise=noise,
+                                   model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
+                                   progress=verbose)
         return denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
 
 
+def do_batched_spectrogram_diffusion(diffusion_model, diffuser, latents, lengths, conditioning_latents, temperature=1,
+                                     verbose=True, sampler='p', eta=0.0):
+    """
+    Converts a batch of latents of different lengths into spectrograms with a single diffusion loop. Row b of latents
+    is valid up to lengths[b]. The rows are padded to the longest one and the diffusion model masks the padding, so
+    each spectrogram is the one do_spectrogram_diffusion() would produce for the row alone, with other noise.
+    :param conditioning_latents: Diffusion conditioning latent shared by all the rows, or one per row.
+    :return: The spectrograms, padded with silence, and their lengths.
+    """
+    with torch.no_grad():
+        output_lengths = [length * 4 * 24000 // 22050 for length in lengths]
+        output_seq_len = max(output_lengths)
+        output_shape = (latents.shape[0], 100, output_seq_len)
+        conditioning_latents = conditioning_latents.expand(latents.shape[0], -1)
+        # The aligned embeddings are normalized and interpolated over the whole sequence, they are computed per row.
+        precomputed_embeddings = []
+        for b, (length, output_length) in enumerate(zip(lengths, output_lengths)):
+            embeddings = diffusion_model.timestep_independent(latents[b:b+1, :length], conditioning_latents[b:b+1],
+                                                              output_length, False)
+            precomputed_embeddings.append(F.pad(embeddings, (0, output_seq_len - output_length)))
+        precomputed_embeddings = torch.cat(precomputed_embeddings, dim=0)
+        padding_mask = torch.arange(output_seq_len, device=latents.device).unsqueeze(0) < \
+            torch.tensor(output_lengths, device=latents.device).unsqueeze(1)
+
+        noise = torch.randn(output_shape, device=latents.device) * temperature
+        mel = diffuser.sample_loop(sampler, diffusion_model, output_shape, eta=eta, noise=noise,
+                                   model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings,
+                                                 'padding_mask': padding_mask},
+                                   progress=verbose)
+        mel = denormalize_tacotron_mel(mel).masked_fill(~padding_mask.unsqueeze(1), TACOTRON_MEL_MIN)
+        return mel, output_lengths
+
+
+def trim_at_calm_tokens(codes, calm_token=83, max_calm_tokens=8):
+    """
+    Returns the number of codes to keep before the first run of more than max_calm_tokens silence tokens, or the full
+    length if there is none. max_calm_tokens gives the diffusion model some "breathing room" to terminate speech.
+    """
+    ctokens = 0
+    for i in range(codes.shape[-1]):
+        if codes[i] == calm_token:
+            ctokens += 1
+        else:
+            ctokens = 0
+        if ctokens > max_calm_tokens:
+            return i
+    return codes.shape[-1]
+
+
 def classify_audio_clip(clip):
     """
     Returns whether or not Tortoises' classifier thinks the given clip came from Tortoise.
@@ -179,7 +237,9 @@ class TextToSpeech:
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
                  enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
-                 tokenizer_vocab_file=None, tokenizer_basic=False):
+                 tokenizer_vocab_file=None, tokenizer_basic=False, residency_policy='lru', residency_budget=None,
+                 residency_idle_seconds=ModelResidency.DEFAULT_IDLE_SECONDS, cpu_profile='auto', cpu_threads=None,
+                 quantize=False):
 
         """
         Constructor
@@ -191,9 +251,21 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param residency_policy: When the models are moved between the CPU and the device, see ModelResidency.POLICIES.
+                                 'lru' (default) keeps the models on the device while they fit in residency_budget,
+                                 'resident' never offloads them, 'idle' offloads them after residency_idle_seconds
+                                 unused and 'per_call' offloads them after each use.
+        :param residency_budget: Bytes of model weights kept on the device by the 'lru' policy. Defaults to a share of
+                                 the device memory on cuda, unlimited on the other devices.
+        :param residency_idle_seconds: Seconds unused after which the 'idle' policy offloads a model.
+        :param cpu_profile: Precision used when the device is the CPU, see CpuProfile.PROFILES. 'auto' (default) uses
+                            bf16 autocast when half is set and the CPU has fast bf16 kernels.
+        :param cpu_threads: Intra-op threads used when the device is the CPU. Defaults to the number of physical cores.
+        :param quantize: When the device is the CPU, converts the Linear layers of the autoregressive model and of the
+                         CLVP to dynamic int8. Faster, at some cost in quality (see quantization_benchmark.py). The
+                         quantized weights are cached in models_dir. Implies the fp32 cpu_profile.
         """
         self.models_dir = models_dir
-        self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
         self.enable_redaction = enable_redaction
         if device is None:
             self.device = torch.device('cuda' if torch.cuda.is_available() else'cpu')
@@ -204,6 +276,24 @@ class TextToSpeech:
             
         if torch.backends.mps.is_available():
             self.device = torch.device('mps')
+        if quantize and self.device.type != 'cpu':
+            print("WARNING: Quantization is only supported on the CPU, ignoring it.")
+        # The int8 layers take fp32 activations, so they cannot run under bf16 autocast.
+        self.quantized = quantize and self.device.type == 'cpu'
+        if self.device.type == 'cpu':
+            self.cpu_profile = CpuProfile('fp32' if self.quantized else cpu_profile, half=half, threads=cpu_threads)
+            print(self.cpu_profile.describe())
+        else:
+            self.cpu_profile = None
+        if autoregressive_batch_size is not None:
+            self.autoregressive_batch_size = autoregressive_batch_size
+        elif self.cpu_profile is not None:
+            self.autoregressive_batch_size = CpuProfile.AUTOREGRESSIVE_BATCH_SIZE
+        else:
+            self.autoregressive_batch_size = pick_best_batch_size_for_gpu()
+        # Tracks which models are on the device, they are all created on the CPU.
+        self.residency = ModelResidency(self.device, policy=residency_policy, budget_bytes=residency_budget,
+                                        idle_seconds=residency_idle_seconds)
         if self.enable_redaction:
             self.aligner = Wav2VecAlignment(cache=models_dir)
 
@@ -212,28 +302,47 @@ class TextToSpeech:
             use_basic_cleaners=tokenizer_basic,
         )
         self.half = half
+        self.kv_cache = kv_cache
+        self.use_deepspeed = use_deepspeed
         if os.path.exists(f'{models_dir}/autoregressive.ptt'):
+            if self.quantized:
+                print("WARNING: Traced models cannot be quantized, the autoregressive model stays in fp32.")
             # Assume this is a traced directory.
-            self.autoregressive = torch.jit.load(f'{models_dir}/autoregressive.ptt')
-            self.diffusion = torch.jit.load(f'{models_dir}/diffusion_decoder.ptt')
+            autoregressive_path = f'{models_dir}/autoregressive.ptt'
+            diffusion_path = f'{models_dir}/diffusion_decoder.ptt'
+            self.autoregressive = torch.jit.load(autoregressive_path)
+            self.diffusion = torch.jit.load(diffusion_path)
         else:
             self.autoregressive = UnifiedVoice(max_mel_tokens=604, max_text_tokens=402, max_conditioning_inputs=2, layers=30,
                                           model_dim=1024,
                                           heads=16, number_text_tokens=255, start_text_token=255, checkpointing=False,
                                           train_solo_embeddings=False).cpu().eval()
-            self.autoregressive.load_state_dict(torch.load(get_model_path('autoregressive.pth', models_dir)), strict=False)
+            autoregressive_path = get_model_path('autoregressive.pth', models_dir)
+            if self.quantized:
+                load_quantized(self.autoregressive, autoregressive_path,
+                               os.path.join(models_dir, 'autoregressive.int8.pth'), strict=False)
+            else:
+                self.autoregressive.load_state_dict(torch.load(autoregressive_path), strict=False)
             self.autoregressive.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=kv_cache, half=self.half)
             
             self.diffusion = DiffusionTts(model_channels=1024, num_layers=10, in_channels=100, out_channels=200,
                                           in_latent_channels=1024, in_tokens=8193, dropout=0, use_fp16=False, num_heads=16,
                                           layer_drop=0, unconditioned_percentage=0).cpu().eval()
-            self.diffusion.load_state_dict(torch.load(get_model_path('diffusion_decoder.pth', models_dir)))
+            diffusion_path = get_model_path('diffusion_decoder.pth', models_dir)
+            self.diffusion.load_state_dict(torch.load(diffusion_path))
+        # The conditioning latents are produced by these two models, see conditioning_fingerprint().
+        self._conditioning_fingerprint = {'autoregressive': checkpoint_fingerprint(autoregressive_path),
+                                          'diffusion': checkpoint_fingerprint(diffusion_path),
+                                          'quantized': self.quantized}
 
         self.clvp = CLVP(dim_text=768, dim_speech=768, dim_latent=768, num_text_tokens=256, text_enc_depth=20,
                          text_seq_len=350, text_heads=12,
                          num_speech_tokens=8192, speech_enc_depth=20, speech_heads=12, speech_seq_len=430,
                          use_xformers=True).cpu().eval()
-        self.clvp.load_state_dict(torch.load(get_model_path('clvp2.pth', models_dir)))
+        if self.quantized:
+            load_quantized(self.clvp, get_model_path('clvp2.pth', models_dir), os.path.join(models_dir, 'clvp2.int8.pth'))
+        else:
+            self.clvp.load_state_dict(torch.load(get_model_path('clvp2.pth', models_dir)))
         self.cvvp = None # CVVP model is only loaded if used.
 
         self.vocoder = UnivNetGenerator().cpu()
@@ -245,19 +354,57 @@ class TextToSpeech:
         # Random latent generators (RLGs) are loaded lazily.
         self.rlg_auto = None
         self.rlg_diffusion = None
-    @contextmanager
+
+        # InferenceStats of the last tts() or tts_batch() call.
+        self.last_stats = None
+
     def temporary_cuda(self, model):
-        m = model.to(self.device)
-        yield m
-        m = model.cpu()
+        """
+        Context manager yielding model on the device. The model is only moved when it is not there yet, and stays on
+        the device afterwards unless the residency policy offloads it.
+        """
+        return self.residency.use(model)
+
+    def reconfigure(self, kv_cache=None, half=None, use_deepspeed=None, residency_policy=None, cpu_profile=None):
+        """
+        Changes the kv_cache, half, use_deepspeed, residency_policy and cpu_profile settings of an already constructed
+        instance without reading the model weights from disk again. Arguments left as None keep their current value.
+        """
+        if residency_policy is not None:
+            self.residency.set_policy(residency_policy)
+        kv_cache = self.kv_cache if kv_cache is None else kv_cache
+        half = self.half if half is None else half
+        if self.cpu_profile is not None:
+            self.cpu_profile.configure('fp32' if self.quantized else cpu_profile, half)
+        use_deepspeed = self.use_deepspeed if use_deepspeed is None else use_deepspeed
+        if (kv_cache, half, use_deepspeed) == (self.kv_cache, self.half, self.use_deepspeed):
+            return
+
+        # Traced models have their inference settings baked in.
+        if hasattr(self.autoregressive, 'post_init_gpt2_config'):
+            if use_deepspeed != self.use_deepspeed or (use_deepspeed and half != self.half):
+                # The DeepSpeed engine is built for a given dtype, so the inference wrapper must be rebuilt.
+                self.autoregressive.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=kv_cache, half=half)
+            else:
+                self.autoregressive.inference_model.kv_cache = kv_cache
+
+        self.kv_cache = kv_cache
+        self.half = half
+        self.use_deepspeed = use_deepspeed
 
-    
     def load_cvvp(self):
         """Load CVVP model."""
         self.cvvp = CVVP(model_dim=512, transformer_heads=8, dropout=0, mel_codes=8192, conditioning_enc_depth=8, cond_mask_percentage=0,
                          speech_enc_depth=8, speech_mask_percentage=0, latent_multiplier=1).cpu().eval()
         self.cvvp.load_state_dict(torch.load(get_model_path('cvvp.pth', self.models_dir)))
 
+    def conditioning_fingerprint(self):
+        """
+        Identifies the weights producing the conditioning latents: the autoregressive and diffusion checkpoints, and
+        whether the autoregressive model is quantized. Latents cached under another fingerprint are outdated.
+        """
+        return dict(self._conditioning_fingerprint)
+
     def get_conditioning_latents(self, voice_samples, return_mels=False):
         """
         Transforms one or more voice_samples into a tuple (autoregressive_conditioning_latent, diffusion_conditioning_latent).
@@ -274,9 +421,8 @@ class TextToSpeech:
             for vs in voice_samples:
                 auto_conds.append(format_conditioning(vs, device=self.device))
             auto_conds = torch.stack(auto_conds, dim=1)
-            self.autoregressive = self.autoregressive.to(self.device)
-            auto_latent = self.autoregressive.get_conditioning(auto_conds)
-            self.autoregressive = self.autoregressive.cpu()
+            with self.temporary_cuda(self.autoregressive) as autoregressive:
+                auto_latent = autoregressive.get_conditioning(auto_conds)
 
             if self.stft is None:
                 # Initialize STFT
@@ -292,9 +438,8 @@ class TextToSpeech:
                 diffusion_conds.append(cond_mel)
             diffusion_conds = torch.stack(diffusion_conds, dim=1)
 
-            self.diffusion = self.diffusion.to(self.device)
-            diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
-            self.diffusion = self.diffusion.cpu()
+            with self.temporary_cuda(self.diffusion) as diffusion:
+                diffusion_latent = diffusion.get_conditioning(diffusion_conds)
 
         if return_mels:
             return auto_latent, diffusion_latent, auto_conds, diffusion_conds
@@ -319,6 +464,15 @@ class TextToSpeech:
             'standard': Very good quality. This is generally about as good as you are going to get.
             'high_quality': Use if you want the absolute best. This is not really worth the compute, though.
         """
+        return self.tts(text, **self._preset_settings(preset, kwargs))
+
+    def tts_batch_with_preset(self, texts, voices, preset='fast', **kwargs):
+        """
+        Calls tts_batch with one of the generation presets of tts_with_preset.
+        """
+        return self.tts_batch(texts, voices, **self._preset_settings(preset, kwargs))
+
+    def _preset_settings(self, preset, kwargs):
         # Use generally found best tuning knobs for generation.
         settings = {'temperature': .8, 'length_penalty': 1.0, 'repetition_penalty': 2.0,
                     'top_p': .8,
@@ -332,7 +486,7 @@ class TextToSpeech:
         }
         settings.update(presets[preset])
         settings.update(kwargs) # allow overriding of preset settings with kwargs
-        return self.tts(text, **settings)
+        return settings
 
     def tts(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
             return_deterministic_state=False,
@@ -341,7 +495,13 @@ class TextToSpeech:
             # CVVP parameters follow
             cvvp_amount=.0,
             # diffusion generation parameters follow
-            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0, fuse_cond_free=False,
+            sampler='p', ddim_eta=0.0,
+            return_stats=False, stats_callback=None, artifact_store=None,
+            # adaptive sampling parameters follow
+            adaptive_sampling=False, adaptive_margin=ClvpConvergence.DEFAULT_MARGIN,
+            adaptive_patience=ClvpConvergence.DEFAULT_PATIENCE, adaptive_min_samples=ClvpConvergence.DEFAULT_MIN_SAMPLES,
+            pipelined_scoring=False, reuse_latents=False, batch_candidates=False,
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -365,6 +525,22 @@ class TextToSpeech:
                                  I was interested in the premise, but the results were not as good as I was hoping. This is off by default, but
                                  could use some tuning.
         :param typical_mass: The typical_mass parameter from the typical_sampling algorithm.
+        :param adaptive_sampling: When true, each batch of autoregressive samples is scored by the CLVP as soon as it is
+                                  generated, and sampling stops before num_autoregressive_samples once the mean of the k
+                                  best scores has not improved by more than adaptive_margin (relative) for
+                                  adaptive_patience batches in a row, after at least adaptive_min_samples samples.
+                                  num_autoregressive_samples is the upper bound. See ClvpConvergence.
+        :param pipelined_scoring: When true, each batch of autoregressive samples is scored by the CLVP (and CVVP) on a
+                                  background thread, on its own cuda stream, while the next batch is sampled. Only the k
+                                  best samples are kept instead of all of them, so the codes and scores checkpoints of
+                                  artifact_store are not written. Can be combined with adaptive_sampling, which then
+                                  stops one batch later. See ScoringPipeline.
+        :param reuse_latents: When true, the final hidden states of the autoregressive model are captured while sampling
+                              and kept for the k best samples so far, so the diffusion latents do not need a second
+                              forward pass of the autoregressive model. The few latents after the stop token come from
+                              the tokens fed during sampling rather than from the calm tokens of the fixed up codes.
+                              Samples too long to be trimmed within their captured latents fall back to the second
+                              pass.
         ~~CLVP-CVVP KNOBS~~
         :param cvvp_amount: Controls the influence of the CVVP model in selecting the best output from the autoregressive model.
                             [0,1]. Values closer to 1 mean the CVVP model is more important, 0 disables the CVVP model.
@@ -381,7 +557,30 @@ class TextToSpeech:
                             Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
+        :param fuse_cond_free: When true, the conditioned and the conditioning-free passes of each diffusion step run as
+                               a single forward of twice the batch instead of two forwards. Faster, especially on
+                               GPUs, at the cost of twice the activation memory of the diffusion.
+        :param sampler: The diffusion sampler, one of GaussianDiffusion.SAMPLERS. 'p' is the ancestral sampler the
+                        presets are tuned for. 'ddim' and 'dpm++2m' (second order multistep DPM-Solver++) give good
+                        results in far fewer diffusion_iterations, 20-50 instead of hundreds.
+        :param ddim_eta: Stochasticity of the 'ddim' sampler. [0,1]. 0 is deterministic given the noise, 1 is close to
+                         the 'p' sampler.
+        :param batch_candidates: When true and k > 1, the k candidates are diffused together in one batch, padded to the
+                                 longest one with the padding masked in the diffusion model, and vocoded together,
+                                 instead of one after the other. Faster on GPUs, at the cost of k times the memory of
+                                 the diffusion. The vocoder sees silence after the shorter candidates, which can slightly
+                                 change their last few milliseconds.
         ~~OTHER STUFF~~
+        :param return_stats: When true, the InferenceStats with the wall time, throughput, peak memory and real time
+                             factor of each stage are returned after the clip(s) (and the deterministic state, if
+                             requested). The stats of the last call are also kept in self.last_stats.
+        :param stats_callback: Callable receiving the InferenceStats when the inference finishes.
+        :param artifact_store: An ArtifactStore where the sampled codes, the CLVP scores and the selected best codes and
+                               latents of this utterance are saved as each stage completes. When the store already
+                               holds the results of a stage computed with the same text, conditioning, seed and
+                               sampling settings, the stages up to it are skipped, so an interrupted run, or a re-roll
+                               of the diffusion with other settings, only redoes the remaining work. With a store, the
+                               diffusion is seeded with the deterministic seed, so resumed runs produce the same audio.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
@@ -389,13 +588,16 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        stats = InferenceStats(self.device, stage_context=self._stage_context())
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
         auto_conds = None
         if voice_samples is not None:
-            auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
+            with stats.stage('conditioning') as stage:
+                auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
+                stage.items += len(voice_samples)
         elif conditioning_latents is not None:
             auto_conditioning, diffusion_conditioning = conditioning_latents
         else:
@@ -403,138 +605,249 @@ class TextToSpeech:
         auto_conditioning = auto_conditioning.to(self.device)
         diffusion_conditioning = diffusion_conditioning.to(self.device)
 
-        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free,
+                                                  cond_free_k=cond_free_k, fuse_cond_free=fuse_cond_free)
+        assert sampler in SpacedDiffusion.SAMPLERS, f"Unknown sampler {sampler}, use one of {SpacedDiffusion.SAMPLERS}"
 
         with torch.no_grad():
             samples = []
             num_batches = num_autoregressive_samples // self.autoregressive_batch_size
             stop_mel_token = self.autoregressive.stop_mel_token
             calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
-            if verbose:
-                print("Generating autoregressive samples..")
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.autoregressive
-                ) as autoregressive, torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.half):
-                    for b in tqdm(range(num_batches), disable=not verbose):
-                        codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                    do_sample=True,
-                                                                    top_p=top_p,
-                                                                    temperature=temperature,
-                                                                    num_return_sequences=self.autoregressive_batch_size,
-                                                                    length_penalty=length_penalty,
-                                                                    repetition_penalty=repetition_penalty,
-                                                                    max_generate_length=max_mel_tokens,
-                                                                    **hf_generate_kwargs)
-                        padding_needed = max_mel_tokens - codes.shape[1]
-                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                        samples.append(codes)
-            else:
-                with self.temporary_cuda(self.autoregressive) as autoregressive:
-                    for b in tqdm(range(num_batches), disable=not verbose):
-                        codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                    do_sample=True,
-                                                                    top_p=top_p,
-                                                                    temperature=temperature,
-                                                                    num_return_sequences=self.autoregressive_batch_size,
-                                                                    length_penalty=length_penalty,
-                                                                    repetition_penalty=repetition_penalty,
-                                                                    max_generate_length=max_mel_tokens,
-                                                                    **hf_generate_kwargs)
-                        padding_needed = max_mel_tokens - codes.shape[1]
-                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                        samples.append(codes)
+            # Stages already completed by a previous run of this utterance are loaded from the artifact store.
+            resume_stage, checkpoint = None, None
+            if artifact_store is not None:
+                fingerprints = ArtifactStore.stage_fingerprints(
+                    text=text, conditioning=auto_conditioning, seed=deterministic_seed,
+                    num_autoregressive_samples=num_autoregressive_samples, batch_size=self.autoregressive_batch_size,
+                    temperature=temperature, length_penalty=length_penalty, repetition_penalty=repetition_penalty,
+                    top_p=top_p, max_mel_tokens=max_mel_tokens, hf_generate_kwargs=hf_generate_kwargs,
+                    cvvp_amount=cvvp_amount, k=k, reuse_latents=reuse_latents,
+                    # a pipelined adaptive sampling stops one batch later
+                    adaptive=(adaptive_margin, adaptive_patience, adaptive_min_samples, pipelined_scoring)
+                    if adaptive_sampling else None)
+                resume_stage, checkpoint = artifact_store.resume(fingerprints)
+                if resume_stage is not None and verbose:
+                    print(f"Resuming from the {resume_stage} checkpoint..")
 
-            clip_results = []
-            
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
-                    device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
-                ):
+            # latents of the best samples captured while sampling, with the number of valid positions of each one
+            captured_latents, captured_lengths = None, None
+            if resume_stage is None and (adaptive_sampling or pipelined_scoring or reuse_latents):
+                if verbose:
+                    print("Generating and scoring autoregressive samples..")
+                convergence = None
+                if adaptive_sampling:
+                    convergence = ClvpConvergence(k, num_autoregressive_samples, margin=adaptive_margin,
+                                                  patience=adaptive_patience, min_samples=adaptive_min_samples)
+                clip_results = []
+                running_best = None
+                with self.temporary_cuda(self.autoregressive) as autoregressive, self.temporary_cuda(
+                    self.clvp
+                ) as clvp, self._autocast():
                     if cvvp_amount > 0:
                         if self.cvvp is None:
                             self.load_cvvp()
-                        self.cvvp = self.cvvp.to(self.device)
-                    if verbose:
-                        if self.cvvp is None:
-                            print("Computing best candidates using CLVP")
-                        else:
-                            print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
-                        for i in range(batch.shape[0]):
-                            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                        if cvvp_amount != 1:
-                            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        if auto_conds is not None and cvvp_amount > 0:
-                            cvvp_accumulator = 0
-                            for cl in range(auto_conds.shape[1]):
-                                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                            cvvp = cvvp_accumulator / auto_conds.shape[1]
-                            if cvvp_amount == 1:
-                                clip_results.append(cvvp)
-                            else:
-                                clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
-                        else:
-                            clip_results.append(clvp_out)
+                        self.residency.load(self.cvvp)
+
+                    def score(batch):
+                        return self._clvp_scores(clvp, text_tokens, batch, auto_conds, cvvp_amount, stop_mel_token)
+                    pipeline = None
+                    if pipelined_scoring:
+                        pipeline = ScoringPipeline(score, k, self.device, self._autocast,
+                                                   should_stop=None if convergence is None else convergence.update)
+                        pipeline.start()
+                    try:
+                        for b in tqdm(range(num_batches), disable=not verbose):
+                            with stats.stage('autoregressive') as stage:
+                                codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                        do_sample=True,
+                                                                        top_p=top_p,
+                                                                        temperature=temperature,
+                                                                        num_return_sequences=self.autoregressive_batch_size,
+                                                                        length_penalty=length_penalty,
+                                                                        repetition_penalty=repetition_penalty,
+                                                                        max_generate_length=max_mel_tokens,
+                                                                        return_latent=reuse_latents,
+                                                                        **hf_generate_kwargs)
+                                extras = ()
+                                if reuse_latents:
+                                    codes, latents = codes
+                                    lengths = torch.full((codes.shape[0],), latents.shape[1], device=codes.device)
+                                    latents = F.pad(latents, (0, 0, 0, max_mel_tokens - latents.shape[1]))
+                                    extras = (latents, lengths)
+                                stage.items += codes.shape[0]
+                                stage.tokens += int((codes != stop_mel_token).sum())
+                                padding_needed = max_mel_tokens - codes.shape[1]
+                                codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                            if pipeline is not None:
+                                # scored on the pipeline thread while the next batch is sampled
+                                pipeline.submit(codes, *extras)
+                                if pipeline.stop_requested():
+                                    break
+                                continue
+                            samples.append(codes)
+                            with stats.stage('clvp') as stage:
+                                clip_results.append(score(codes))
+                                stage.items += codes.shape[0]
+                            if reuse_latents:
+                                # only the latents of the k best samples so far are kept
+                                running_best = self._keep_best(k, running_best, clip_results[-1], codes, *extras)
+                            if convergence is not None and convergence.update(clip_results[-1]):
+                                break
+                    finally:
+                        if pipeline is not None:
+                            pipeline.finish()
+                if verbose and convergence is not None:
+                    print(f"Sampling stopped after {convergence.samples} of {num_autoregressive_samples} samples.")
+                if pipeline is not None:
+                    # only the k best samples were kept
+                    stats.add('clvp', pipeline.wall_time, pipeline.items)
+                    best_results, clip_results, extras = pipeline.best()
+                    if reuse_latents:
+                        captured_latents, captured_lengths = extras
+                    samples = best_results
+                else:
                     clip_results = torch.cat(clip_results, dim=0)
                     samples = torch.cat(samples, dim=0)
                     best_results = samples[torch.topk(clip_results, k=k).indices]
-            else:
-                with self.temporary_cuda(self.clvp) as clvp:
-                    if cvvp_amount > 0:
-                        if self.cvvp is None:
-                            self.load_cvvp()
-                        self.cvvp = self.cvvp.to(self.device)
-                    if verbose:
-                        if self.cvvp is None:
-                            print("Computing best candidates using CLVP")
-                        else:
-                            print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
-                        for i in range(batch.shape[0]):
-                            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                        if cvvp_amount != 1:
-                            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        if auto_conds is not None and cvvp_amount > 0:
-                            cvvp_accumulator = 0
-                            for cl in range(auto_conds.shape[1]):
-                                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                            cvvp = cvvp_accumulator / auto_conds.shape[1]
-                            if cvvp_amount == 1:
-                                clip_results.append(cvvp)
+                    if reuse_latents:
+                        _, best_results, captured_latents, captured_lengths = running_best
+                    if artifact_store is not None:
+                        artifact_store.save(ArtifactStore.STAGE_SCORES, fingerprints, codes=samples, scores=clip_results)
+            elif resume_stage is None:
+                if verbose:
+                    print("Generating autoregressive samples..")
+                if not torch.backends.mps.is_available():
+                    with self.temporary_cuda(self.autoregressive
+                    ) as autoregressive, self._autocast(), stats.stage('autoregressive') as stage:
+                        for b in tqdm(range(num_batches), disable=not verbose):
+                            codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                        do_sample=True,
+                                                                        top_p=top_p,
+                                                                        temperature=temperature,
+                                                                        num_return_sequences=self.autoregressive_batch_size,
+                                                                        length_penalty=length_penalty,
+                                                                        repetition_penalty=repetition_penalty,
+                                                                        max_generate_length=max_mel_tokens,
+                                                                        **hf_generate_kwargs)
+                            stage.items += codes.shape[0]
+                            stage.tokens += int((codes != stop_mel_token).sum())
+                            padding_needed = max_mel_tokens - codes.shape[1]
+                            codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                            samples.append(codes)
+                else:
+                    with self.temporary_cuda(self.autoregressive) as autoregressive, stats.stage('autoregressive') as stage:
+                        for b in tqdm(range(num_batches), disable=not verbose):
+                            codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                        do_sample=True,
+                                                                        top_p=top_p,
+                                                                        temperature=temperature,
+                                                                        num_return_sequences=self.autoregressive_batch_size,
+                                                                        length_penalty=length_penalty,
+                                                                        repetition_penalty=repetition_penalty,
+                                                                        max_generate_length=max_mel_tokens,
+                                                                        **hf_generate_kwargs)
+                            stage.items += codes.shape[0]
+                            stage.tokens += int((codes != stop_mel_token).sum())
+                            padding_needed = max_mel_tokens - codes.shape[1]
+                            codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                            samples.append(codes)
+                if artifact_store is not None:
+                    artifact_store.save(ArtifactStore.STAGE_CODES, fingerprints, codes=torch.cat(samples, dim=0))
+            elif resume_stage == ArtifactStore.STAGE_CODES:
+                samples = list(torch.split(checkpoint['codes'].to(self.device), self.autoregressive_batch_size))
+
+            if resume_stage == ArtifactStore.STAGE_CODES or (resume_stage is None and not (adaptive_sampling or pipelined_scoring)):
+                clip_results = []
+            
+                if not torch.backends.mps.is_available():
+                    with self.temporary_cuda(self.clvp) as clvp, self._autocast(), stats.stage('clvp') as stage:
+                        if cvvp_amount > 0:
+                            if self.cvvp is None:
+                                self.load_cvvp()
+                            self.residency.load(self.cvvp)
+                        if verbose:
+                            if self.cvvp is None:
+                                print("Computing best candidates using CLVP")
                             else:
-                                clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
-                        else:
-                            clip_results.append(clvp_out)
-                    clip_results = torch.cat(clip_results, dim=0)
-                    samples = torch.cat(samples, dim=0)
-                    best_results = samples[torch.topk(clip_results, k=k).indices]
+                                print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
+                        for batch in tqdm(samples, disable=not verbose):
+                            stage.items += batch.shape[0]
+                            clip_results.append(self._clvp_scores(clvp, text_tokens, batch, auto_conds, cvvp_amount,
+                                                                  stop_mel_token))
+                        clip_results = torch.cat(clip_results, dim=0)
+                        samples = torch.cat(samples, dim=0)
+                        best_results = samples[torch.topk(clip_results, k=k).indices]
+                else:
+                    with self.temporary_cuda(self.clvp) as clvp, stats.stage('clvp') as stage:
+                        if cvvp_amount > 0:
+                            if self.cvvp is None:
+                                self.load_cvvp()
+                            self.residency.load(self.cvvp)
+                        if verbose:
+                            if self.cvvp is None:
+                                print("Computing best candidates using CLVP")
+                            else:
+                                print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
+                        for batch in tqdm(samples, disable=not verbose):
+                            stage.items += batch.shape[0]
+                            clip_results.append(self._clvp_scores(clvp, text_tokens, batch, auto_conds, cvvp_amount,
+                                                                  stop_mel_token))
+                        clip_results = torch.cat(clip_results, dim=0)
+                        samples = torch.cat(samples, dim=0)
+                        best_results = samples[torch.topk(clip_results, k=k).indices]
+                if artifact_store is not None:
+                    artifact_store.save(ArtifactStore.STAGE_SCORES, fingerprints, codes=samples, scores=clip_results)
+            elif resume_stage == ArtifactStore.STAGE_SCORES:
+                samples = checkpoint['codes'].to(self.device)
+                clip_results = checkpoint['scores'].to(self.device)
+                best_results = samples[torch.topk(clip_results, k=k).indices]
+            elif resume_stage == ArtifactStore.STAGE_BEST:
+                samples = None
+                best_results = checkpoint['codes'].to(self.device)
+
             if self.cvvp is not None:
-                self.cvvp = self.cvvp.cpu()
+                self.residency.release(self.cvvp)
             del samples
 
-            # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
-            # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(
-                    self.autoregressive
-                ) as autoregressive, torch.autocast(
-                    device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
-                ):
-                    best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                                    torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                                    return_latent=True, clip_inputs=False)
-                    del auto_conditioning
+            if captured_latents is not None and self._captured_latents_cover(best_results, captured_lengths, calm_token):
+                best_latents = captured_latents
+                del auto_conditioning
+                if artifact_store is not None:
+                    artifact_store.save(ArtifactStore.STAGE_BEST, fingerprints, codes=best_results, latents=best_latents)
+            elif resume_stage != ArtifactStore.STAGE_BEST:
+                # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
+                # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
+                # results, but will increase memory usage.
+                if not torch.backends.mps.is_available():
+                    with self.temporary_cuda(
+                        self.autoregressive
+                    ) as autoregressive, self._autocast(), stats.stage('latents') as stage:
+                        best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                        torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                        return_latent=True, clip_inputs=False)
+                        stage.items += best_latents.shape[0]
+                        del auto_conditioning
+                else:
+                    with self.temporary_cuda(
+                        self.autoregressive
+                    ) as autoregressive, stats.stage('latents') as stage:
+                        best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                        torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                        return_latent=True, clip_inputs=False)
+                        stage.items += best_latents.shape[0]
+                        del auto_conditioning
+                if artifact_store is not None:
+                    artifact_store.save(ArtifactStore.STAGE_BEST, fingerprints, codes=best_results, latents=best_latents)
             else:
-                with self.temporary_cuda(
-                    self.autoregressive
-                ) as autoregressive:
-                    best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                                    torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                                    return_latent=True, clip_inputs=False)
-                    del auto_conditioning
+                best_latents = checkpoint['latents'].to(self.device)
+                del auto_conditioning
+
+            if artifact_store is not None:
+                # The diffusion noise must not depend on the stages skipped by a resumed run.
+                torch.manual_seed(deterministic_seed)
 
             if verbose:
                 print("Transforming autoregressive outputs into audio..")
@@ -543,9 +856,49 @@ class TextToSpeech:
                 with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
                     self.vocoder
                 ) as vocoder:
+                    if batch_candidates and best_results.shape[0] > 1:
+                        wav_candidates = self._diffuse_candidates(diffusion, vocoder, diffuser, best_results, best_latents,
+                                                                  diffusion_conditioning, calm_token,
+                                                                  diffusion_temperature, sampler, ddim_eta, verbose,
+                                                                  stats)
+                    else:
+                        for b in range(best_results.shape[0]):
+                            codes = best_results[b].unsqueeze(0)
+                            latents = best_latents[b].unsqueeze(0)
+
+                            # Find the first occurrence of the "calm" token and trim the codes to that.
+                            ctokens = 0
+                            for k in range(codes.shape[-1]):
+                                if codes[0, k] == calm_token:
+                                    ctokens += 1
+                                else:
+                                    ctokens = 0
+                                if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+                                    latents = latents[:, :k]
+                                    break
+                            with stats.stage('diffusion') as stage:
+                                mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
+                                                            verbose=verbose, sampler=sampler, eta=ddim_eta)
+                                stage.items += 1
+                            with stats.stage('vocoder') as stage:
+                                wav = vocoder.inference(mel)
+                                stage.items += 1
+                            wav_candidates.append(wav.cpu())
+            else:
+                # The diffusion and the vocoder run on the CPU on mps, get_conditioning_latents() may have moved the
+                # diffusion model to the device.
+                self.residency.offload(self.diffusion)
+                self.residency.offload(self.vocoder)
+                diffusion, vocoder = self.diffusion, self.vocoder
+                diffusion_conditioning = diffusion_conditioning.cpu()
+                if batch_candidates and best_results.shape[0] > 1:
+                    wav_candidates = self._diffuse_candidates(diffusion, vocoder, diffuser, best_results,
+                                                              best_latents.cpu(), diffusion_conditioning, calm_token,
+                                                              diffusion_temperature, sampler, ddim_eta, verbose, stats)
+                else:
                     for b in range(best_results.shape[0]):
-                        codes = best_results[b].unsqueeze(0)
-                        latents = best_latents[b].unsqueeze(0)
+                        codes = best_results[b].unsqueeze(0).cpu()
+                        latents = best_latents[b].unsqueeze(0).cpu()
 
                         # Find the first occurrence of the "calm" token and trim the codes to that.
                         ctokens = 0
@@ -557,47 +910,326 @@ class TextToSpeech:
                             if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
                                 latents = latents[:, :k]
                                 break
-                        mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                    verbose=verbose)
-                        wav = vocoder.inference(mel)
+                        with stats.stage('diffusion') as stage:
+                            mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
+                                                        verbose=verbose, sampler=sampler, eta=ddim_eta)
+                            stage.items += 1
+                        with stats.stage('vocoder') as stage:
+                            wav = vocoder.inference(mel)
+                            stage.items += 1
                         wav_candidates.append(wav.cpu())
-            else:
-                diffusion, vocoder = self.diffusion, self.vocoder
-                diffusion_conditioning = diffusion_conditioning.cpu()
-                for b in range(best_results.shape[0]):
-                    codes = best_results[b].unsqueeze(0).cpu()
-                    latents = best_latents[b].unsqueeze(0).cpu()
-
-                    # Find the first occurrence of the "calm" token and trim the codes to that.
-                    ctokens = 0
-                    for k in range(codes.shape[-1]):
-                        if codes[0, k] == calm_token:
-                            ctokens += 1
-                        else:
-                            ctokens = 0
-                        if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                            latents = latents[:, :k]
-                            break
-                    mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                verbose=verbose)
-                    wav = vocoder.inference(mel)
-                    wav_candidates.append(wav.cpu())
 
             def potentially_redact(clip, text):
                 if self.enable_redaction:
                     return self.aligner.redact(clip.squeeze(1), text).unsqueeze(1)
                 return clip
-            wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+            if self.enable_redaction:
+                with stats.stage('redaction') as stage:
+                    wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+                    stage.items += len(wav_candidates)
 
             if len(wav_candidates) > 1:
                 res = wav_candidates
             else:
                 res = wav_candidates[0]
 
+            self._finish_stats(stats, wav_candidates, verbose, stats_callback)
+            outputs = (res,)
             if return_deterministic_state:
-                return res, (deterministic_seed, text, voice_samples, conditioning_latents)
+                outputs += ((deterministic_seed, text, voice_samples, conditioning_latents),)
+            if return_stats:
+                outputs += (stats,)
+            return outputs if len(outputs) > 1 else res
+
+    def tts_batch(self, texts, voices, k=1, verbose=True, use_deterministic_seed=None, return_deterministic_state=False,
+                  utterances_per_batch=None,
+                  # autoregressive generation parameters follow
+                  num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8,
+                  max_mel_tokens=500,
+                  # diffusion generation parameters follow
+                  diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+                  fuse_cond_free=False, sampler='p', ddim_eta=0.0, return_stats=False, stats_callback=None, artifact_stores=None,
+                  **hf_generate_kwargs):
+        """
+        Produces audio clips for several texts at once. The utterances are packed in shared batches for the
+        autoregressive sampling, the CLVP scoring, the latent extraction, the diffusion and the vocoder, and each one
+        gets the same result it would get from tts() with the same arguments (CVVP is not supported). The candidates are
+        diffused and vocoded in batches of similar lengths padded to the longest one, as tts() does with
+        batch_candidates.
+        :param texts: List of texts to be spoken.
+        :param voices: List with one conditioning latents tuple (autoregressive_conditioning_latent,
+                       diffusion_conditioning_latent) per text, or a single tuple used by all the texts. A list of
+                       voice samples can be given in place of a tuple.
+        :param k: The number of returned clips per text, an int or a list with one value per text.
+        :param utterances_per_batch: How many texts are sampled together by each autoregressive batch, each one
+                                     contributing autoregressive_batch_size rows. Default is all of them.
+        :param artifact_stores: List with one ArtifactStore (or None) per text, where the CLVP scores and the best codes
+                                and latents of the text are saved. They are not read back: tts() resumes from them.
+        The other parameters are the same as tts(). The stats cover the whole batch.
+        :return: A list with the result of each text, with the same format returned by tts().
+        """
+        deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        stats = InferenceStats(self.device, stage_context=self._stage_context())
+        n_texts = len(texts)
+        ks = list(k) if isinstance(k, (list, tuple)) else [k] * n_texts
+        if isinstance(voices, tuple):
+            voices = [voices] * n_texts
+        assert len(voices) == n_texts and len(ks) == n_texts, 'One voice and one k must be given for each text.'
+
+        # the trailing 0 token is kept for parity with tts()
+        text_tokens = [torch.IntTensor(self.tokenizer.encode(text) + [0]) for text in texts]
+        for tokens in text_tokens:
+            assert tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+        text_lengths = torch.tensor([tokens.shape[-1] for tokens in text_tokens], device=self.device)
+        padded_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True).to(self.device)
+
+        latents_cache = {}
+        auto_conditioning = []
+        diffusion_conditioning = []
+        for voice in voices:
+            if not isinstance(voice, tuple):
+                # voice samples, computed once per distinct list
+                if id(voice) not in latents_cache:
+                    with stats.stage('conditioning') as stage:
+                        latents_cache[id(voice)] = self.get_conditioning_latents(voice)
+                        stage.items += len(voice)
+                voice = latents_cache[id(voice)]
+            auto_conditioning.append(voice[0].to(self.device).reshape(1, -1))
+            diffusion_conditioning.append(voice[1].to(self.device).reshape(1, -1))
+        auto_conditioning = torch.cat(auto_conditioning, dim=0)
+        diffusion_conditioning = torch.cat(diffusion_conditioning, dim=0)
+
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free,
+                                                  cond_free_k=cond_free_k, fuse_cond_free=fuse_cond_free)
+        assert sampler in SpacedDiffusion.SAMPLERS, f"Unknown sampler {sampler}, use one of {SpacedDiffusion.SAMPLERS}"
+        stop_mel_token = self.autoregressive.stop_mel_token
+        calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+        num_batches = num_autoregressive_samples // self.autoregressive_batch_size
+        utterances_per_batch = n_texts if utterances_per_batch is None else max(1, utterances_per_batch)
+        groups = [list(range(i, min(i + utterances_per_batch, n_texts))) for i in range(0, n_texts, utterances_per_batch)]
+
+        with torch.no_grad():
+            # Autoregressive sampling and CLVP scoring, autoregressive_batch_size rows per utterance in each batch.
+            samples = [[] for _ in range(n_texts)]
+            clip_results = [[] for _ in range(n_texts)]
+            if verbose:
+                print(f"Generating autoregressive samples for {n_texts} texts..")
+            with self.temporary_cuda(self.autoregressive) as autoregressive, self._autocast(), \
+                    stats.stage('autoregressive') as stage:
+                for b in tqdm(range(num_batches), disable=not verbose):
+                    for group in groups:
+                        max_len = int(text_lengths[group].max())
+                        codes = autoregressive.inference_speech(auto_conditioning[group], padded_tokens[group, :max_len],
+                                                                text_lengths=text_lengths[group],
+                                                                do_sample=True,
+                                                                top_p=top_p,
+                                                                temperature=temperature,
+                                                                num_return_sequences=self.autoregressive_batch_size,
+                                                                length_penalty=length_penalty,
+                                                                repetition_penalty=repetition_penalty,
+                                                                max_generate_length=max_mel_tokens,
+                                                                **hf_generate_kwargs)
+                        stage.items += codes.shape[0]
+                        stage.tokens += int((codes != stop_mel_token).sum())
+                        padding_needed = max_mel_tokens - codes.shape[1]
+                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                        for i in range(codes.shape[0]):
+                            codes[i] = fix_autoregressive_output(codes[i], stop_mel_token)
+                        # generate() returns the rows of each input grouped together
+                        for j, t in enumerate(group):
+                            samples[t].append(codes[j * self.autoregressive_batch_size:(j + 1) * self.autoregressive_batch_size])
+
+            if verbose:
+                print("Computing best candidates using CLVP")
+            with self.temporary_cuda(self.clvp) as clvp, self._autocast(), stats.stage('clvp') as stage:
+                for b in tqdm(range(num_batches), disable=not verbose):
+                    for group in groups:
+                        batch = torch.cat([samples[t][b] for t in group], dim=0)
+                        stage.items += batch.shape[0]
+                        rows = torch.tensor(group, device=self.device).repeat_interleave(self.autoregressive_batch_size)
+                        max_len = int(text_lengths[group].max())
+                        clvp_out = clvp(padded_tokens[rows, :max_len], batch, return_loss=False,
+                                        text_lengths=text_lengths[rows])
+                        for j, t in enumerate(group):
+                            clip_results[t].append(clvp_out[j * self.autoregressive_batch_size:(j + 1) * self.autoregressive_batch_size])
+            fingerprints = [None] * n_texts
+            if artifact_stores is not None:
+                for t in range(n_texts):
+                    if artifact_stores[t] is not None:
+                        fingerprints[t] = ArtifactStore.stage_fingerprints(
+                            text=texts[t], conditioning=auto_conditioning[t:t + 1], seed=deterministic_seed,
+                            num_autoregressive_samples=num_autoregressive_samples,
+                            batch_size=self.autoregressive_batch_size, temperature=temperature,
+                            length_penalty=length_penalty, repetition_penalty=repetition_penalty, top_p=top_p,
+                            max_mel_tokens=max_mel_tokens, hf_generate_kwargs=hf_generate_kwargs, cvvp_amount=.0,
+                            k=ks[t])
+            best_results = []
+            for t in range(n_texts):
+                utterance_samples = torch.cat(samples[t], dim=0)
+                utterance_scores = torch.cat(clip_results[t], dim=0)
+                best_results.append(utterance_samples[torch.topk(utterance_scores, k=ks[t]).indices])
+                if fingerprints[t] is not None:
+                    artifact_stores[t].save(ArtifactStore.STAGE_SCORES, fingerprints[t], codes=utterance_samples,
+                                            scores=utterance_scores)
+            del samples
+
+            # Latents of the best results, batched over the utterances with the same text length, since the
+            # autoregressive forward pass has no padding mask.
+            best_latents = [None] * n_texts
+            with self.temporary_cuda(self.autoregressive) as autoregressive, self._autocast(), \
+                    stats.stage('latents') as stage:
+                for length in sorted(set(text_lengths.tolist())):
+                    same_length = [t for t in range(n_texts) if int(text_lengths[t]) == length]
+                    rows = torch.tensor(same_length, device=self.device).repeat_interleave(
+                        torch.tensor([ks[t] for t in same_length], device=self.device))
+                    codes = torch.cat([best_results[t] for t in same_length], dim=0)
+                    latents = autoregressive(auto_conditioning[rows], padded_tokens[rows, :length],
+                                             torch.tensor([length], device=self.device), codes,
+                                             torch.tensor([codes.shape[-1]*self.autoregressive.mel_length_compression], device=self.device),
+                                             return_latent=True, clip_inputs=False)
+                    stage.items += latents.shape[0]
+                    start = 0
+                    for t in same_length:
+                        best_latents[t] = latents[start:start + ks[t]]
+                        start += ks[t]
+                        if fingerprints[t] is not None:
+                            artifact_stores[t].save(ArtifactStore.STAGE_BEST, fingerprints[t], codes=best_results[t],
+                                                    latents=best_latents[t])
+
+            # Diffusion and vocoder, batched over the candidates trimmed at their silence. The candidates are sorted by
+            # length, so each batch is padded to the longest of candidates of similar lengths, and the diffusion model
+            # masks the padding.
+            if verbose:
+                print("Transforming autoregressive outputs into audio..")
+            candidates = []
+            for t in range(n_texts):
+                codes = best_results[t].cpu()
+                for c in range(ks[t]):
+                    candidates.append((trim_at_calm_tokens(codes[c], calm_token), t, c))
+            candidates.sort()
+            wav_candidates = [[None] * ks[t] for t in range(n_texts)]
+            if not torch.backends.mps.is_available():
+                with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(self.vocoder) as vocoder:
+                    self._diffuse_batches(diffusion, vocoder, diffuser, candidates, best_latents, diffusion_conditioning,
+                                          wav_candidates, diffusion_temperature, sampler, ddim_eta, verbose, stats)
             else:
-                return res
+                # The diffusion and the vocoder run on the CPU on mps, as in tts().
+                self.residency.offload(self.diffusion)
+                self.residency.offload(self.vocoder)
+                best_latents = [latents.cpu() for latents in best_latents]
+                diffusion_conditioning = diffusion_conditioning.cpu()
+                self._diffuse_batches(self.diffusion, self.vocoder, diffuser, candidates, best_latents,
+                                      diffusion_conditioning, wav_candidates, diffusion_temperature, sampler, ddim_eta,
+                                      verbose, stats)
+
+            results = []
+            for t in range(n_texts):
+                clips = wav_candidates[t]
+                if self.enable_redaction:
+                    with stats.stage('redaction') as stage:
+                        clips = [self.aligner.redact(clip.squeeze(1), texts[t]).unsqueeze(1) for clip in clips]
+                        stage.items += len(clips)
+                wav_candidates[t] = clips
+                results.append(clips if len(clips) > 1 else clips[0])
+
+            self._finish_stats(stats, [clip for clips in wav_candidates for clip in clips], verbose, stats_callback)
+            outputs = (results,)
+            if return_deterministic_state:
+                outputs += ((deterministic_seed, texts, voices),)
+            if return_stats:
+                outputs += (stats,)
+            return outputs if len(outputs) > 1 else results
+
+    def _finish_stats(self, stats, clips, verbose, stats_callback):
+        stats.finish(sum(clip.shape[-1] for clip in clips) / 24000)
+        self.last_stats = stats
+        if verbose:
+            print(stats.summary())
+        if stats_callback is not None:
+            stats_callback(stats)
+
+    def _clvp_scores(self, clvp, text_tokens, batch, auto_conds, cvvp_amount, stop_mel_token):
+        # Fixes the padding of the codes of batch in place and returns their CLVP scores, blended with the CVVP scores
+        # when cvvp_amount > 0 and the voice samples are known.
+        for i in range(batch.shape[0]):
+            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
+        if cvvp_amount != 1:
+            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
+        if auto_conds is not None and cvvp_amount > 0:
+            cvvp_accumulator = 0
+            for cl in range(auto_conds.shape[1]):
+                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
+            cvvp = cvvp_accumulator / auto_conds.shape[1]
+            if cvvp_amount == 1:
+                return cvvp
+            return cvvp * cvvp_amount + clvp_out * (1-cvvp_amount)
+        return clvp_out
+
+    @staticmethod
+    def _keep_best(k, best, scores, *tensors):
+        # Returns the scores and the rows of tensors of the k best samples, best first, among the ones of best (the
+        # result of a previous call, or None) and a new batch.
+        if best is not None:
+            scores = torch.cat([best[0], scores])
+            tensors = [torch.cat([previous, tensor]) for previous, tensor in zip(best[1:], tensors)]
+        indices = torch.topk(scores, k=min(k, scores.shape[0])).indices
+        return (scores[indices],) + tuple(tensor[indices] for tensor in tensors)
+
+    def _diffuse_batches(self, diffusion, vocoder, diffuser, candidates, best_latents, diffusion_conditioning,
+                         wav_candidates, temperature, sampler, eta, verbose, stats):
+        # Diffuses and vocodes the (trimmed length, text, candidate) candidates of tts_batch() sorted by length, in
+        # batches of autoregressive_batch_size, and stores their clips in wav_candidates[text][candidate].
+        for start in range(0, len(candidates), self.autoregressive_batch_size):
+            chunk = candidates[start:start + self.autoregressive_batch_size]
+            lengths = [length for length, _, _ in chunk]
+            # the codes of different texts have different lengths, the latents are zero padded
+            latents = torch.stack([F.pad(best_latents[t][c, :length], (0, 0, 0, max(lengths) - length))
+                                   for length, t, c in chunk], dim=0)
+            conditioning = diffusion_conditioning[[t for _, t, _ in chunk]]
+            with stats.stage('diffusion') as stage:
+                mel, mel_lengths = do_batched_spectrogram_diffusion(diffusion, diffuser, latents, lengths, conditioning,
+                                                                    temperature=temperature, verbose=verbose,
+                                                                    sampler=sampler, eta=eta)
+                stage.items += len(chunk)
+            with stats.stage('vocoder') as stage:
+                wavs = vocoder.inference(mel)
+                stage.items += len(chunk)
+            for j, (_, t, c) in enumerate(chunk):
+                wav_candidates[t][c] = wavs[j:j + 1, :, :mel_lengths[j] * vocoder.hop_length].cpu()
+
+    @staticmethod
+    def _diffuse_candidates(diffusion, vocoder, diffuser, codes, latents, diffusion_conditioning, calm_token,
+                            temperature, sampler, eta, verbose, stats):
+        # Diffuses and vocodes all the candidates in one batch, each trimmed at its calm tokens, and returns their clips.
+        codes = codes.cpu()
+        lengths = [trim_at_calm_tokens(codes[b], calm_token) for b in range(codes.shape[0])]
+        with stats.stage('diffusion') as stage:
+            mel, mel_lengths = do_batched_spectrogram_diffusion(diffusion, diffuser, latents[:, :max(lengths)], lengths,
+                                                                diffusion_conditioning, temperature=temperature,
+                                                                verbose=verbose, sampler=sampler, eta=eta)
+            stage.items += len(lengths)
+        with stats.stage('vocoder') as stage:
+            wavs = vocoder.inference(mel)
+            stage.items += len(lengths)
+        return [wavs[b:b+1, :, :mel_lengths[b] * vocoder.hop_length].cpu() for b in range(len(lengths))]
+
+    @staticmethod
+    def _captured_latents_cover(codes, lengths, calm_token):
+        # True when the latents captured for each sample reach the position where the diffusion trims it.
+        codes = codes.cpu()
+        return all(trim_at_calm_tokens(codes[b], calm_token) <= int(lengths[b]) for b in range(codes.shape[0]))
+
+    def _stage_context(self):
+        # Per stage thread counts on the CPU.
+        return self.cpu_profile.stage if self.cpu_profile is not None else None
+
+    def _autocast(self):
+        # Half precision on cuda devices, bf16 on the CPU when the profile enables it, disabled on mps.
+        if self.cpu_profile is not None:
+            return self.cpu_profile.autocast()
+        return torch.autocast(device_type="cuda", dtype=torch.float16,
+                              enabled=self.half and not torch.backends.mps.is_available())
+
     def deterministic_state(self, seed=None):
         """
         Sets the random seeds that tortoise uses to the current time() and returns that seed so results can be
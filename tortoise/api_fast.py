@@ -21,6 +21,7 @@ from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
 from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.stats import InferenceStats
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
 from contextlib import contextmanager
@@ -227,6 +228,10 @@ class TextToSpeech:
         self.hifi_decoder.load_state_dict(hifi_model, strict=False)
         # Random latent generators (RLGs) are loaded lazily.
         self.rlg_auto = None
+
+        # InferenceStats of the last tts() or tts_stream() call.
+        self.last_stats = None
+
     def get_conditioning_latents(self, voice_samples, return_mels=False):
         """
         Transforms one or more voice_samples into a tuple (autoregressive_conditioning_latent, diffusion_conditioning_latent).
@@ -316,6 +321,7 @@ class TextToSpeech:
             cvvp_amount=.0,
             # diffusion generation parameters follow
             diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            stats_callback=None,
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -349,6 +355,8 @@ class TextToSpeech:
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
         ~~OTHER STUFF~~
+        :param stats_callback: Callable receiving the InferenceStats with the wall time, throughput, peak memory and real
+                               time factor of each stage when the stream ends. They are also kept in self.last_stats.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
@@ -356,12 +364,15 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        stats = InferenceStats(self.device)
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
         if voice_samples is not None:
-            auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+            with stats.stage('conditioning') as stage:
+                auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+                stage.items += len(voice_samples)
         else:
             auto_conditioning  = self.get_random_conditioning_latents()
         auto_conditioning = auto_conditioning.to(self.device)
@@ -397,33 +408,45 @@ class TextToSpeech:
             wav_overlap = None
             is_end = False
             first_buffer = 60
+            audio_samples = 0
             while not is_end:
                 try:
                     with torch.autocast(
                         device_type="cuda", dtype=torch.float16, enabled=self.half
-                    ):
+                    ), stats.stage('autoregressive') as stage:
                         codes, latent = next(gpt_generator)
                         all_latents += [latent]
                         codes_ += [codes]
+                        stage.tokens += 1
                 except StopIteration:
                     is_end = True
 
                 if is_end or (stream_chunk_size > 0 and len(codes_) >= max(stream_chunk_size, first_buffer)):
                     first_buffer = 0
                     gpt_latents = torch.cat(all_latents, dim=0)[None, :]
-                    wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+                    with stats.stage('vocoder') as stage:
+                        wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+                        stage.items += 1
                     wav_gen = wav_gen.squeeze()
                     wav_chunk, wav_gen_prev, wav_overlap = self.handle_chunks(
                         wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len
                     )
                     codes_ = []
+                    audio_samples += wav_chunk.shape[-1]
                     yield wav_chunk
+            stats.finish(audio_samples / 24000)
+            self.last_stats = stats
+            if verbose:
+                print(stats.summary())
+            if stats_callback is not None:
+                stats_callback(stats)
     def tts(self, text, voice_samples=None, k=1, verbose=True, use_deterministic_seed=None,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, 
             top_p=.8, max_mel_tokens=500,
             # CVVP parameters follow
             cvvp_amount=.0,
+            return_stats=False, stats_callback=None,
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -457,6 +480,9 @@ class TextToSpeech:
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
         ~~OTHER STUFF~~
+        :param return_stats: When true, returns the InferenceStats with the wall time, throughput, peak memory and real
+                             time factor of each stage after the clip. They are also kept in self.last_stats.
+        :param stats_callback: Callable receiving the InferenceStats when the inference finishes.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
@@ -464,12 +490,15 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        stats = InferenceStats(self.device)
 
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
         if voice_samples is not None:
-            auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+            with stats.stage('conditioning') as stage:
+                auto_conditioning = self.get_conditioning_latents(voice_samples, return_mels=False)
+                stage.items += len(voice_samples)
         else:
             auto_conditioning  = self.get_random_conditioning_latents()
         auto_conditioning = auto_conditioning.to(self.device)
@@ -480,7 +509,7 @@ class TextToSpeech:
                 print("Generating autoregressive samples..")
             with torch.autocast(
                     device_type="cuda" , dtype=torch.float16, enabled=self.half
-                ):
+                ), stats.stage('autoregressive') as stage:
                 codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
                                                             top_k=50,
                                                             top_p=top_p,
@@ -493,13 +522,29 @@ class TextToSpeech:
                                                             output_attentions=False,
                                                             output_hidden_states=True,
                                                             **hf_generate_kwargs)
+                stage.items += codes.shape[0]
+                stage.tokens += int((codes != self.autoregressive.stop_mel_token).sum())
+            with torch.autocast(
+                    device_type="cuda" , dtype=torch.float16, enabled=self.half
+                ), stats.stage('latents') as stage:
                 gpt_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
                                 torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
                                 torch.tensor([codes.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
                                 return_latent=True, clip_inputs=False)
+                stage.items += gpt_latents.shape[0]
             if verbose:
                 print("generating audio..")
-            wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+            with stats.stage('vocoder') as stage:
+                wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+                stage.items += wav_gen.shape[0]
+            stats.finish(wav_gen.shape[-1] * wav_gen.shape[0] / 24000)
+            self.last_stats = stats
+            if verbose:
+                print(stats.summary())
+            if stats_callback is not None:
+                stats_callback(stats)
+            if return_stats:
+                return wav_gen, stats
             return wav_gen
     def deterministic_state(self, seed=None):
         """
@@ -19,8 +19,21 @@ def zero_module(module):
 
 
 class GroupNorm32(nn.GroupNorm):
-    def forward(self, x):
-        return super().forward(x.float()).type(x.dtype)
+    def forward(self, x, padding_mask=None):
+        if padding_mask is None:
+            return super().forward(x.float()).type(x.dtype)
+        # The statistics only cover the valid positions of padding_mask ([N x T] bools), the padding is zeroed.
+        h = x.float()
+        b, c, t = h.shape
+        mask = padding_mask.reshape(b, 1, 1, t).float()
+        groups = h.reshape(b, self.num_groups, c // self.num_groups, t)
+        count = mask.sum(dim=-1, keepdim=True).clamp(min=1) * (c // self.num_groups)
+        mean = (groups * mask).sum(dim=(2, 3), keepdim=True) / count
+        var = (((groups - mean) * mask) ** 2).sum(dim=(2, 3), keepdim=True) / count
+        h = ((groups - mean) / torch.sqrt(var + self.eps)).reshape(b, c, t)
+        if self.affine:
+            h = h * self.weight.reshape(1, c, 1) + self.bias.reshape(1, c, 1)
+        return h.masked_fill(~padding_mask.unsqueeze(1), 0).type(x.dtype)
 
 
 def normalization(channels):
@@ -50,11 +63,13 @@ class QKVAttentionLegacy(nn.Module):
         super().__init__()
         self.n_heads = n_heads
 
-    def forward(self, qkv, mask=None, rel_pos=None):
+    def forward(self, qkv, mask=None, rel_pos=None, padding_mask=None):
         """
         Apply QKV attention.
 
         :param qkv: an [N x (H * 3 * C) x T] tensor of Qs, Ks, and Vs.
+        :param padding_mask: an optional [N x T] bool tensor of the valid positions. The other keys are excluded before
+                             the softmax.
         :return: an [N x (H * C) x T] tensor after attention.
         """
         bs, width, length = qkv.shape
@@ -67,6 +82,10 @@ class QKVAttentionLegacy(nn.Module):
         )  # More stable with f16 than dividing afterwards
         if rel_pos is not None:
             weight = rel_pos(weight.reshape(bs, self.n_heads, weight.shape[-2], weight.shape[-1])).reshape(bs * self.n_heads, weight.shape[-2], weight.shape[-1])
+        if padding_mask is not None:
+            # A finite minimum rather than -inf, every query has at least one valid key.
+            keys = padding_mask.repeat_interleave(self.n_heads, dim=0).unsqueeze(1)
+            weight = weight.masked_fill(~keys, torch.finfo(weight.dtype).min)
         weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
         if mask is not None:
             # The proper way to do this is to mask before the softmax using -inf, but that doesn't work properly on CPUs.
@@ -114,12 +133,14 @@ class AttentionBlock(nn.Module):
         else:
             self.relative_pos_embeddings = None
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, padding_mask=None):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
-        h = self.attention(qkv, mask, self.relative_pos_embeddings)
+        qkv = self.qkv(self.norm(x, padding_mask))
+        h = self.attention(qkv, mask, self.relative_pos_embeddings, padding_mask=padding_mask)
         h = self.proj_out(h)
+        if padding_mask is not None:
+            h = h.masked_fill(~padding_mask.unsqueeze(1), 0)
         return (x + h).reshape(b, c, *spatial)
 
 
@@ -46,6 +46,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        # When a list, forward() appends the normalized final hidden state of the last position at each call, which is
+        # the latent of the token being generated.
+        self.latent_capture = None
     def parallelize(self, device_map=None):
         self.device_map = (
             get_device_map(len(self.transformer.h), range(max(1, torch.cuda.device_count())))
@@ -171,7 +174,12 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
-        lm_logits = self.lm_head(hidden_states)
+        if self.latent_capture is not None:
+            normed = self.final_norm(hidden_states)
+            self.latent_capture.append(normed[:, -1])
+            lm_logits = self.lm_head[1](normed)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -533,14 +541,40 @@ class UnifiedVoice(nn.Module):
         gpt_inputs[:, -1] = self.start_mel_token
         return gpt_inputs
     def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):        
-
-        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
-        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
-
-        conds = speech_conditioning_latent.unsqueeze(1)
-        emb = torch.cat([conds, text_emb], dim=1)
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, text_lengths=None,
+                         return_latent=False, **hf_generate_kwargs):
+        """
+        Samples mel codes for the given text. When text_lengths is given, text_inputs is a right padded batch of
+        different texts (each one with its own conditioning latent): each row is embedded with its actual length and
+        the rows are left padded and masked, so they generate exactly as if they were sampled alone.
+        When return_latent is True, returns (codes, latents) where latents are the final hidden states captured while
+        generating, (b, generated length, model_dim). They are the latents forward(..., return_latent=True) computes
+        for the same codes, except after the stop token: the generation feeds the stop and padding tokens there, while
+        the codes given to forward() are usually fixed up with calm tokens (see fix_autoregressive_output()).
+        """
+        attention_mask = None
+        if text_lengths is None:
+            text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+            text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+            text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+
+            conds = speech_conditioning_latent.unsqueeze(1)
+            emb = torch.cat([conds, text_emb], dim=1)
+        else:
+            assert input_tokens is None, "input_tokens are not supported with padded text inputs"
+            conds = speech_conditioning_latent.unsqueeze(1)
+            embs = []
+            for b in range(text_inputs.shape[0]):
+                row = F.pad(text_inputs[b:b+1, :int(text_lengths[b])], (0, 1), value=self.stop_text_token)
+                row, _ = self.build_aligned_inputs_and_targets(row, self.start_text_token, self.stop_text_token)
+                embs.append(torch.cat([conds[b:b+1], self.text_embedding(row) + self.text_pos_embedding(row)], dim=1))
+            emb_len = max(e.shape[1] for e in embs)
+            emb = torch.cat([F.pad(e, (0, 0, emb_len - e.shape[1], 0)) for e in embs], dim=0)
+            # +1 for the start_mel_token
+            attention_mask = torch.ones((emb.shape[0], emb_len + 1), dtype=torch.long, device=text_inputs.device)
+            for b, e in enumerate(embs):
+                attention_mask[b, :emb_len - e.shape[1]] = 0
+            hf_generate_kwargs['attention_mask'] = attention_mask
         self.inference_model.store_mel_emb(emb)
 
         fake_inputs = torch.full((emb.shape[0], conds.shape[1] + emb.shape[1],), fill_value=1, dtype=torch.long,
@@ -557,9 +591,19 @@ class UnifiedVoice(nn.Module):
 
         logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
         max_length = trunc_index + self.max_mel_tokens - 1  if max_generate_length is None else trunc_index + max_generate_length
-        gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        if return_latent:
+            assert input_tokens is None, "return_latent is not supported with input_tokens"
+            self.inference_model.latent_capture = []
+        try:
+            gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+            if return_latent:
+                # one forward call per generated token
+                latents = torch.stack(self.inference_model.latent_capture, dim=1)[:, :gen.shape[1] - trunc_index]
+                return gen[:, trunc_index:], latents
+        finally:
+            self.inference_model.latent_capture = None
         return gen[:, trunc_index:]
 
     def get_generator(self, fake_inputs, **hf_generate_kwargs):
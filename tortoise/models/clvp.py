@@ -100,8 +100,13 @@ class CLVP(nn.Module):
             self,
             text,
             speech_tokens,
-            return_loss=False
+            return_loss=False,
+            text_lengths=None
     ):
+        """
+        text_lengths: optional long tensor (b,) with the actual length of each row of a right padded text batch. The
+        padding is masked out, so each row is scored as if it was evaluated alone.
+        """
         b, device = text.shape[0], text.device
         if self.training:
             text_mask = torch.rand_like(text.float()) > self.text_mask_percentage
@@ -109,6 +114,8 @@ class CLVP(nn.Module):
         else:
             text_mask = torch.ones_like(text.float()).bool()
             voice_mask = torch.ones_like(speech_tokens.float()).bool()
+        if text_lengths is not None:
+            text_mask = text_mask & (torch.arange(text.shape[1], device=device).unsqueeze(0) < text_lengths.unsqueeze(1))
 
         text_emb = self.text_emb(text)
         speech_emb = self.speech_emb(speech_tokens)
@@ -41,17 +41,17 @@ def timestep_embedding(timesteps, dim, max_period=10000):
 
 class TimestepBlock(nn.Module):
     @abstractmethod
-    def forward(self, x, emb):
+    def forward(self, x, emb, padding_mask=None):
         """
         Apply the module to `x` given `emb` timestep embeddings.
         """
 
 
 class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
-    def forward(self, x, emb):
+    def forward(self, x, emb, padding_mask=None):
         for layer in self:
             if isinstance(layer, TimestepBlock):
-                x = layer(x, emb)
+                x = layer(x, emb, padding_mask)
             else:
                 x = layer(x)
         return x
@@ -104,20 +104,27 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = nn.Conv1d(channels, self.out_channels, eff_kernel, padding=eff_padding)
 
-    def forward(self, x, emb):
-        h = self.in_layers(x)
+    def forward(self, x, emb, padding_mask=None):
+        # With a padding_mask ([N x T] bools), the normalizations ignore the padded positions and they are zeroed before
+        # each convolution, so each row of the batch is computed as if it was alone.
+        h = self.in_layers[1:](self.in_layers[0](x, padding_mask))
         emb_out = self.emb_layers(emb).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
         if self.use_scale_shift_norm:
             out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
             scale, shift = torch.chunk(emb_out, 2, dim=1)
-            h = out_norm(h) * (1 + scale) + shift
+            h = out_norm(h, padding_mask) * (1 + scale) + shift
+            if padding_mask is not None:
+                h = h.masked_fill(~padding_mask.unsqueeze(1), 0)
             h = out_rest(h)
         else:
             h = h + emb_out
-            h = self.out_layers(h)
-        return self.skip_connection(x) + h
+            h = self.out_layers[1:](self.out_layers[0](h, padding_mask))
+        h = self.skip_connection(x) + h
+        if padding_mask is not None:
+            h = h.masked_fill(~padding_mask.unsqueeze(1), 0)
+        return h
 
 
 class DiffusionLayer(TimestepBlock):
@@ -126,9 +133,9 @@ class DiffusionLayer(TimestepBlock):
         self.resblk = ResBlock(model_channels, model_channels, dropout, model_channels, dims=1, use_scale_shift_norm=True)
         self.attn = AttentionBlock(model_channels, num_heads, relative_pos_embeddings=True)
 
-    def forward(self, x, time_emb):
-        y = self.resblk(x, time_emb)
-        return self.attn(y)
+    def forward(self, x, time_emb, padding_mask=None):
+        y = self.resblk(x, time_emb, padding_mask)
+        return self.attn(y, padding_mask=padding_mask)
 
 
 class DiffusionTts(nn.Module):
@@ -259,7 +266,7 @@ class DiffusionTts(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
-    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False, padding_mask=None):
         """
         Apply the model to an input batch.
 
@@ -269,13 +276,21 @@ class DiffusionTts(nn.Module):
         :param conditioning_latent: a pre-computed conditioning latent; see get_conditioning().
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  Can also be an [N] bool tensor, to only ignore them for some rows of the batch.
+        :param padding_mask: an optional [N x T] bool tensor of the valid positions of x, for batches of padded inputs. The
+                             padding does not influence the valid positions and the outputs are zero there.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_latent is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
 
         unused_params = []
-        if conditioning_free:
+        if torch.is_tensor(conditioning_free):
+            # Conditioned and conditioning-free rows in the same batch, only used for inference.
+            assert not self.training and precomputed_aligned_embeddings is not None
+            code_emb = torch.where(conditioning_free.reshape(-1, 1, 1), self.unconditioned_embedding,
+                                   precomputed_aligned_embeddings)
+        elif conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
             unused_params.extend(list(self.latent_conditioner.parameters()))
@@ -291,9 +306,14 @@ class DiffusionTts(nn.Module):
 
             unused_params.append(self.unconditioned_embedding)
 
+        if padding_mask is not None:
+            code_emb = code_emb.masked_fill(~padding_mask.unsqueeze(1), 0)
+            x = x.masked_fill(~padding_mask.unsqueeze(1), 0)
         time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
-        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb)
+        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb, padding_mask)
         x = self.inp_block(x)
+        if padding_mask is not None:
+            x = x.masked_fill(~padding_mask.unsqueeze(1), 0)
         x = torch.cat([x, code_emb], dim=1)
         x = self.integrating_conv(x)
         for i, lyr in enumerate(self.layers):
@@ -304,12 +324,16 @@ class DiffusionTts(nn.Module):
                 # First and last blocks will have autocast disabled for improved precision.
                 if not torch.backends.mps.is_available():
                     with autocast(x.device.type, enabled=self.enable_fp16 and i != 0):
-                        x = lyr(x, time_emb)
+                        x = lyr(x, time_emb, padding_mask)
                 else:
-                    x = lyr(x, time_emb)
+                    x = lyr(x, time_emb, padding_mask)
 
         x = x.float()
-        out = self.out(x)
+        if padding_mask is None:
+            out = self.out(x)
+        else:
+            out = self.out[2](self.out[1](self.out[0](x, padding_mask)))
+            out = out.masked_fill(~padding_mask.unsqueeze(1), 0)
 
         # Involve probabilistic or possibly unused parameters in loss so we don't get DDP errors.
         extraneous_addition = 0
@@ -0,0 +1,112 @@
+import argparse
+from time import perf_counter
+
+import torch
+import torch.nn.functional as F
+
+from api import TextToSpeech, MODELS_DIR, fix_autoregressive_output
+from utils.audio import load_voices
+
+DEFAULT_TEXTS = [
+    "Hello there, traveler.",
+    "I used to be an adventurer like you, then I took an arrow in the knee.",
+    "The expressiveness of autoregressive transformers is literally nuts! I absolutely adore them.",
+]
+
+
+def sample_and_score(tts, text, auto_conditioning, num_samples, seed):
+    """
+    Generates num_samples autoregressive samples of text with the settings of the presets and scores them with the
+    CLVP of tts. Returns the codes, the scores and the seconds spent in each model.
+    """
+    torch.manual_seed(seed)
+    text_tokens = F.pad(torch.IntTensor(tts.tokenizer.encode(text)).unsqueeze(0), (0, 1))
+    settings = tts._preset_settings('fast', {})
+    samples = []
+    start = perf_counter()
+    with torch.no_grad():
+        for _ in range(num_samples // tts.autoregressive_batch_size):
+            codes = tts.autoregressive.inference_speech(auto_conditioning, text_tokens, do_sample=True,
+                                                        top_p=settings['top_p'], temperature=settings['temperature'],
+                                                        num_return_sequences=tts.autoregressive_batch_size,
+                                                        length_penalty=settings['length_penalty'],
+                                                        repetition_penalty=settings['repetition_penalty'],
+                                                        max_generate_length=500)
+            samples.append(F.pad(codes, (0, 500 - codes.shape[1]), value=tts.autoregressive.stop_mel_token))
+        autoregressive_time = perf_counter() - start
+        codes = torch.cat(samples, dim=0)
+        for i in range(codes.shape[0]):
+            codes[i] = fix_autoregressive_output(codes[i], tts.autoregressive.stop_mel_token, complain=False)
+        scores, clvp_time = score(tts, text_tokens, codes)
+    return codes, scores, autoregressive_time, clvp_time
+
+
+def score(tts, text_tokens, codes):
+    start = perf_counter()
+    with torch.no_grad():
+        scores = tts.clvp(text_tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+    return scores, perf_counter() - start
+
+
+def rank_correlation(a, b):
+    """
+    Spearman correlation of two score vectors.
+    """
+    rank_a = a.argsort().argsort().float()
+    rank_b = b.argsort().argsort().float()
+    rank_a, rank_b = rank_a - rank_a.mean(), rank_b - rank_b.mean()
+    return float((rank_a * rank_b).sum() / (rank_a.norm() * rank_b.norm()).clamp(min=1e-9))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the speed and the CLVP scores of the fp32 and dynamic int8 '
+                                                 'autoregressive model and CLVP on the CPU. Both sets of models are '
+                                                 'loaded at once, so it needs enough memory for both.')
+    parser.add_argument('--voice', type=str, help='Voice used for the comparison.', default='train_dotrice')
+    parser.add_argument('--text', type=str, action='append', help='Text to synthesize, can be repeated. Defaults to a few sentences of different lengths.')
+    parser.add_argument('--samples', type=int, help='Autoregressive samples per text.', default=16)
+    parser.add_argument('--top_k', type=int, help='Number of best samples compared between the two CLVPs.', default=3)
+    parser.add_argument('--threads', type=int, help='CPU threads, defaults to the number of physical cores.', default=None)
+    parser.add_argument('--seed', type=int, help='Random seed of the autoregressive sampling.', default=0)
+    parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints.', default=MODELS_DIR)
+    args = parser.parse_args()
+    texts = args.text or DEFAULT_TEXTS
+
+    fp32 = TextToSpeech(models_dir=args.model_dir, device='cpu', enable_redaction=False, cpu_profile='fp32',
+                        cpu_threads=args.threads)
+    int8 = TextToSpeech(models_dir=args.model_dir, device='cpu', enable_redaction=False, cpu_threads=args.threads,
+                        quantize=True)
+    voice_samples, conditioning_latents = load_voices([args.voice])
+    if conditioning_latents is None:
+        conditioning_latents = fp32.get_conditioning_latents(voice_samples)
+    auto_conditioning = conditioning_latents[0]
+
+    totals = {'fp32_autoregressive': 0.0, 'int8_autoregressive': 0.0, 'fp32_clvp': 0.0, 'int8_clvp': 0.0}
+    for text in texts:
+        print(f"'{text}'")
+        fp32_codes, fp32_scores, fp32_ar_time, fp32_clvp_time = sample_and_score(fp32, text, auto_conditioning, args.samples, args.seed)
+        int8_codes, int8_scores, int8_ar_time, _ = sample_and_score(int8, text, auto_conditioning, args.samples, args.seed)
+        text_tokens = F.pad(torch.IntTensor(fp32.tokenizer.encode(text)).unsqueeze(0), (0, 1))
+        # Same samples scored by both CLVPs: how much the quantized CLVP changes the ranking.
+        int8_clvp_scores, int8_clvp_time = score(int8, text_tokens, fp32_codes)
+        k = min(args.top_k, fp32_codes.shape[0])
+        top_fp32 = set(fp32_scores.topk(k).indices.tolist())
+        top_int8 = set(int8_clvp_scores.topk(k).indices.tolist())
+        # Samples of the quantized autoregressive model judged by the fp32 CLVP: how much worse the candidates are.
+        int8_ar_scores, _ = score(fp32, text_tokens, int8_codes)
+        print(f"  autoregressive: fp32 {fp32_ar_time:.2f}s, int8 {int8_ar_time:.2f}s ({fp32_ar_time / int8_ar_time:.2f}x)")
+        print(f"  clvp: fp32 {fp32_clvp_time:.2f}s, int8 {int8_clvp_time:.2f}s ({fp32_clvp_time / int8_clvp_time:.2f}x)")
+        print(f"  int8 clvp vs fp32 clvp: mean abs score difference {(int8_clvp_scores - fp32_scores).abs().mean():.4f}, "
+              f"rank correlation {rank_correlation(fp32_scores, int8_clvp_scores):.3f}, "
+              f"top {k} overlap {len(top_fp32 & top_int8)}/{k}")
+        print(f"  fp32 clvp scores: fp32 samples mean {fp32_scores.mean():.4f} best {fp32_scores.max():.4f}, "
+              f"int8 samples mean {int8_ar_scores.mean():.4f} best {int8_ar_scores.max():.4f}")
+        totals['fp32_autoregressive'] += fp32_ar_time
+        totals['int8_autoregressive'] += int8_ar_time
+        totals['fp32_clvp'] += fp32_clvp_time
+        totals['int8_clvp'] += int8_clvp_time
+
+    print(f"Total autoregressive: fp32 {totals['fp32_autoregressive']:.2f}s, int8 {totals['int8_autoregressive']:.2f}s "
+          f"({totals['fp32_autoregressive'] / totals['int8_autoregressive']:.2f}x)")
+    print(f"Total clvp: fp32 {totals['fp32_clvp']:.2f}s, int8 {totals['int8_clvp']:.2f}s "
+          f"({totals['fp32_clvp'] / totals['int8_clvp']:.2f}x)")
@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import hashlib
+
+import torch
+
+
+class ArtifactStore:
+    """
+    On-disk checkpoints of the intermediate results of one utterance, used by TextToSpeech.tts() to skip the stages
+    already completed by a previous run. Each stage is a file with its tensors and the fingerprint of the inputs that
+    produced them, so results computed with other settings are never reused.
+    Stages, in pipeline order:
+        codes: the autoregressive samples.
+        scores: the samples (fixed for the CLVP) and their CLVP/CVVP scores.
+        best: the codes and latents of the k best samples, the input of the diffusion.
+    """
+    STAGE_CODES = 'codes'
+    STAGE_SCORES = 'scores'
+    STAGE_BEST = 'best'
+    STAGES = [STAGE_CODES, STAGE_SCORES, STAGE_BEST]
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def stage_fingerprints(text, conditioning, seed, num_autoregressive_samples, batch_size, temperature,
+                           length_penalty, repetition_penalty, top_p, max_mel_tokens, hf_generate_kwargs,
+                           cvvp_amount, k, adaptive=None, reuse_latents=False):
+        """
+        Fingerprint of the inputs of each stage, as a dict stage -> hex string. Each fingerprint includes the one of
+        the previous stage. adaptive holds the adaptive sampling settings, None when it is disabled. reuse_latents
+        tells if the latents of the best samples are the ones captured while sampling.
+        """
+        conditioning_hash = hashlib.sha256(conditioning.detach().float().cpu().numpy().tobytes()).hexdigest()
+        inputs = {'text': text, 'conditioning': conditioning_hash, 'seed': seed,
+                  'num_autoregressive_samples': num_autoregressive_samples, 'batch_size': batch_size,
+                  'temperature': temperature, 'length_penalty': length_penalty,
+                  'repetition_penalty': repetition_penalty, 'top_p': top_p,
+                  'max_mel_tokens': max_mel_tokens, 'hf_generate_kwargs': hf_generate_kwargs}
+        if adaptive is not None:
+            # the number of samples depends on the scores, with the k of the ranking
+            inputs.update({'adaptive': adaptive, 'k': k})
+        codes = ArtifactStore._hash(inputs)
+        scores = ArtifactStore._hash({'codes': codes, 'cvvp_amount': cvvp_amount})
+        best = {'scores': scores, 'k': k}
+        if reuse_latents:
+            best['reuse_latents'] = True
+        best = ArtifactStore._hash(best)
+        return {ArtifactStore.STAGE_CODES: codes, ArtifactStore.STAGE_SCORES: scores, ArtifactStore.STAGE_BEST: best}
+
+    def resume(self, fingerprints):
+        """
+        Returns (stage, tensors) of the last stage saved with a matching fingerprint, or (None, None).
+        """
+        for stage in reversed(ArtifactStore.STAGES):
+            tensors = self.load(stage, fingerprints[stage])
+            if tensors is not None:
+                return stage, tensors
+        return None, None
+
+    def load(self, stage, fingerprint):
+        """
+        Returns the tensors saved for stage as a dict, or None if there are none or they have another fingerprint.
+        """
+        path = self._stage_path(stage)
+        if not os.path.exists(path):
+            return None
+        try:
+            data = torch.load(path, map_location='cpu')
+        except Exception as e:
+            print(f"WARNING: Ignoring the unreadable checkpoint {path}: {e}")
+            return None
+        if data.get('fingerprint') != fingerprint:
+            return None
+        tensors = data['tensors']
+        if 'codes' in tensors:
+            tensors['codes'] = tensors['codes'].long()
+        return tensors
+
+    def save(self, stage, fingerprints, **tensors):
+        """
+        Save the tensors of stage, with its fingerprint taken from fingerprints. The codes are kept as int16.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tensors = {name: tensor.detach().cpu() for name, tensor in tensors.items()}
+        if 'codes' in tensors:
+            tensors['codes'] = tensors['codes'].short()
+        path = self._stage_path(stage)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({'fingerprint': fingerprints[stage], 'tensors': tensors}, tmp_path)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        """
+        Remove all the checkpoints of the utterance.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _stage_path(self, stage):
+        return os.path.join(self.directory, f"{stage}.pth")
+
+    @staticmethod
+    def _hash(values):
+        return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
@@ -0,0 +1,51 @@
+import torch
+
+
+class ClvpConvergence:
+    """
+    Decides when the adaptive autoregressive sampling of TextToSpeech.tts() can stop. After each batch of samples is
+    scored by the CLVP, the mean of the k best scores seen so far is compared to its value before the batch. Sampling
+    stops once it has not improved by more than margin (relative to its magnitude) for patience batches in a row, and
+    at least min_samples samples were taken. It always stops at max_samples.
+    """
+    DEFAULT_MARGIN = .01
+    DEFAULT_PATIENCE = 2
+    DEFAULT_MIN_SAMPLES = 32
+
+    def __init__(self, k, max_samples, margin=DEFAULT_MARGIN, patience=DEFAULT_PATIENCE,
+                 min_samples=DEFAULT_MIN_SAMPLES):
+        self.k = k
+        self.max_samples = max_samples
+        self.margin = margin
+        self.patience = patience
+        self.min_samples = min(min_samples, max_samples)
+        self.samples = 0
+        self.stalled_batches = 0
+        self.top_scores = None
+
+    def update(self, scores):
+        """
+        Accounts the scores of a new batch. Returns True when sampling should stop.
+        """
+        scores = scores.detach().float().flatten().cpu()
+        self.samples += scores.shape[0]
+        previous = self.top_score()
+        # the first batches only fill the top k
+        filled = self.top_scores is not None and self.top_scores.shape[0] == self.k
+        candidates = scores if self.top_scores is None else torch.cat([self.top_scores, scores])
+        self.top_scores = candidates.topk(min(self.k, candidates.shape[0])).values
+        current = self.top_score()
+        if filled:
+            if current - previous > self.margin * max(abs(previous), 1e-6):
+                self.stalled_batches = 0
+            else:
+                self.stalled_batches += 1
+        if self.samples >= self.max_samples:
+            return True
+        return self.samples >= self.min_samples and self.stalled_batches >= self.patience
+
+    def top_score(self):
+        """
+        Mean of the k best scores so far, None before the first batch.
+        """
+        return None if self.top_scores is None else float(self.top_scores.mean())
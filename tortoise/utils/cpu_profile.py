@@ -0,0 +1,107 @@
+import os
+from contextlib import contextmanager
+
+import torch
+
+
+class CpuProfile:
+    """
+    Execution settings used by TextToSpeech when it runs on the CPU.
+    Profiles:
+        'auto': bf16 autocast when half precision is requested and the CPU has native bf16 support, fp32 otherwise.
+        'bf16': bf16 autocast whenever torch supports it on this CPU.
+        'fp32': no autocast.
+    The number of intra-op threads is set for each inference stage, see STAGE_MAX_THREADS. The inter-op pool is not
+    used by eager inference, so it is reduced to interop_threads to avoid oversubscribing the cores.
+    """
+    PROFILES = ['auto', 'bf16', 'fp32']
+    # The autoregressive decoding multiplies a few rows by the weights at each token, it is limited by the memory
+    # bandwidth and stops scaling after a few threads. The other stages are convolutions or full sequence passes and
+    # use all the threads.
+    STAGE_MAX_THREADS = {'autoregressive': 8}
+    # Batches of samples amortize the weight reads of the memory bound decoding.
+    AUTOREGRESSIVE_BATCH_SIZE = 4
+    DEFAULT_INTEROP_THREADS = 1
+
+    def __init__(self, profile='auto', half=False, threads=None, interop_threads=DEFAULT_INTEROP_THREADS,
+                 stage_threads=None):
+        """
+        :param threads: Intra-op threads, defaults to the torch default (the number of physical cores).
+        :param stage_threads: Optional dict stage name -> thread count, overriding STAGE_MAX_THREADS.
+        """
+        assert profile in CpuProfile.PROFILES, f"Unknown cpu profile {profile}, use one of {CpuProfile.PROFILES}"
+        self.profile = profile
+        self.threads = torch.get_num_threads() if threads is None else threads
+        self.stage_threads = dict(CpuProfile.STAGE_MAX_THREADS)
+        if stage_threads is not None:
+            self.stage_threads.update(stage_threads)
+        self.bf16 = False
+        self.configure(profile, half)
+        torch.set_num_threads(self.threads)
+        if interop_threads is not None and torch.get_num_interop_threads() != interop_threads:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError:
+                # It can only be set before the first parallel work of the process.
+                print(f"WARNING: Cannot set the inter-op threads to {interop_threads}, torch already started them.")
+        # Denormal floats are computed in microcode by x86 CPUs, the diffusion produces many of them.
+        torch.set_flush_denormal(True)
+
+    def configure(self, profile=None, half=None):
+        """
+        Changes the profile, and the half precision request for the 'auto' profile.
+        """
+        profile = self.profile if profile is None else profile
+        assert profile in CpuProfile.PROFILES, f"Unknown cpu profile {profile}, use one of {CpuProfile.PROFILES}"
+        self.profile = profile
+        if profile == 'fp32':
+            self.bf16 = False
+        elif profile == 'bf16':
+            self.bf16 = CpuProfile.bf16_available()
+        else:
+            self.bf16 = bool(half) and CpuProfile.bf16_native()
+
+    def autocast(self):
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=self.bf16)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Runs the with block with the thread count of the stage name.
+        """
+        threads = min(self.threads, self.stage_threads.get(name, self.threads))
+        previous = torch.get_num_threads()
+        if threads != previous:
+            torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            if threads != previous:
+                torch.set_num_threads(previous)
+
+    def describe(self):
+        return (f"CPU profile {self.profile}: {'bf16' if self.bf16 else 'fp32'}, {self.threads} threads "
+                f"(of {os.cpu_count()} logical cores)")
+
+    @staticmethod
+    def bf16_available():
+        """
+        True when torch can run bf16 autocast on the CPU, even if it is emulated.
+        """
+        try:
+            with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+                torch.ones(1, 1) @ torch.ones(1, 1)
+            return True
+        except (RuntimeError, AssertionError):
+            return False
+
+    @staticmethod
+    def bf16_native():
+        """
+        True when oneDNN has optimized bf16 kernels for this CPU (AVX512 and newer, with native instructions on
+        AVX512-BF16 and AMX). Elsewhere bf16 is emulated and slower than fp32.
+        """
+        try:
+            return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported()) and CpuProfile.bf16_available()
+        except (AttributeError, RuntimeError):
+            return False
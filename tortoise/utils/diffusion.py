@@ -187,8 +187,15 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param fused_conditioning_free: if True, the conditioned and the
+                                    conditioning-free passes of each step are
+                                    run as a single forward of a doubled batch.
+                                    The model must accept a per-row bool
+                                    tensor as conditioning_free.
     """
 
+    SAMPLERS = ['p', 'ddim', 'dpm++2m']
+
     def __init__(
         self,
         *,
@@ -200,6 +207,7 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        fused_conditioning_free=False,
     ):
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
@@ -208,6 +216,7 @@ class GaussianDiffusion:
         self.conditioning_free = conditioning_free
         self.conditioning_free_k = conditioning_free_k
         self.ramp_conditioning_free = ramp_conditioning_free
+        self.fused_conditioning_free = fused_conditioning_free
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -337,9 +346,12 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,)
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
-        if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+        if self.conditioning_free and self.fused_conditioning_free:
+            model_output, model_output_no_conditioning = self._fused_conditioning_free_outputs(model, x, t, model_kwargs)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+            if self.conditioning_free:
+                model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -376,7 +388,7 @@ class GaussianDiffusion:
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                assert (t == t[0]).all()  # This should only be used in inference, with the same timestep for the whole batch.
                 cfk = self.conditioning_free_k * (1 - self._scale_timesteps(t)[0].item() / self.num_timesteps)
             else:
                 cfk = self.conditioning_free_k
@@ -417,6 +429,25 @@ class GaussianDiffusion:
             "pred_xstart": pred_xstart,
         }
 
+    def _fused_conditioning_free_outputs(self, model, x, t, model_kwargs):
+        """
+        Run the conditioned and the conditioning-free passes of p_mean_variance()
+        as one forward of a 2B batch: the first B rows are conditioned, the
+        last B rows are not. Tensor model_kwargs with one row per sample are
+        repeated for both halves.
+
+        :return: a tuple (model_output, model_output_no_conditioning).
+        """
+        B = x.shape[0]
+        conditioning_free = th.cat([th.zeros(B, dtype=th.bool, device=x.device),
+                                    th.ones(B, dtype=th.bool, device=x.device)])
+        kwargs = {
+            key: th.cat([value, value]) if th.is_tensor(value) and value.shape[:1] == (B,) else value
+            for key, value in model_kwargs.items()
+        }
+        output = model(th.cat([x, x]), self._scale_timesteps(th.cat([t, t])), conditioning_free=conditioning_free, **kwargs)
+        return output[:B], output[B:]
+
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
@@ -792,6 +823,147 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def dpm_solver_sample(
+        self,
+        model,
+        x,
+        t,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        previous=None,
+    ):
+        """
+        Sample x_{t-1} from the model with one step of the second order
+        multistep DPM-Solver++ (2M) of Lu et al. 2022, which integrates the
+        probability flow ODE from the x_0 predictions. t must be the same for
+        the whole batch.
+
+        :param previous: the dict returned by the previous step, or None for
+                         the first step. The first and the last two steps are
+                         first order.
+        :return: a dict containing the following keys:
+                 - 'sample': the sample at timestep t-1.
+                 - 'pred_xstart': a prediction of x_0.
+                 - 'h': the step in log signal-to-noise ratio, used by the
+                        next step.
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        i = int(t[0])
+        alpha_bar, alpha_bar_prev = self.alphas_cumprod[i], self.alphas_cumprod_prev[i]
+        if alpha_bar_prev == 1.0:
+            # The last step reaches the noise-free signal.
+            return {"sample": out["pred_xstart"], "pred_xstart": out["pred_xstart"], "h": None}
+        # Signal and noise scales of x_t and x_{t-1}, and the half log SNR step between them.
+        alpha_s, sigma_s = math.sqrt(alpha_bar), math.sqrt(1.0 - alpha_bar)
+        alpha_t, sigma_t = math.sqrt(alpha_bar_prev), math.sqrt(1.0 - alpha_bar_prev)
+        h = math.log(alpha_t / sigma_t) - math.log(alpha_s / sigma_s)
+        denoised = out["pred_xstart"]
+        # The step into the last timestep is first order too: near the noise-free
+        # end of the schedule it is much longer than the previous one, and the
+        # second order extrapolation overshoots (lower_order_final of DPM-Solver).
+        if previous is not None and previous["h"] is not None and i > 1:
+            r = previous["h"] / h
+            denoised = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * previous["pred_xstart"]
+        sample = (sigma_t / sigma_s) * x - alpha_t * math.expm1(-h) * denoised
+        return {"sample": sample, "pred_xstart": out["pred_xstart"], "h": h}
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Generate samples from the model using DPM-Solver++ (2M). It is
+        deterministic given the noise and needs far fewer steps than
+        p_sample_loop(), use a diffusion respaced to 20-50 steps.
+
+        Same usage as p_sample_loop().
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Use DPM-Solver++ (2M) to sample from the model and yield intermediate
+        samples from each timestep.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+
+        out = None
+        for i in tqdm(indices, disable=not progress):
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                out = self.dpm_solver_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                    previous=out,
+                )
+                yield out
+                img = out["sample"]
+
+    def sample_loop(self, sampler, model, shape, eta=0.0, **kwargs):
+        """
+        Generate samples from the model with one of SAMPLERS:
+        'p': p_sample_loop(), 'ddim': ddim_sample_loop() with eta, or
+        'dpm++2m': dpm_solver_sample_loop().
+
+        The other arguments are the same as p_sample_loop().
+        """
+        assert sampler in GaussianDiffusion.SAMPLERS, f"Unknown sampler {sampler}, use one of {GaussianDiffusion.SAMPLERS}"
+        if sampler == 'ddim':
+            return self.ddim_sample_loop(model, shape, eta=eta, **kwargs)
+        if sampler == 'dpm++2m':
+            return self.dpm_solver_sample_loop(model, shape, **kwargs)
+        return self.p_sample_loop(model, shape, **kwargs)
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
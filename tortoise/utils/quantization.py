@@ -0,0 +1,67 @@
+import os
+
+import torch
+import torch.nn as nn
+
+
+def conv1d_to_linear(model):
+    """
+    Replaces the transformers Conv1D layers of model (the projections of the HF GPT-2 blocks) by equivalent nn.Linear
+    layers, so dynamic quantization converts them too. Conv1D stores its weight as (in, out), nn.Linear as (out, in).
+    """
+    from transformers.pytorch_utils import Conv1D
+    for name, child in list(model.named_children()):
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = nn.Linear(in_features, out_features, bias=child.bias is not None)
+            linear.weight.data = child.weight.data.t().contiguous()
+            if child.bias is not None:
+                linear.bias.data = child.bias.data
+            setattr(model, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return model
+
+
+def quantize_dynamic_int8(model):
+    """
+    Converts the Linear layers of model to dynamic int8 in place: the weights are stored as int8 and the activations
+    are quantized on the fly, per batch. The quantized layers only run on the CPU.
+    """
+    conv1d_to_linear(model)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def load_quantized(model, checkpoint_path, cache_path, strict=True):
+    """
+    Loads the fp32 checkpoint into model and quantizes it with quantize_dynamic_int8(). The quantized state dict is
+    cached in cache_path, and used instead of the checkpoint by the next calls as long as the checkpoint and the torch
+    version do not change.
+    :param model: Freshly constructed model, with the architecture of the checkpoint.
+    :param strict: Passed to load_state_dict() for the fp32 checkpoint.
+    """
+    fingerprint = checkpoint_fingerprint(checkpoint_path)
+    if os.path.exists(cache_path):
+        try:
+            cached = torch.load(cache_path, map_location='cpu')
+            if cached.get('fingerprint') == fingerprint:
+                quantize_dynamic_int8(model)
+                model.load_state_dict(cached['state_dict'])
+                return model
+        except Exception as e:
+            print(f"WARNING: Ignoring the unreadable quantized model {cache_path}: {e}")
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'), strict=strict)
+    quantize_dynamic_int8(model)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    torch.save({'fingerprint': fingerprint, 'state_dict': model.state_dict()}, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return model
+
+
+def checkpoint_fingerprint(checkpoint_path):
+    """
+    Identifies a checkpoint file by its name, size and modification time, and the torch version loading it.
+    """
+    stat = os.stat(checkpoint_path)
+    return {'checkpoint': os.path.basename(os.path.realpath(checkpoint_path)), 'size': stat.st_size,
+            'mtime': int(stat.st_mtime), 'torch': torch.__version__}
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+from time import monotonic
+
+import torch
+
+
+class ModelResidency:
+    """
+    Tracks which models are on the inference device and moves them only when a policy requires it, instead of copying
+    every model to the device and back to the CPU on each call.
+    Policies:
+        'resident': a model stays on the device once loaded.
+        'lru': models stay on the device while their total size fits in budget_bytes, the least recently used idle
+               models are offloaded to make room for a new one.
+        'idle': models are offloaded when they were not used for idle_seconds (checked when a model is loaded).
+        'per_call': models are offloaded as soon as they are released, like the original temporary_cuda().
+    Models in use (between load() and release(), or inside use()) are never offloaded.
+    """
+    POLICIES = ['resident', 'lru', 'idle', 'per_call']
+    # share of the device memory used for the weights by default, the rest is left for the activations
+    DEFAULT_BUDGET_FRACTION = 0.6
+    DEFAULT_IDLE_SECONDS = 300
+
+    def __init__(self, device, policy='lru', budget_bytes=None, idle_seconds=DEFAULT_IDLE_SECONDS):
+        assert policy in ModelResidency.POLICIES, f"Unknown residency policy {policy}, use one of {ModelResidency.POLICIES}"
+        self.device = torch.device(device)
+        self.policy = policy
+        if budget_bytes is None and self.device.type == 'cuda' and torch.cuda.is_available():
+            total = torch.cuda.get_device_properties(self.device).total_memory
+            budget_bytes = int(total * ModelResidency.DEFAULT_BUDGET_FRACTION)
+        # None: no limit
+        self.budget_bytes = budget_bytes
+        self.idle_seconds = idle_seconds
+        # id(model) -> {'model', 'size', 'in_use', 'last_used'} of the models on the device
+        self._resident = {}
+
+    def set_policy(self, policy):
+        assert policy in ModelResidency.POLICIES, f"Unknown residency policy {policy}, use one of {ModelResidency.POLICIES}"
+        self.policy = policy
+        if policy == 'per_call':
+            self.offload_all()
+
+    def load(self, model):
+        """
+        Make sure model is on the device and mark it as in use. Returns the model.
+        """
+        if self.device.type == 'cpu':
+            return model
+        entry = self._resident.get(id(model))
+        if entry is None:
+            size = ModelResidency.model_size(model)
+            self._make_room(size)
+            model.to(self.device)
+            entry = self._resident[id(model)] = {'model': model, 'size': size, 'in_use': 0, 'last_used': monotonic()}
+        entry['in_use'] += 1
+        return model
+
+    def release(self, model):
+        """
+        Mark model as no longer in use, offloading it if the policy says so.
+        """
+        entry = self._resident.get(id(model))
+        if entry is None:
+            return
+        entry['in_use'] = max(0, entry['in_use'] - 1)
+        entry['last_used'] = monotonic()
+        if self.policy == 'per_call' and entry['in_use'] == 0:
+            self.offload(model)
+
+    @contextmanager
+    def use(self, model):
+        """
+        Context manager version of load() and release().
+        """
+        model = self.load(model)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def offload(self, model):
+        """
+        Move model to the CPU now, e.g. before running it there.
+        """
+        entry = self._resident.pop(id(model), None)
+        model.cpu()
+        if entry is not None and self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def offload_all(self):
+        for entry in list(self._resident.values()):
+            if entry['in_use'] == 0:
+                self.offload(entry['model'])
+
+    def resident_bytes(self):
+        return sum(entry['size'] for entry in self._resident.values())
+
+    @staticmethod
+    def model_size(model):
+        return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+    def _make_room(self, size):
+        idle = sorted((entry for entry in self._resident.values() if entry['in_use'] == 0),
+                      key=lambda entry: entry['last_used'])
+        if self.policy == 'idle':
+            now = monotonic()
+            for entry in idle:
+                if now - entry['last_used'] >= self.idle_seconds:
+                    self.offload(entry['model'])
+        elif self.policy == 'lru' and self.budget_bytes is not None:
+            for entry in idle:
+                if self.resident_bytes() + size <= self.budget_bytes:
+                    break
+                self.offload(entry['model'])
@@ -0,0 +1,117 @@
+import heapq
+import queue
+import threading
+from contextlib import nullcontext
+from itertools import count
+from time import perf_counter
+
+import torch
+
+
+class ScoringPipeline(threading.Thread):
+    """
+    Background thread scoring the autoregressive batches of TextToSpeech.tts() while the next batch is sampled.
+    Batches are handed over with submit(), scored by score_fn on the thread (on its own cuda stream on cuda devices)
+    and only the k best samples are kept, in a heap, instead of all the samples and their scores.
+    Tensors aligned with the samples (e.g. their latents) can be submitted with each batch, they are kept for the k best
+    samples only. The queue is bounded, so the sampling waits when the scoring falls behind. should_stop, when given,
+    is called with the scores of each batch and can ask the sampling to stop (see stop_requested()).
+    """
+    _STOP = object()
+
+    def __init__(self, score_fn, k, device, autocast, should_stop=None, max_pending=2):
+        super().__init__(name="clvp-scoring", daemon=True)
+        self.score_fn = score_fn
+        self.k = k
+        self.device = torch.device(device)
+        self.autocast = autocast
+        self.should_stop = should_stop
+        self.wall_time = 0.0
+        self.items = 0
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._stop_event = threading.Event()
+        self._error = None
+        # (score, sequence number, codes, extras) of the k best samples, the worst one first
+        self._heap = []
+        self._sequence = count()
+        self._cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self._stream = torch.cuda.Stream(self.device) if self._cuda else None
+
+    def submit(self, codes, *extras):
+        """
+        Queue a batch of codes, produced on the current stream, to be scored. extras are tensors with one row per
+        sample, returned by best() for the best samples.
+        """
+        if self._error is not None:
+            raise self._error
+        ready = None
+        if self._cuda:
+            ready = torch.cuda.Event()
+            ready.record()
+            # the codes are allocated on the sampling stream and freed while the scoring stream may still use them
+            for tensor in (codes,) + extras:
+                tensor.record_stream(self._stream)
+        self._jobs.put((codes, extras, ready))
+
+    def stop_requested(self):
+        return self._stop_event.is_set()
+
+    def finish(self):
+        """
+        Score the queued batches and stop the thread. Raises the error of the scoring, if any.
+        """
+        if self.is_alive():
+            self._jobs.put(ScoringPipeline._STOP)
+            self.join()
+        if self._cuda:
+            torch.cuda.current_stream().wait_stream(self._stream)
+        if self._error is not None:
+            raise self._error
+
+    def best(self):
+        """
+        Returns (codes, scores, extras) of the k best samples, best first. extras is the list of the stacked rows of the
+        tensors submitted with the codes.
+        """
+        ranked = sorted(self._heap, key=lambda entry: entry[:2], reverse=True)
+        codes = torch.stack([entry[2] for entry in ranked])
+        scores = torch.tensor([entry[0] for entry in ranked], device=codes.device)
+        extras = [torch.stack([entry[3][i] for entry in ranked]) for i in range(len(ranked[0][3]))]
+        return codes, scores, extras
+
+    def run(self):
+        # grad mode and autocast are thread local
+        with torch.no_grad(), self.autocast():
+            while True:
+                job = self._jobs.get()
+                if job is ScoringPipeline._STOP:
+                    return
+                if self._error is not None:
+                    # drain the queue, the sampling raises the error at its next submit()
+                    continue
+                try:
+                    self._score(*job)
+                except Exception as e:
+                    self._error = e
+                    self._stop_event.set()
+
+    #####################################################
+
+    def _score(self, codes, extras, ready):
+        start = perf_counter()
+        with torch.cuda.stream(self._stream) if self._cuda else nullcontext():
+            if self._cuda:
+                self._stream.wait_event(ready)
+            scores = self.score_fn(codes)
+            for i, score in enumerate(scores.float().tolist()):
+                if len(self._heap) < self.k or score > self._heap[0][0]:
+                    # copies, so the heap does not keep the whole batches alive
+                    entry = (score, next(self._sequence), codes[i].clone(), tuple(extra[i].clone() for extra in extras))
+                    if len(self._heap) < self.k:
+                        heapq.heappush(self._heap, entry)
+                    else:
+                        heapq.heapreplace(self._heap, entry)
+        self.items += codes.shape[0]
+        self.wall_time += perf_counter() - start
+        if self.should_stop is not None and self.should_stop(scores):
+            self._stop_event.set()
@@ -0,0 +1,138 @@
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import torch
+
+
+class StageStats:
+    """
+    Measurements of one inference stage. A stage can be entered several times (e.g. once per autoregressive batch),
+    the measurements are accumulated.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        # number of samples/candidates/clips processed by the stage
+        self.items = 0
+        # mel codes produced, only set by the autoregressive stage
+        self.tokens = 0
+        # peak memory allocated on the cuda device while the stage ran, None on the other devices
+        self.peak_memory = None
+        # seconds of audio of the inference result, set when the inference finishes
+        self.audio_seconds = 0.0
+
+    @property
+    def items_per_second(self):
+        return self.items / self.wall_time if self.wall_time > 0 else 0.0
+
+    @property
+    def tokens_per_second(self):
+        return self.tokens / self.wall_time if self.wall_time > 0 else 0.0
+
+    @property
+    def real_time_factor(self):
+        """
+        Seconds spent by the stage per second of audio produced.
+        """
+        return self.wall_time / self.audio_seconds if self.audio_seconds > 0 else None
+
+    def to_dict(self):
+        return {'name': self.name, 'wall_time': self.wall_time, 'items': self.items,
+                'items_per_second': self.items_per_second, 'tokens': self.tokens,
+                'tokens_per_second': self.tokens_per_second, 'peak_memory': self.peak_memory,
+                'real_time_factor': self.real_time_factor}
+
+
+class InferenceStats:
+    """
+    Per stage wall time, throughput and peak memory of a TextToSpeech inference, in the order the stages ran.
+    """
+    def __init__(self, device, stage_context=None):
+        """
+        :param stage_context: Optional callable taking a stage name and returning a context manager entered around the
+                              stage, e.g. CpuProfile.stage to set the thread count of each stage.
+        """
+        self.device = torch.device(device)
+        self.stage_context = stage_context
+        self.stages = {}
+        self.wall_time = 0.0
+        self.audio_seconds = 0.0
+        self._start = perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures the code run in the with block as part of the stage name. Yields the StageStats, so the caller can
+        count the items and tokens it processed.
+        """
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStats(name)
+        cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        if cuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        context = self.stage_context(name) if self.stage_context is not None else nullcontext()
+        start = perf_counter()
+        try:
+            with context:
+                yield stage
+        finally:
+            if cuda:
+                torch.cuda.synchronize(self.device)
+                peak = torch.cuda.max_memory_allocated(self.device)
+                stage.peak_memory = peak if stage.peak_memory is None else max(stage.peak_memory, peak)
+            stage.wall_time += perf_counter() - start
+
+    def add(self, name, wall_time, items=0):
+        """
+        Accounts work measured elsewhere, e.g. on another thread, to the stage name.
+        """
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStats(name)
+        stage.wall_time += wall_time
+        stage.items += items
+        return stage
+
+    def finish(self, audio_seconds):
+        """
+        Sets the length of the audio produced, used by the real time factors, and the total wall time.
+        """
+        self.wall_time = perf_counter() - self._start
+        self.audio_seconds = audio_seconds
+        for stage in self.stages.values():
+            stage.audio_seconds = audio_seconds
+        return self
+
+    @property
+    def real_time_factor(self):
+        return self.wall_time / self.audio_seconds if self.audio_seconds > 0 else None
+
+    @property
+    def peak_memory(self):
+        peaks = [stage.peak_memory for stage in self.stages.values() if stage.peak_memory is not None]
+        return max(peaks) if peaks else None
+
+    def to_dict(self):
+        return {'wall_time': self.wall_time, 'audio_seconds': self.audio_seconds,
+                'real_time_factor': self.real_time_factor, 'peak_memory': self.peak_memory,
+                'stages': [stage.to_dict() for stage in self.stages.values()]}
+
+    def summary(self):
+        """
+        One line per stage, for printing.
+        """
+        lines = []
+        for stage in self.stages.values():
+            line = f"{stage.name}: {stage.wall_time:.2f}s, {stage.items_per_second:.2f} items/s"
+            if stage.tokens > 0:
+                line += f", {stage.tokens_per_second:.1f} tokens/s"
+            if stage.peak_memory is not None:
+                line += f", peak {stage.peak_memory / 1024 ** 2:.0f} MB"
+            if stage.real_time_factor is not None:
+                line += f", RTF {stage.real_time_factor:.2f}"
+            lines.append(line)
+        rtf = f", RTF {self.real_time_factor:.2f}" if self.real_time_factor is not None else ""
+        lines.append(f"total: {self.wall_time:.2f}s for {self.audio_seconds:.2f}s of audio{rtf}")
+        return "\n".join(lines)